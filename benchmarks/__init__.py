@@ -0,0 +1 @@
+# Benchmarks. Run from the repository root, eg. python -m benchmarks.spatial
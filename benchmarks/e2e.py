@@ -0,0 +1,234 @@
+"""
+End-to-end runs of the bot against local fakes of sgpokemap, the geocode
+APIs and Telegram, with Telegram's flood limits enforced as 429s.
+
+    python -m benchmarks.e2e --users 10,100 --rates 2,10 --duration 30
+    python -m benchmarks.e2e --out before.json
+    python -m benchmarks.e2e --out after.json --compare before.json
+
+Each scenario starts the bot in its own process, so its peak RSS is the
+bot's alone, signs the users up with /setloc, /setradius and /monitor,
+then lets spawns appear at the given rate for duration seconds. Reports
+alert latency, from a spawn appearing upstream to an alert with its
+location reaching a chat, upstream and geocode requests, messages sent
+per second, 429s and peak memory, and saves them as JSON to compare runs.
+"""
+import argparse
+import json
+import os
+import re
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import pokedex
+from benchmarks.fake_geocode import FakeGeocode
+from benchmarks.fake_sgpokemap import FakeSgpokemap
+from benchmarks.fake_telegram import FIRST_CHAT_ID, FakeTelegram
+from benchmarks.webhook import percentile
+
+# Telegram's flood limits: messages per second per chat, and in total
+CHAT_RATE = 1.0
+GLOBAL_RATE = 30.0
+RADII = [1.0, 2.0, 3.0]
+# Seconds allowed for all users to finish signing up
+SETUP_TIMEOUT = 120
+# Where a spawn is, in a location or the map links of a merged alert
+MAP_LINK = re.compile(r'maps\.google\.com/\?q=([-0-9.]+),([-0-9.]+)')
+
+
+def run_bot(args):
+    # The bot side of a scenario, in its own process; writes its stats on SIGTERM
+    import asyncio
+    import telegram
+    from userstore import open_store
+
+    store = open_store('sqlite:' + os.path.join(args.tmp, 'users.db'))
+    bot = telegram.Bot(store, monitor_interval=args.interval)
+
+    def stop(signum, frame):
+        with open(os.path.join(args.tmp, 'stats.json'), 'w') as f:
+            json.dump({
+                'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                'users': len(bot.users),
+                'fetch_interval': bot.schedule.interval,
+                'outbox_throttled': telegram.outbox.throttled,
+            }, f)
+        # Handler threads may be parked in a long-poll
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    asyncio.run(bot.run())
+
+
+def sign_up(telegram, chat_ids):
+    # Each chat's commands are handled in order
+    for n, chat_id in enumerate(chat_ids):
+        telegram.say(chat_id, "/start")
+        telegram.say(chat_id, "/setloc block {} ang mo kio".format(n))
+        telegram.say(chat_id, "/setradius {}".format(RADII[n % len(RADII)]))
+        telegram.say(chat_id, "/monitor")
+
+    deadline = time.time() + SETUP_TIMEOUT
+    waiting = set(chat_ids)
+    while waiting and time.time() < deadline:
+        time.sleep(0.2)
+        with telegram.cond:
+            for chat_id, _, params in telegram.sent:
+                if params.get('text', '').startswith('Monitoring set until'):
+                    waiting.discard(chat_id)
+    if waiting:
+        raise RuntimeError("{} of {} users not monitoring after {} s".format(
+            len(waiting), len(chat_ids), SETUP_TIMEOUT))
+
+
+def run_scenario(users, rate, duration, interval, seed=0, verbose=False):
+    upstream = FakeSgpokemap(rate, seed, pokemon_ids=pokedex.want_ids()).start()
+    geocode = FakeGeocode().start()
+    telegram = FakeTelegram(chat_rate=CHAT_RATE, global_rate=GLOBAL_RATE).start()
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env.update(telegram.environ())
+    env.update({
+        'GOOGLE_GEOCODE_API': 'key',
+        'SGPOKEMAP_URL': upstream.query_url,
+        'GOOGLE_GEOCODE_URL': geocode.geocode_url,
+        'PLUS_CODES_URL': geocode.plus_codes_url,
+    })
+    bot = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.e2e', '--bot', '--tmp', tmp, '--interval', str(interval)],
+        env=env, stdout=None if verbose else subprocess.DEVNULL)
+    try:
+        sign_up(telegram, [FIRST_CHAT_ID + n for n in range(users)])
+        started = time.time()
+        upstream_before = upstream.requests
+        sent_before = len(telegram.sent)
+        throttled_before = telegram.throttled
+        time.sleep(duration)
+        ended = time.time()
+
+        bot.send_signal(signal.SIGTERM)
+        bot.wait(30)
+        with open(os.path.join(tmp, 'stats.json')) as f:
+            stats = json.load(f)
+
+        # Alerts for spawns that appeared once everyone was monitoring
+        latencies = []
+        with telegram.cond:
+            sent = list(zip(telegram.sent, telegram.sent_at))
+        for (chat_id, method, params), sent_at in sent:
+            if sent_at > ended:
+                continue
+            if method == 'sendLocation':
+                where = [(params['latitude'], params['longitude'])]
+            else:
+                where = MAP_LINK.findall(params.get('text', ''))
+            for lat, lng in where:
+                created = upstream.created.get((float(lat), float(lng)))
+                if created is not None and created >= started:
+                    latencies.append(sent_at - created)
+        messages = sum(1 for _, sent_at in sent[sent_before:] if sent_at <= ended)
+    finally:
+        if bot.poll() is None:
+            bot.kill()
+        for fake in (upstream, geocode, telegram):
+            fake.stop()
+        shutil.rmtree(tmp)
+
+    elapsed = ended - started
+    return {
+        'users': users,
+        'spawn_rate': rate,
+        'duration': round(elapsed, 2),
+        'spawns': int(elapsed * rate),
+        'alerts': len(latencies),
+        'alert_latency_p50': round(percentile(latencies, 50), 3) if latencies else None,
+        'alert_latency_p99': round(percentile(latencies, 99), 3) if latencies else None,
+        'upstream_requests': upstream.requests - upstream_before,
+        'geocode_requests': geocode.requests,
+        'messages': messages,
+        'messages_per_sec': round(messages / elapsed, 2),
+        'throttled': telegram.throttled - throttled_before,
+        'fetch_interval': round(stats['fetch_interval'], 1),
+        'max_rss_mb': round(stats['max_rss_mb'], 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+COLUMNS = [
+    ('users', '{:>6}'), ('spawn_rate', '{:>6}'), ('alerts', '{:>7}'),
+    ('alert_latency_p50', '{:>8}'), ('alert_latency_p99', '{:>8}'),
+    ('upstream_requests', '{:>9}'), ('messages_per_sec', '{:>8}'),
+    ('throttled', '{:>6}'), ('max_rss_mb', '{:>7}'),
+]
+HEADER = "users  rate  alerts  p50 (s)  p99 (s)  upstream  msgs/s  429s  rss MB"
+
+
+def format_row(result, baseline=None):
+    cells = []
+    for key, fmt in COLUMNS:
+        value = result.get(key)
+        cell = fmt.format(value if value is not None else '-')
+        if baseline and isinstance(value, (int, float)) and baseline.get(key):
+            cell += " ({:+.0f}%)".format((value - baseline[key]) * 100.0 / baseline[key])
+        cells.append(cell)
+    return " ".join(cells)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', default='10,100')
+    parser.add_argument('--rates', default='2,10')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--interval', type=float, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--compare', default=None)
+    parser.add_argument('--verbose', action='store_true')
+    # Internal: the bot process of a scenario
+    parser.add_argument('--bot', action='store_true')
+    parser.add_argument('--tmp', default=None)
+    args = parser.parse_args()
+
+    if args.bot:
+        return run_bot(args)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            for result in json.load(f)['scenarios']:
+                baseline[(result['users'], result['spawn_rate'])] = result
+
+    print(HEADER)
+    results = []
+    for users in [int(n) for n in args.users.split(',')]:
+        for rate in [float(r) for r in args.rates.split(',')]:
+            result = run_scenario(users, rate, args.duration, args.interval, args.seed, args.verbose)
+            results.append(result)
+            print(format_row(result, baseline.get((users, rate))))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'time': int(time.time()),
+                'duration': args.duration,
+                'interval': args.interval,
+                'scenarios': results,
+            }, f, indent=2)
+        print("Saved to {}".format(args.out))
+
+
+if __name__ == '__main__':
+    main()
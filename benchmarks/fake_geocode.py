@@ -0,0 +1,38 @@
+"""
+In-process fake of the Google geocode and plus.codes APIs. Every address
+resolves to a point in Singapore picked from a hash of it, so the same
+address always lands in the same place. Point the bot at it with
+
+    GOOGLE_GEOCODE_URL=http://127.0.0.1:<port>/maps/api/geocode/json
+    PLUS_CODES_URL=http://127.0.0.1:<port>/api
+"""
+import random
+
+from benchmarks.fakeserver import FakeServer
+from benchmarks.synthetic import random_latlon
+
+
+class FakeGeocode(FakeServer):
+
+    @property
+    def geocode_url(self):
+        return self.url + "/maps/api/geocode/json"
+
+    @property
+    def plus_codes_url(self):
+        return self.url + "/api"
+
+    def route(self, path, params):
+        if path.endswith('/geocode/json'):
+            address = params.get('address', '').replace('+', ' ')
+            lat, lng = random_latlon(random.Random(address))
+            return 200, {'status': 'OK', 'results': [{
+                'geometry': {'location': {'lat': lat, 'lng': lng}},
+                'formatted_address': "{}, Singapore".format(address.title()),
+            }]}
+        if path.endswith('/api'):
+            if 'encryptkey' in params:
+                return 200, {'key': 'fake-ekey'}
+            return 200, {'plus_code': {
+                'best_street_address': "Near {}, Singapore".format(params.get('address', ''))}}
+        return 404, {}
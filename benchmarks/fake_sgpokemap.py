@@ -0,0 +1,73 @@
+"""
+In-process fake of sgpokemap's query2.php, with synthetic spawns around
+Singapore appearing at rate per second from when it starts. Point the bot
+at it with
+
+    SGPOKEMAP_URL=http://127.0.0.1:<port>/query2.php
+
+Responses honour since and mons like the real feed and leave out despawned
+spawns. created maps each spawn's (lat, lng), as floats, to when it appeared,
+to time alerts from.
+"""
+import random
+import time
+
+from benchmarks.fakeserver import FakeServer
+from benchmarks.synthetic import random_latlon
+
+# Seconds a spawn stays up
+LIFETIME = (600, 1800)
+
+
+class FakeSgpokemap(FakeServer):
+
+    def __init__(self, rate=5.0, seed=0, pokemon_ids=None, port=0):
+        super(FakeSgpokemap, self).__init__(port)
+        self.rate = rate
+        self.rng = random.Random(seed)
+        self.pokemon_ids = list(pokemon_ids or range(1, 252))
+        # (inserted, record), in the order they appeared
+        self.spawns = []
+        self.created = {}
+        self.inserted = 0
+        self.started = time.time()
+        self.returned = 0
+
+    @property
+    def query_url(self):
+        return self.url + "/query2.php"
+
+    def advance(self, now):
+        # Adds the spawns due by now and drops despawned ones
+        due = int((now - self.started) * self.rate)
+        while self.inserted < due:
+            self.inserted += 1
+            created = self.started + self.inserted / float(self.rate)
+            lat, lng = random_latlon(self.rng)
+            record = {
+                'pokemon_id': str(self.rng.choice(self.pokemon_ids)),
+                'lat': "{:.6f}".format(lat),
+                'lng': "{:.6f}".format(lng),
+                'despawn': str(int(created + self.rng.randint(*LIFETIME))),
+                'attack': str(self.rng.randint(0, 15)),
+                'defence': str(self.rng.randint(0, 15)),
+                'stamina': str(self.rng.randint(0, 15)),
+            }
+            self.spawns.append((self.inserted, record))
+            self.created[(float(record['lat']), float(record['lng']))] = created
+        if self.spawns and int(self.spawns[0][1]['despawn']) <= now:
+            self.spawns = [(i, r) for i, r in self.spawns if int(r['despawn']) > now]
+
+    def route(self, path, params):
+        if not path.endswith('/query2.php'):
+            return 404, {}
+        now = time.time()
+        since = int(params.get('since') or 0)
+        mons = set(params.get('mons', '').split(','))
+        with self.lock:
+            self.advance(now)
+            pokemons = [record for inserted, record in self.spawns
+                        if inserted > since and record['pokemon_id'] in mons
+                        and int(record['despawn']) > now]
+            self.returned += len(pokemons)
+            return 200, {'pokemons': pokemons, 'meta': {'inserted': self.inserted}}
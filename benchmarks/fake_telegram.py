@@ -0,0 +1,162 @@
+"""
+In-process fake of the Telegram Bot API methods the bot uses, for runs on
+localhost. Point the bot at it with
+
+    TELE_POKEBACON_ENDPOINT=http://127.0.0.1:<port>/bot{}/
+
+say() queues an incoming message for getUpdates, and every sendMessage or
+sendLocation is recorded in sent as (chat_id, method, params), with the
+time it arrived in sent_at. Given a chat_rate or global_rate, sends beyond
+them get a 429 with a retry_after, like Telegram's flood limits, and are
+counted in throttled. bench_bot() gives a bot that sends to it as fast as
+it answers.
+"""
+from contextlib import contextmanager
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from benchmarks.fakeserver import FakeServer
+from outbox import TokenBucket
+
+# Messages Telegram lets through per chat in a burst, before its per-second rate
+CHAT_BURST = 3
+# Real chat ids are never 0, so fake chats are numbered from here
+FIRST_CHAT_ID = 1000
+
+
+class FakeTelegram(FakeServer):
+
+    def __init__(self, port=0, chat_rate=None, global_rate=None, chat_burst=CHAT_BURST):
+        super(FakeTelegram, self).__init__(port)
+        self.updates = []
+        self.sent = []
+        self.sent_at = []
+        self.webhook = None
+        self.next_update_id = 1
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.global_bucket = TokenBucket(global_rate, global_rate) if global_rate else None
+        self.throttled = 0
+        self.cond = threading.Condition()
+
+    @property
+    def endpoint(self):
+        return self.url + "/bot{}/"
+
+    def environ(self):
+        # What telegram reads from the environment at import, pointing it here
+        return {
+            'TELE_POKEBACON_ENDPOINT': self.endpoint,
+            'TELE_POKEBACON_USER': 'bench',
+            'TELE_POKEBACON_API': 'token',
+        }
+
+    def route(self, path, params):
+        method = path.rsplit('/', 1)[-1]
+        if method == 'getUpdates':
+            result = self.get_updates(params)
+        elif method in ('sendMessage', 'sendLocation'):
+            retry_after = self.flood_wait(int(params['chat_id']))
+            if retry_after:
+                return 429, {
+                    'ok': False, 'error_code': 429,
+                    'description': 'Too Many Requests: retry after {}'.format(retry_after),
+                    'parameters': {'retry_after': retry_after},
+                }
+            result = self.record(method, params)
+        elif method == 'setWebhook':
+            self.webhook = params
+            result = True
+        else:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+        return 200, {'ok': True, 'result': result}
+
+    def flood_wait(self, chat_id):
+        # Whole seconds to retry after if this send breaks a limit, else 0
+        now = time.time()
+        wait = 0
+        with self.cond:
+            if self.chat_rate:
+                bucket = self.chat_buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                wait = bucket.take(now)
+            if not wait and self.global_bucket is not None:
+                wait = self.global_bucket.take(now)
+            if wait:
+                self.throttled += 1
+        return int(math.ceil(wait))
+
+    def say(self, chat_id, text, first_name="user"):
+        with self.cond:
+            self.updates.append({
+                'update_id': self.next_update_id,
+                'message': {
+                    'message_id': self.next_update_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'first_name': first_name, 'type': 'private'},
+                    'text': text,
+                },
+            })
+            self.next_update_id += 1
+            self.cond.notify_all()
+
+    def get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        deadline = time.time() + float(params.get('timeout', 0))
+        with self.cond:
+            # Updates before the offset are confirmed and dropped
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return list(self.updates)
+
+    def record(self, method, params):
+        with self.cond:
+            self.sent.append((int(params['chat_id']), method, params))
+            self.sent_at.append(time.time())
+            self.cond.notify_all()
+        return {'message_id': len(self.sent), 'chat': {'id': int(params['chat_id'])}}
+
+    def wait_sent(self, count, timeout=30):
+        # Blocks until count messages were sent in total; returns whether they were
+        deadline = time.time() + timeout
+        with self.cond:
+            while len(self.sent) < count and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return len(self.sent) >= count
+
+    def replies(self, chat_id):
+        with self.cond:
+            return [params.get('text') for sent_to, _, params in self.sent if sent_to == chat_id]
+
+
+@contextmanager
+def bench_bot(db=None):
+    # A telegram.Bot with the flood and command limits lifted, on a sqlite store
+    # at db, or in a temp directory removed afterwards. Import telegram only
+    # once the environment points at the fake.
+    import telegram
+    from userstore import open_store
+
+    telegram.command_limit.rate = telegram.command_limit.burst = 1e6
+    telegram.outbox.set_global_rate(1e6)
+    telegram.outbox.set_chat_rate(1e6, 1e6)
+    telegram.outbox.workers = 16
+
+    tmp = None
+    if db is None:
+        tmp = tempfile.mkdtemp()
+        db = os.path.join(tmp, 'users.db')
+    store = open_store('sqlite:' + db)
+    try:
+        yield telegram.Bot(store)
+    finally:
+        store.close()
+        if tmp is not None:
+            shutil.rmtree(tmp)
@@ -0,0 +1,89 @@
+"""
+Base for the in-process fakes of the services the bot calls. Each fake is
+a threaded keep-alive HTTP server on localhost answering JSON from
+route(path, params); requests counts the calls it got.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+import json
+import sys
+import threading
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients going away, eg. a bot process that was stopped, are expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+
+class FakeServer(object):
+
+    def __init__(self, port=0):
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = Server(('127.0.0.1', port), self.handler())
+        self.port = self.server.server_address[1]
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.port)
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def route(self, path, params):
+        # Returns (status, body) for a request
+        raise NotImplementedError
+
+    def handle(self, path, params):
+        with self.lock:
+            self.requests += 1
+        return self.route(path, params)
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real services
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes; don't let the body
+            # wait on the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                self.reply(*fake.handle(url.path, dict(parse_qsl(url.query))))
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8')
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params.update(json.loads(body or '{}'))
+                else:
+                    params.update(parse_qsl(body))
+                self.reply(*fake.handle(url.path, params))
+
+            def reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,81 @@
+"""
+Parse time and memory of a since=0 query2.php response: json.loads of the
+whole body into dicts, against streaming it into Spawn records, with and
+without the species and bounding box prefilters of one /list.
+
+    python -m benchmarks.feedparse --spawns 50000
+
+Times are the best of a few runs; peak, the most memory held while
+parsing, and kept, what the result holds once parsing is done, come from
+a separate run under tracemalloc, which slows allocation down.
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import pokedex
+from benchmarks.synthetic import make_spawns
+from feedstream import CHUNK_SIZE, parse_feed, prefilter
+from spatial import circle_bbox
+
+# Centre of a /list, eg. city hall mrt
+LATLON = (1.2931, 103.8520)
+RADIUS = 2.0
+
+
+def parse_json(chunks, wanted, bbox):
+    # What fetch_pokemons does: the whole body, then every record as a dict
+    results = json.loads(b''.join(chunks).decode('utf-8'))
+    keep = prefilter(wanted, bbox)
+    return [record for record in results['pokemons'] if keep(record)]
+
+
+def parse_stream(chunks, wanted, bbox):
+    return parse_feed(chunks, prefilter(wanted, bbox))[0]
+
+
+def parse_stream_all(chunks, wanted, bbox):
+    return parse_feed(chunks)[0]
+
+
+def chunks_of(body):
+    # Sliced off as they are read, like a streamed response
+    return (body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE))
+
+
+def measure(parse, body, wanted, bbox, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        started = time.time()
+        parse(chunks_of(body), wanted, bbox)
+        timings.append(time.time() - started)
+
+    tracemalloc.start()
+    result = parse(chunks_of(body), wanted, bbox)
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(result), min(timings), peak, kept
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spawns', type=int, default=50000)
+    args = parser.parse_args()
+
+    spawns = make_spawns(args.spawns)
+    body = json.dumps({'pokemons': spawns, 'meta': {'inserted': 1}}).encode()
+    wanted = set(pokedex.want_ids())
+    bbox = circle_bbox(LATLON, RADIUS)
+    print("{} spawns, {:.1f} MB body".format(len(spawns), len(body) / 1e6))
+
+    for label, parse in [('json.loads dicts', parse_json),
+                         ('stream prefiltered', parse_stream),
+                         ('stream all', parse_stream_all)]:
+        count, secs, peak, kept = measure(parse, body, wanted, bbox)
+        print("{:<19}: {:6} spawns {:7.1f} ms  peak {:7.1f} MB  kept {:7.2f} MB".format(
+            label, count, secs * 1000, peak / 1e6, kept / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Resident memory of the bot as more and more of its registered users
+message it.
+
+    python -m benchmarks.memory --users 100000 --messages 50000
+
+Users are written to a sqlite store first, one in ten of them monitoring.
+Then messages from users picked at random go through the bot's update
+dispatch and handlers, with replies sent to a fake Telegram server. There are
+two runs, each in its own process: one drops idle users from memory as the bot
+does, and one keeps every user it has seen, as the bot used to. Each run
+reports RSS as the messages go by, once the replies so far have been sent.
+Also compares the size of a user as a User and as the dict it replaced.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fake_telegram import FIRST_CHAT_ID, FakeTelegram, bench_bot
+from benchmarks.store import make_user
+from userstore import dump_user, load_user, open_store
+
+# Updates dispatched at a time
+BATCH = 200
+CHECKPOINTS = 10
+
+
+def rss_mb():
+    # Current resident set size on Linux, else the peak
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def populate(path, users):
+    store = open_store('sqlite:' + path)
+    now = int(time.time())
+    for n in range(users):
+        store.put(FIRST_CHAT_ID + n, make_user(n, now))
+    store.close()
+
+
+def user_bytes(users):
+    # Bytes per user held as dicts and as User records, loaded from the same JSON
+    now = int(time.time())
+    dumps = [dump_user(make_user(n, now)) for n in range(users)]
+    sizes = []
+    for load in (json.loads, load_user):
+        tracemalloc.start()
+        loaded = [load(data) for data in dumps]
+        sizes.append(tracemalloc.get_traced_memory()[0] / float(users))
+        tracemalloc.stop()
+        del loaded
+    return sizes
+
+
+async def send_messages(bot, users, messages, seed=0):
+    import telegram
+
+    rng = random.Random(seed)
+    samples = []
+    every = max(1, messages // CHECKPOINTS)
+    for n in range(0, messages, BATCH):
+        updates = []
+        for update_id in range(n, min(n + BATCH, messages)):
+            text = "/settings" if update_id % 2 else "/setradius {}".format(1 + update_id % 3)
+            updates.append({'update_id': update_id, 'message': {
+                'chat': {'id': FIRST_CHAT_ID + rng.randrange(users), 'first_name': 'bench'},
+                'text': text}})
+        bot.dispatch(updates)
+        while bot.queues:
+            await asyncio.sleep(0.01)
+        done = n + len(updates)
+        if done % every < BATCH or done == messages:
+            while telegram.outbox.size():
+                await asyncio.sleep(0.05)
+            samples.append((done, round(rss_mb(), 1), len(bot.users)))
+    return samples
+
+
+def run_child(args):
+    import telegram
+
+    with bench_bot(args.db) as bot:
+        telegram.outbox.start()
+        bot.store.start()
+        if args.resident:
+            bot.users.maxsize = args.resident
+        samples = asyncio.run(send_messages(bot, args.users, args.messages))
+    with open(args.out, 'w') as f:
+        json.dump({'samples': samples, 'evicted': bot.users.evicted}, f)
+    # Outbox workers are parked on their queue
+    os._exit(0)
+
+
+def run(db, users, messages, fake, resident=None):
+    out = db + '.out'
+    cmd = [sys.executable, '-m', 'benchmarks.memory', '--child', '--db', db, '--out', out,
+           '--users', str(users), '--messages', str(messages)]
+    if resident:
+        cmd += ['--resident', str(resident)]
+    env = dict(os.environ)
+    env.update(fake.environ())
+    subprocess.check_call(cmd, env=env, stdout=subprocess.DEVNULL)
+    with open(out) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--messages', type=int, default=50000)
+    # Internal: one run, in its own process
+    parser.add_argument('--child', action='store_true')
+    parser.add_argument('--db', default=None)
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--resident', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.child:
+        return run_child(args)
+
+    as_dict, as_user = user_bytes(min(args.users, 10000))
+    print("bytes per user: {:.0f} as a dict, {:.0f} as a User".format(as_dict, as_user))
+
+    tmp = tempfile.mkdtemp()
+    fake = FakeTelegram().start()
+    try:
+        start = time.time()
+        db = os.path.join(tmp, 'users.db')
+        populate(db, args.users)
+        print("{} registered users written in {:.1f} s".format(args.users, time.time() - start))
+        runs = []
+        for resident in (None, args.users * 2):
+            # Each run starts from the same store
+            copy = os.path.join(tmp, 'run{}.db'.format(len(runs)))
+            shutil.copy(db, copy)
+            runs.append(run(copy, args.users, args.messages, fake, resident))
+    finally:
+        fake.stop()
+        shutil.rmtree(tmp)
+
+    print("messages   evicting: RSS MB  in memory   keeping all: RSS MB  in memory")
+    for (done, rss, held), (_, all_rss, all_held) in zip(runs[0]['samples'], runs[1]['samples']):
+        print("{:>8}   {:>17}  {:>9}   {:>20}  {:>9}".format(done, rss, held, all_rss, all_held))
+    print("{} users evicted".format(runs[0]['evicted']))
+
+
+if __name__ == '__main__':
+    main()
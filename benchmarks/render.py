@@ -0,0 +1,110 @@
+"""
+Rendering the alerts of one monitor pass: formatting every match per user
+with describe_pokemon and sending a message and location per pokemon,
+against a Card per spawn shared by every user it matches and one merged
+message per chat.
+
+    python -m benchmarks.render --spawns 2000 --users 5000
+
+Users are packed into the city centre, so each spawn there matches many
+of them, as happens with a popular spawn.
+"""
+import argparse
+import random
+import time
+
+from benchmarks.synthetic import make_spawns
+from pokemap import describe_pokemon, filter_iv_and_sort, get_latlong
+from render import Renderer, alert_html, alert_text
+from spatial import UserGrid
+
+# Alerts per chat per pass, like send_pokemons
+NEAREST = 10
+CENTRE = (1.2931, 103.8520)
+
+
+def make_central_users(count, seed=1):
+    rng = random.Random(seed)
+    return dict((chat_id, {
+        'loc': (CENTRE[0] + rng.uniform(-0.03, 0.03), CENTRE[1] + rng.uniform(-0.03, 0.03)),
+        'radius': rng.choice([1.0, 2.0, 3.0]),
+    }) for chat_id in range(count))
+
+
+def matched_pairs(users, spawns):
+    grid = UserGrid()
+    for chat_id, user in users.items():
+        grid.add(chat_id, user['loc'], user['radius'])
+    pairs = []
+    for pokemon in spawns:
+        for chat_id, km in grid.match(get_latlong(pokemon)):
+            pairs.append((chat_id, pokemon, km))
+    return pairs
+
+
+def render_per_user(pairs):
+    # Returns the (method, params) calls sent
+    within_radius = {}
+    for chat_id, pokemon, km in pairs:
+        within_radius.setdefault(chat_id, []).append(describe_pokemon(pokemon, km))
+    calls = []
+    for chat_id, pokemons in within_radius.items():
+        for counter, pk in enumerate(filter_iv_and_sort(pokemons)[:NEAREST], 1):
+            message = "{0:<2} {1}\n".format(counter, pk["name"].upper())
+            message += "Distance    : {0:<3.2f} km\n".format(pk["km_from_location"])
+            message += "IV percent  : {0:<3} %\n".format(pk["iv"])
+            message += "Despawn in : {}\n\n".format(pk["time_left_secs"])
+            calls.append(('sendMessage', [('text', message), ('chat_id', chat_id)]))
+            calls.append(('sendLocation', [('latitude', pk['lat']), ('longitude', pk['lng']),
+                                           ('chat_id', chat_id)]))
+    return calls
+
+
+def render_cards(pairs, merge=True):
+    renderer = Renderer()
+    within_radius = {}
+    for chat_id, pokemon, km in pairs:
+        within_radius.setdefault(chat_id, []).append(renderer.match(pokemon, km))
+    calls = []
+    for chat_id, pokemons in within_radius.items():
+        pokemons = filter_iv_and_sort(pokemons)[:NEAREST]
+        if merge:
+            calls.append(('sendMessage', [('text', alert_html(pokemons)), ('parse_mode', 'HTML'),
+                                          ('disable_web_page_preview', 'true'), ('chat_id', chat_id)]))
+            continue
+        for counter, pk in enumerate(pokemons, 1):
+            calls.append(('sendMessage', [('text', alert_text(counter, pk)), ('chat_id', chat_id)]))
+            calls.append(('sendLocation', [('latitude', pk['lat']), ('longitude', pk['lng']),
+                                           ('chat_id', chat_id)]))
+    return calls
+
+
+def payload_bytes(calls):
+    return sum(len(method) + sum(len(str(k)) + len(str(v)) + 2 for k, v in params)
+               for method, params in calls)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spawns', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=5000)
+    args = parser.parse_args()
+
+    spawns = make_spawns(args.spawns)
+    for seq, pokemon in enumerate(spawns, 1):
+        pokemon['seq'] = seq
+    pairs = matched_pairs(make_central_users(args.users), spawns)
+    print("{} spawns x {} users, {} matches".format(len(spawns), args.users, len(pairs)))
+
+    for label, render in [('per user, per pokemon', render_per_user),
+                          ('cards, per pokemon', lambda p: render_cards(p, merge=False)),
+                          ('cards, merged', render_cards)]:
+        start = time.time()
+        calls = render(pairs)
+        secs = time.time() - start
+        print("{:<22}: {:8.1f} ms  {:7} calls  {:8.1f} KB".format(
+            label, secs * 1000, len(calls), payload_bytes(calls) / 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Replays a spawn history through the bot's matching and alerting, faster
+than real time, against a fake Telegram server, and times a top cells
+query on it.
+
+    python -m benchmarks.replay --synthesize /tmp/history.bin --batches 1000
+    python -m benchmarks.replay --history /tmp/history.bin --users 1000 --speed 0
+
+--synthesize writes a week of made-up batches to replay; a history
+recorded by the bot with TELE_POKEBACON_HISTORY works the same. --speed
+is how many times faster than recorded to go, 0 for as fast as possible.
+Spawns live for their recorded time divided by the speed, or by
+LIFETIME_SPEED when going as fast as possible, so about as many are up
+per batch as when recorded. Flood limits are lifted, so this measures the
+bot rather than Telegram's.
+"""
+import argparse
+import os
+import time
+import tracemalloc
+
+from benchmarks.fake_telegram import FIRST_CHAT_ID, FakeTelegram, bench_bot
+from benchmarks.synthetic import make_spawns, make_users
+from benchmarks.webhook import percentile
+from history import History, HistoryRecorder
+import pokedex
+
+WEEK = 7 * 86400
+# Speed spawn lifetimes are scaled by when replaying as fast as possible
+LIFETIME_SPEED = 1000
+
+
+def synthesize(path, batches, per_batch, seed=0):
+    # Batches evenly spread over the week before now
+    recorder = HistoryRecorder(path)
+    started = time.time() - WEEK
+    now = int(time.time())
+    for n in range(batches):
+        seen = started + n * WEEK / float(batches)
+        spawns = make_spawns(per_batch, seed=seed + n, pokemon_ids=pokedex.want_ids())
+        for spawn in spawns:
+            spawn['despawn'] = str(int(spawn['despawn']) - now + int(seen))
+        recorder.append(spawns, n + 1, seen)
+    recorder.close()
+
+
+def replay(history, users, speed):
+    import telegram
+
+    with bench_bot() as bot:
+        telegram.outbox.start()
+        now = time.time()
+        for chat_id, user in users.items():
+            chat_id += FIRST_CHAT_ID
+            user['monitor'] = int(now + WEEK)
+            bot.schedule.watch(chat_id, user, now)
+            bot.users[chat_id] = user
+
+        pass_secs = []
+        matched = 0
+        previous = None
+        started = time.time()
+        for seen, spawns, inserted in history.replay(speed=speed or LIFETIME_SPEED):
+            if speed and previous is not None:
+                time.sleep((seen - previous) / speed)
+            previous = seen
+            begun = time.time()
+            telegram.feed.ingest(spawns, inserted)
+            matches = bot.monitor_pass(False)
+            for chat_id, pokemons in matches.items():
+                if pokemons:
+                    matched += len(pokemons)
+                    telegram.send_pokemons(chat_id, pokemons, True)
+            pass_secs.append(time.time() - begun)
+        elapsed = time.time() - started
+        queued = telegram.outbox.size()
+    return elapsed, pass_secs, matched, queued
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--history', default=None)
+    parser.add_argument('--synthesize', default=None)
+    parser.add_argument('--batches', type=int, default=1000)
+    parser.add_argument('--per-batch', type=int, default=30)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--speed', type=float, default=0)
+    parser.add_argument('--species', default='dragonite')
+    args = parser.parse_args()
+
+    path = args.history
+    if args.synthesize:
+        start = time.time()
+        synthesize(args.synthesize, args.batches, args.per_batch)
+        path = args.synthesize
+        print("wrote {} batches of {} spawns in {:.1f} s, {:.1f} MB".format(
+            args.batches, args.per_batch, time.time() - start, os.path.getsize(path) / 1e6))
+    if path is None:
+        parser.error("give --history or --synthesize")
+
+    history = History(path)
+    batches = history.batches()
+    recorded = batches[-1][0] - batches[0][0] if batches else 0
+
+    pokemon_id = pokedex.lookup(args.species)
+    tracemalloc.start()
+    start = time.time()
+    top = history.top_cells(pokemon_id, time.time() - WEEK)
+    query_secs = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("top {} cells over {} spawns: {:.1f} ms, peak {:.1f} MB, busiest {} with {}".format(
+        args.species, len(history), query_secs * 1000, peak / 1e6,
+        top[0][0] if top else None, top[0][1] if top else 0))
+
+    fake = FakeTelegram().start()
+    os.environ.update(fake.environ())
+
+    elapsed, pass_secs, matched, queued = replay(history, make_users(args.users), args.speed)
+    history.close()
+    print("replayed {} batches, {:.1f} h recorded, in {:.1f} s: {:.0f}x real time".format(
+        len(batches), recorded / 3600.0, elapsed, recorded / elapsed if elapsed else 0))
+    print("{} users, {} alerts, {} messages sent and {} still queued; pass p50 {:.2f} ms p99 {:.2f} ms".format(
+        args.users, matched, len(fake.sent), queued, percentile(pass_secs, 50) * 1000,
+        percentile(pass_secs, 99) * 1000))
+    fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+End-to-end run of the sharded worker mode against a fake Telegram server.
+
+    python -m benchmarks.sharding --shards 2 --users 60
+
+Every user sets a radius, the coordinator rebalances to one more shard,
+and every user then asks for /settings: each chat must get exactly one
+reply per message, and its radius must survive the move to a new owner.
+Sends are held to Telegram's flood limits, so this checks correctness and
+rebalance time rather than raw throughput.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from benchmarks.fake_telegram import FIRST_CHAT_ID, FakeTelegram
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', type=int, default=2)
+    parser.add_argument('--users', type=int, default=60)
+    args = parser.parse_args()
+
+    fake = FakeTelegram().start()
+    # Inherited by the spawned workers
+    os.environ.update(fake.environ())
+    from sharding import Coordinator, shard_of
+
+    tmp = tempfile.mkdtemp()
+    coordinator = Coordinator(args.shards, 'sqlite:' + os.path.join(tmp, 'users.db'))
+    # No upstream here, so only the Telegram side runs
+    poller = threading.Thread(target=asyncio.run, args=(coordinator.poll(),))
+    poller.daemon = True
+    poller.start()
+    chat_ids = list(range(FIRST_CHAT_ID, FIRST_CHAT_ID + args.users))
+
+    try:
+        start = time.time()
+        for chat_id in chat_ids:
+            fake.say(chat_id, "/start")
+        assert fake.wait_sent(len(chat_ids), timeout=60), "missing greetings"
+        for chat_id in chat_ids:
+            fake.say(chat_id, "/setradius 2")
+        assert fake.wait_sent(2 * len(chat_ids), timeout=60), "missing radius replies"
+        print("{} shards: {} messages in {:.2f} s".format(
+            args.shards, 2 * len(chat_ids), time.time() - start))
+
+        start = time.time()
+        coordinator.rebalance(args.shards + 1)
+        moved = sum(1 for chat_id in chat_ids
+                    if shard_of(chat_id, args.shards) != shard_of(chat_id, args.shards + 1))
+        print("rebalance to {} shards, {} of {} users moved: {:.2f} s".format(
+            args.shards + 1, moved, len(chat_ids), time.time() - start))
+
+        for chat_id in chat_ids:
+            fake.say(chat_id, "/settings")
+        assert fake.wait_sent(3 * len(chat_ids), timeout=60), "missing settings replies"
+        time.sleep(0.5)
+        for chat_id in chat_ids:
+            replies = fake.replies(chat_id)
+            assert len(replies) == 3, "chat {} got {} replies".format(chat_id, len(replies))
+            assert "Radius    : 2.0 km" in replies[-1], "chat {} lost its radius".format(chat_id)
+        print("all {} chats answered once per message, settings kept".format(len(chat_ids)))
+    finally:
+        coordinator.stop()
+        fake.stop()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Spawn-to-user matching: per-pair haversine vs the UserGrid index.
+
+    python -m benchmarks.spatial --spawns 10000 --users 5000
+
+The per-pair baseline is timed on a sample of spawns and extrapolated, as
+the full cross product takes minutes in pure Python.
+"""
+import argparse
+import time
+
+from pokemap import get_latlong, haversine
+from spatial import UserGrid
+from benchmarks.synthetic import make_spawns, make_users
+
+
+def match_naive(users, spawns):
+    matched = set()
+    for i, pokemon in enumerate(spawns):
+        poke_latlon = get_latlong(pokemon)
+        for chat_id, user in users.items():
+            if haversine(user['loc'], poke_latlon) < user['radius']:
+                matched.add((i, chat_id))
+    return matched
+
+
+def match_grid(users, spawns):
+    grid = UserGrid()
+    for chat_id, user in users.items():
+        grid.add(chat_id, user['loc'], user['radius'])
+    matched = set()
+    for i, pokemon in enumerate(spawns):
+        for chat_id, _ in grid.match(get_latlong(pokemon)):
+            matched.add((i, chat_id))
+    return matched
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spawns', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--naive-sample', type=int, default=200)
+    args = parser.parse_args()
+
+    spawns = make_spawns(args.spawns)
+    users = make_users(args.users)
+
+    start = time.time()
+    grid_matched = match_grid(users, spawns)
+    grid_secs = time.time() - start
+
+    sample = spawns[:args.naive_sample]
+    start = time.time()
+    naive_matched = match_naive(users, sample)
+    naive_secs = (time.time() - start) * len(spawns) / float(len(sample))
+
+    sample_grid = set(m for m in grid_matched if m[0] < len(sample))
+    assert sample_grid == naive_matched, "grid and per-pair matches differ"
+
+    print("{} spawns x {} users, {} matches".format(len(spawns), len(users), len(grid_matched)))
+    print("per-pair haversine : {:8.2f} s (extrapolated)".format(naive_secs))
+    print("grid index         : {:8.2f} s".format(grid_secs))
+    print("speedup            : {:8.1f}x".format(naive_secs / grid_secs))
+
+
+if __name__ == '__main__':
+    main()
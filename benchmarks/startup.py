@@ -0,0 +1,53 @@
+"""
+Import and first-lookup times for pokemap and pokedex.
+
+    python -m benchmarks.startup
+
+Imports run in fresh interpreters with the bot's secrets unset, so this
+also checks that importing pokemap needs no environment.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SNIPPETS = [
+    ('import pokedex', 'import pokedex'),
+    ('import pokemap', 'import pokemap'),
+    ('first pokedex lookup', 'import pokedex; pokedex.lookup("dragonite")'),
+    ('fuzzy pokedex lookup', 'import pokedex; pokedex.lookup("dragonight")'),
+]
+
+
+def run(snippet, repeat):
+    env = dict(os.environ)
+    for key in ['GOOGLE_GEOCODE_API', 'TELE_POKEBACON_USER', 'TELE_POKEBACON_API']:
+        env.pop(key, None)
+    # Time only the snippet, not interpreter startup
+    code = 'import time; t = time.time(); {}; print(time.time() - t)'.format(snippet)
+    timings = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', code], env=env)
+        timings.append(float(out))
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for label, snippet in SNIPPETS:
+        print("{:<22}: {:8.2f} ms".format(label, run(snippet, args.repeat) * 1000))
+
+    import pokedex
+    pokedex.ids()
+    start = time.time()
+    for _ in range(100000):
+        pokedex.lookup("Mr. Mime")
+    print("{:<22}: {:8.2f} us".format("warm lookup", (time.time() - start) * 10))
+
+
+if __name__ == '__main__':
+    main()
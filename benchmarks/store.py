@@ -0,0 +1,113 @@
+"""
+User store write throughput, startup time and kill -9 recovery.
+
+    python -m benchmarks.store --users 100000
+
+For each backend a child process writes users in batches and is killed
+with SIGKILL mid-stream; every batch it reported as flushed must be intact
+when the store is reopened.
+"""
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from userstore import open_store
+
+BATCH = 1000
+
+
+def make_user(chat_id, now):
+    return {
+        'loc': (1.3 + chat_id % 100 / 1000.0, 103.8),
+        'radius': 2.0,
+        'address': 'Block {} Singapore'.format(chat_id),
+        # one in ten users has an active monitor
+        'monitor': now + 3600 if chat_id % 10 == 0 else None,
+        'since': chat_id,
+    }
+
+
+def child(url, users):
+    store = open_store(url)
+    now = int(time.time())
+    for start in range(0, users, BATCH):
+        for chat_id in range(start, min(start + BATCH, users)):
+            store.put(chat_id, make_user(chat_id, now))
+        store.flush()
+        print(start + BATCH)
+        sys.stdout.flush()
+    # Keep writing unflushed updates until killed
+    while True:
+        store.put(0, make_user(0, now))
+
+
+def check_recovery(url, users):
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.store', '--child', url, '--users', str(users)],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    flushed = 0
+    for line in proc.stdout:
+        flushed = int(line)
+        if flushed >= users // 2:
+            break
+    os.kill(proc.pid, signal.SIGKILL)
+    proc.wait()
+
+    store = open_store(url)
+    for chat_id in range(flushed):
+        user = store.get(chat_id)
+        assert user is not None and user['since'] == chat_id, "lost user {}".format(chat_id)
+    store.close()
+    return flushed
+
+
+def bench(url, users):
+    store = open_store(url)
+    now = int(time.time())
+    start = time.time()
+    for chat_id in range(users):
+        store.put(chat_id, make_user(chat_id, now))
+        if chat_id % BATCH == 0:
+            store.flush()
+    store.close()
+    write_secs = time.time() - start
+
+    start = time.time()
+    store = open_store(url)
+    active = store.load_active(now)
+    startup_secs = time.time() - start
+    store.close()
+    return write_secs, startup_secs, len(active)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--child', default=None)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child, args.users)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for kind in ['sqlite', 'log']:
+            url = '{}:{}'.format(kind, os.path.join(tmp, 'bench-' + kind))
+            write_secs, startup_secs, active = bench(url, args.users)
+            print("{:<6} write {} users: {:6.2f} s, startup with {} active monitors: {:6.3f} s".format(
+                kind, args.users, write_secs, active, startup_secs))
+
+            url = '{}:{}'.format(kind, os.path.join(tmp, 'crash-' + kind))
+            flushed = check_recovery(url, args.users)
+            print("{:<6} kill -9 after {} flushed users: all recovered".format(kind, flushed))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
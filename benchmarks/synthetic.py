@@ -0,0 +1,41 @@
+import random
+import time
+
+# Rough bounding box of Singapore
+SG_LAT = (1.24, 1.46)
+SG_LNG = (103.62, 104.02)
+
+
+def random_latlon(rng):
+    return rng.uniform(*SG_LAT), rng.uniform(*SG_LNG)
+
+
+def make_spawns(count, seed=0, pokemon_ids=None):
+    rng = random.Random(seed)
+    now = int(time.time())
+    pokemon_ids = pokemon_ids or range(1, 252)
+    pokemon_ids = list(pokemon_ids)
+    spawns = []
+    for _ in range(count):
+        lat, lng = random_latlon(rng)
+        spawns.append({
+            'pokemon_id': str(rng.choice(pokemon_ids)),
+            'lat': "{:.6f}".format(lat),
+            'lng': "{:.6f}".format(lng),
+            'despawn': str(now + rng.randint(60, 1800)),
+            'attack': str(rng.randint(0, 15)),
+            'defence': str(rng.randint(0, 15)),
+            'stamina': str(rng.randint(0, 15)),
+        })
+    return spawns
+
+
+def make_users(count, seed=1):
+    rng = random.Random(seed)
+    users = {}
+    for chat_id in range(count):
+        users[chat_id] = {
+            'loc': random_latlon(rng),
+            'radius': rng.choice([0.5, 1.0, 2.0, 3.0, 5.0]),
+        }
+    return users
@@ -0,0 +1,73 @@
+"""
+Pure-Python vs NumPy radius/IV filtering of one feed batch.
+
+    python -m benchmarks.vectorized --spawns 20000
+
+Also checks that all paths return the same pokemons in the same order.
+"""
+import argparse
+import time
+
+from pokemap import filter_pokemons_py, filter_pokemons_np, spawn_columns
+from benchmarks.synthetic import make_spawns
+
+KEYS = ['pokemon_id', 'lat', 'lng', 'name', 'iv']
+
+
+def seconds_left(time_left_secs):
+    minutes, _, seconds, _ = time_left_secs.split()
+    return int(minutes) * 60 + int(seconds)
+
+
+def check_equivalent(py_result, np_result):
+    assert len(py_result) == len(np_result), "{} != {} pokemons".format(
+        len(py_result), len(np_result))
+    for py_pk, np_pk in zip(py_result, np_result):
+        for key in KEYS:
+            assert py_pk[key] == np_pk[key], "{}: {!r} != {!r}".format(
+                key, py_pk[key], np_pk[key])
+        assert abs(py_pk['km_from_location'] - np_pk['km_from_location']) < 1e-9
+        # The clock moves on between runs
+        assert abs(seconds_left(py_pk['time_left_secs']) - seconds_left(np_pk['time_left_secs'])) <= 2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spawns', type=int, default=20000)
+    parser.add_argument('--radius', type=float, default=5.0)
+    parser.add_argument('--iv', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    spawns = make_spawns(args.spawns)
+    geocode_latlon = (1.3521, 103.8198)
+
+    timings = {}
+    results = {}
+    for name, fn in [('python', filter_pokemons_py), ('numpy', filter_pokemons_np)]:
+        start = time.time()
+        for _ in range(args.repeat):
+            results[name] = fn(spawns, geocode_latlon, args.radius, args.iv)
+        timings[name] = (time.time() - start) / args.repeat
+
+    # Columns loaded once per batch and shared by every user's filter, as SpawnFeed does
+    columns = spawn_columns(spawns)
+    start = time.time()
+    for _ in range(args.repeat):
+        results['shared'] = filter_pokemons_np(
+            spawns, geocode_latlon, args.radius, args.iv, columns=columns)
+    timings['shared'] = (time.time() - start) / args.repeat
+
+    check_equivalent(results['python'], results['numpy'])
+    check_equivalent(results['python'], results['shared'])
+
+    print("{} spawns, {} within {} km".format(len(spawns), len(results['numpy']), args.radius))
+    print("python : {:8.2f} ms".format(timings['python'] * 1000))
+    print("numpy  : {:8.2f} ms".format(timings['numpy'] * 1000))
+    print("numpy, shared columns: {:8.2f} ms per user".format(timings['shared'] * 1000))
+    print("speedup: {:8.1f}x ({:.1f}x with shared columns)".format(
+        timings['python'] / timings['numpy'], timings['python'] / timings['shared']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Webhook ingestion throughput and latency against a fake Telegram server.
+
+    python -m benchmarks.webhook --updates 5000 --connections 32
+    python -m benchmarks.webhook --write updates.jsonl
+    python -m benchmarks.webhook --fixtures updates.jsonl
+
+Replays Telegram updates, one JSON object per line, as fast as the given
+number of keep-alive connections allow, with a share of them redelivered.
+Reports acks per second, ack latency, and the latency until each reply
+reaches the fake server. Flood limits are lifted, so this measures the
+bot rather than Telegram's rate limits.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from benchmarks.fake_telegram import FIRST_CHAT_ID, FakeTelegram, bench_bot
+
+SECRET = "bench-secret"
+COMMANDS = ["/help", "/more", "/settings", "/stop", "/include"]
+
+
+def make_updates(count, users, seed=0):
+    rng = random.Random(seed)
+    updates = []
+    for update_id in range(1, count + 1):
+        chat_id = FIRST_CHAT_ID + rng.randrange(users)
+        updates.append({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'first_name': 'user', 'type': 'private'},
+                'text': rng.choice(COMMANDS),
+            },
+        })
+    return updates
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+async def post_all(port, path, bodies, acks):
+    # Sends each body in turn over one keep-alive connection
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for update_id, body in bodies:
+        started = time.time()
+        writer.write((
+            "POST {} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+            "X-Telegram-Bot-Api-Secret-Token: {}\r\nContent-Length: {}\r\n\r\n").format(
+                path, SECRET, len(body)).encode() + body)
+        await writer.drain()
+        status = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b""):
+            pass
+        assert status.split()[1] == b"200", status
+        acks.append((update_id, started, time.time()))
+    writer.close()
+
+
+async def replay(updates, connections, redeliver):
+    from webhook import WebhookServer
+
+    with bench_bot() as bot:
+        server = WebhookServer(SECRET, host='127.0.0.1', port=0)
+        runner = asyncio.ensure_future(bot.run(server))
+        while server.server is None:
+            await asyncio.sleep(0.01)
+
+        bodies = [(u['update_id'], json.dumps(u).encode()) for u in updates]
+        # Telegram redelivers updates it got no answer for
+        rng = random.Random(1)
+        bodies += rng.sample(bodies, int(len(bodies) * redeliver))
+        acks = []
+        started = time.time()
+        await asyncio.gather(*[
+            post_all(server.port, server.path, bodies[n::connections], acks)
+            for n in range(connections)])
+        elapsed = time.time() - started
+
+        runner.cancel()
+        server.close()
+    return server, acks, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--connections', type=int, default=32)
+    parser.add_argument('--redeliver', type=float, default=0.05)
+    parser.add_argument('--fixtures', default=None)
+    parser.add_argument('--write', default=None)
+    args = parser.parse_args()
+
+    if args.fixtures:
+        with open(args.fixtures) as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = make_updates(args.updates, args.users)
+    if args.write:
+        with open(args.write, 'w') as f:
+            for update in updates:
+                f.write(json.dumps(update) + '\n')
+        return
+
+    fake = FakeTelegram().start()
+    os.environ.update(fake.environ())
+
+    server, acks, elapsed = asyncio.run(replay(updates, args.connections, args.redeliver))
+    # Each update gets exactly one reply, in order per chat
+    assert fake.wait_sent(len(updates), timeout=120), "missing replies"
+    time.sleep(0.5)
+    assert len(fake.sent) == len(updates), "{} replies to {} updates".format(len(fake.sent), len(updates))
+
+    first_ack = {}
+    for update_id, started, acked in acks:
+        first_ack.setdefault(update_id, (started, acked))
+    ack_ms = [(acked - started) * 1000 for _, started, acked in acks]
+    replies = {}
+    for (chat_id, _, _), sent_at in zip(fake.sent, fake.sent_at):
+        replies.setdefault(chat_id, []).append(sent_at)
+    posted = {}
+    for update in sorted(updates, key=lambda u: first_ack[u['update_id']][0]):
+        posted.setdefault(update['message']['chat']['id'], []).append(first_ack[update['update_id']][0])
+    reply_ms = []
+    for chat_id, times in posted.items():
+        reply_ms += [(sent - post) * 1000 for post, sent in zip(times, replies[chat_id])]
+
+    print("{} updates + {} redelivered over {} connections: {:.0f} acks/s".format(
+        len(updates), server.duplicates, args.connections, len(acks) / elapsed))
+    print("ack   latency p50 {:7.2f} ms  p99 {:7.2f} ms".format(
+        percentile(ack_ms, 50), percentile(ack_ms, 99)))
+    print("reply latency p50 {:7.2f} ms  p99 {:7.2f} ms".format(
+        percentile(reply_ms, 50), percentile(reply_ms, 99)))
+    fake.stop()
+
+
+if __name__ == '__main__':
+    main()
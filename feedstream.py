@@ -0,0 +1,220 @@
+"""
+Incremental parsing of the sgpokemap query2.php response. The pokemons
+array is decoded one record at a time as the body streams in, and only
+records passing the prefilter are kept, as compact Spawn records.
+"""
+import codecs
+import json
+import re
+
+# Bytes read from the response at a time
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+SEPARATORS = re.compile(r'[ \t\n\r,]*')
+
+decoder = json.JSONDecoder()
+# The C scanner under raw_decode, without its per-call overhead
+scan_once = decoder.scan_once
+
+
+class Spawn(object):
+    """
+    One spawn, with numeric fields parsed once. Reads like the feed's dicts
+    (spawn['lat'], spawn.get('encounter_id'), dict(spawn)), so the filters
+    take either.
+    """
+    __slots__ = ('pokemon_id', 'lat', 'lng', 'despawn', 'attack', 'defence', 'stamina',
+                 'encounter_id', 'inserted', 'seq')
+
+    def __init__(self, pokemon_id, lat, lng, despawn, attack, defence, stamina,
+                 encounter_id=None, inserted=None, seq=None):
+        self.pokemon_id = pokemon_id
+        self.lat = lat
+        self.lng = lng
+        self.despawn = despawn
+        self.attack = attack
+        self.defence = defence
+        self.stamina = stamina
+        self.encounter_id = encounter_id
+        self.inserted = inserted
+        self.seq = seq
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            int(record['pokemon_id']), float(record['lat']), float(record['lng']),
+            int(record['despawn']), int(record['attack']), int(record['defence']),
+            int(record['stamina']), record.get('encounter_id') or None)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def __getstate__(self):
+        return tuple(getattr(self, key) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        for key, value in zip(self.__slots__, state):
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return "Spawn({})".format(", ".join(
+            "{}={!r}".format(key, getattr(self, key)) for key in self.__slots__))
+
+
+class TextStream(object):
+    """
+    Decoded text over an iterator of byte chunks, keeping only what has
+    not been consumed yet.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decode = codecs.getincrementaldecoder('utf-8')().decode
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # Reads another chunk; False at the end of the body
+        if self.eof:
+            return False
+        if self.pos > CHUNK_SIZE:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buf += self.decode(chunk)
+                return True
+        self.buf += self.decode(b'', True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        # Next non-whitespace character, or '' at the end
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("expected {!r} at offset {}".format(char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        # Decodes the next JSON value, reading more of the body as needed
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            # A number may go on in the next chunk
+            if end == len(self.buf) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def batches(self):
+        # Yields lists of the values of the array just opened, as many as
+        # each read of the body completes, up to its closing ']'
+        skip = SEPARATORS.match
+        while True:
+            buf = self.buf
+            pos = skip(buf, self.pos).end()
+            values = []
+            # Fast path: every record up to the last '}' read in one call. A cut
+            # inside a string or a nested object fails to parse, rather than
+            # parsing differently, and falls back to a record at a time.
+            last = buf.rfind('}', pos)
+            if buf.startswith('{', pos) and last > 0:
+                try:
+                    values = json.loads('[' + buf[pos:last + 1] + ']')
+                    pos = skip(buf, last + 1).end()
+                except ValueError:
+                    pass
+            while pos < len(buf) and buf[pos] != ']':
+                try:
+                    value, end = scan_once(buf, pos)
+                except (StopIteration, ValueError):
+                    # Cut off by the end of the buffer
+                    break
+                # Only objects and arrays are known to be complete at the buffer end
+                if end == len(buf) and buf[end - 1] not in '}]"' and not self.eof:
+                    break
+                values.append(value)
+                pos = skip(buf, end).end()
+            self.pos = pos
+            yield values
+            if pos < len(buf) and buf[pos] == ']':
+                self.pos += 1
+                return
+            if not self.fill():
+                raise ValueError("unterminated array at offset {}".format(self.pos))
+
+
+def parse_feed(chunks, keep=None):
+    """
+    Parses a query2.php body from byte chunks. Returns the Spawns whose
+    record passes keep(record), the other top-level fields, eg. meta, and
+    how many records were read.
+    """
+    stream = TextStream(chunks)
+    spawns = []
+    fields = {}
+    scanned = 0
+    stream.expect('{')
+    while stream.peek() != '}':
+        if stream.peek() == ',':
+            stream.pos += 1
+            continue
+        key = stream.value()
+        stream.expect(':')
+        if key != 'pokemons':
+            fields[key] = stream.value()
+            continue
+        stream.expect('[')
+        for records in stream.batches():
+            scanned += len(records)
+            if keep is not None:
+                records = filter(keep, records)
+            spawns.extend(map(Spawn.from_record, records))
+    return spawns, fields, scanned
+
+
+def prefilter(wanted=None, bbox=None):
+    # keep() for parse_feed: species in wanted, a set of pokedex ids, and
+    # position within bbox, (min_lat, min_lng, max_lat, max_lng)
+    if wanted is not None:
+        # The feed has ids as strings; match either form without parsing
+        wanted = set(wanted) | set(str(pokemon_id) for pokemon_id in wanted)
+
+    def keep(record):
+        if wanted is not None and record['pokemon_id'] not in wanted:
+            return False
+        if bbox is not None:
+            lat, lng = float(record['lat']), float(record['lng'])
+            if not (bbox[0] <= lat <= bbox[2] and bbox[1] <= lng <= bbox[3]):
+                return False
+        return True
+    return keep
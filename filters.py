@@ -0,0 +1,73 @@
+from functools import lru_cache
+
+import pokedex
+
+
+@lru_cache(maxsize=None)
+def default_mask():
+    # Bit i of a species mask is set when pokedex id i is wanted
+    mask = 0
+    for pokemon_id in pokedex.want_ids():
+        mask |= 1 << pokemon_id
+    return mask
+
+
+def user_mask(user):
+    # want.txt, plus the user's /include list, minus their /exclude list
+    return (default_mask() | user.get("include", 0)) & ~user.get("exclude", 0)
+
+
+def mask_ids(mask):
+    ids = []
+    pokemon_id = 0
+    while mask:
+        if mask & 1:
+            ids.append(pokemon_id)
+        mask >>= 1
+        pokemon_id += 1
+    return ids
+
+
+class SpeciesIndex(object):
+    """
+    Inverted index from pokedex id to the users who want that species, kept
+    in sync with each user's mask so only changed bits are touched.
+    """
+
+    def __init__(self):
+        self.masks = {}
+        self.users = {}
+
+    def set(self, chat_id, mask):
+        old = self.masks.get(chat_id, 0)
+        if old == mask:
+            return
+        for pokemon_id in mask_ids(old & ~mask):
+            wanted_by = self.users[pokemon_id]
+            wanted_by.discard(chat_id)
+            if not wanted_by:
+                del self.users[pokemon_id]
+        for pokemon_id in mask_ids(mask & ~old):
+            self.users.setdefault(pokemon_id, set()).add(chat_id)
+        if mask:
+            self.masks[chat_id] = mask
+        else:
+            self.masks.pop(chat_id, None)
+
+    def remove(self, chat_id):
+        self.set(chat_id, 0)
+
+    def sync(self, users):
+        # Index exactly the given {chat_id: user}
+        for chat_id in list(self.masks):
+            if chat_id not in users:
+                self.remove(chat_id)
+        for chat_id, user in users.items():
+            self.set(chat_id, user_mask(user))
+
+    def users_for(self, pokemon_id):
+        return self.users.get(int(pokemon_id), ())
+
+    def union(self):
+        # Species wanted by anyone, for the upstream mons parameter
+        return sorted(self.users)
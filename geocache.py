@@ -0,0 +1,118 @@
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import time
+
+# Geocodes of places don't move; refresh them weekly
+TTL = 7 * 24 * 3600
+MAXSIZE = 10000
+
+
+def normalize_address(address):
+    # Same suffix handling as /setloc: add Singapore unless 'sg' or 'singapore' is there
+    tokens = ["singapore" if token == "sg" else token
+              for token in address.lower().replace(",", " ").split()]
+    if "singapore" not in tokens:
+        tokens += ["singapore"]
+    return " ".join(tokens)
+
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=MAXSIZE, ttl=TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, now=None):
+        now = now or time.time()
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires <= now:
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl=None, now=None):
+        now = now or time.time()
+        with self.lock:
+            self.items[key] = (value, now + (ttl or self.ttl))
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+
+class DiskCache(object):
+
+    def __init__(self, path, ttl=TTL):
+        self.ttl = ttl
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS geocode ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+            self.db.commit()
+
+    def get(self, key, now=None):
+        now = now or time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value, expires FROM geocode WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= now:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, value, now=None):
+        now = now or time.time()
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO geocode (key, value, expires) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), now + self.ttl))
+
+
+class GeocodeCache(object):
+    """
+    Geocode results keyed by normalized address: an in-memory LRU in front of
+    an optional on-disk tier, both with a TTL.
+    """
+
+    def __init__(self, path=None, maxsize=MAXSIZE, ttl=TTL):
+        self.memory = LRUCache(maxsize, ttl)
+        self.disk = DiskCache(path, ttl) if path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, address):
+        key = normalize_address(address)
+        result = self.memory.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        if self.disk is not None:
+            result = self.disk.get(key)
+            if result is not None:
+                latlon, formatted_address = result
+                result = tuple(latlon), formatted_address
+                self.memory.put(key, result)
+                self.disk_hits += 1
+                return result
+        self.misses += 1
+        return None
+
+    def put(self, address, result):
+        key = normalize_address(address)
+        self.memory.put(key, result)
+        if self.disk is not None:
+            self.disk.put(key, result)
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
@@ -0,0 +1,229 @@
+"""
+Spawn history. Every spawn the feed sees for the first time is appended
+to a file of fixed-width records, with an index of the batches they came
+in, so the history can be replayed through matching and queried by time
+range without loading it into memory.
+
+    python history.py stats --path history.bin
+    python history.py top dragonite --days 7 --path history.bin
+
+The data file is a header and then RECORD after RECORD; with NumPy it is
+read through a memory map as a structured array, one column at a time.
+The index, path + ".idx", has an INDEX entry per batch: when it was seen,
+its first record, how many records and the feed's inserted cursor.
+"""
+from bisect import bisect_left
+from collections import Counter
+import argparse
+import mmap
+import os
+import struct
+import threading
+import time
+
+import pokedex
+from feedstream import Spawn
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAGIC = b'PBHIST01'
+HEADER = struct.Struct('<8sI')
+# seen, despawn, lat and lng in millionths of a degree, pokemon_id, attack, defence, stamina
+RECORD = struct.Struct('<IIiiHBBBx')
+# seen, first record, count, inserted
+INDEX = struct.Struct('<dQIq')
+if np is not None:
+    DTYPE = np.dtype([
+        ('seen', '<u4'), ('despawn', '<u4'), ('lat', '<i4'), ('lng', '<i4'), ('pokemon_id', '<u2'),
+        ('attack', 'u1'), ('defence', 'u1'), ('stamina', 'u1'), ('pad', 'u1')])
+    assert DTYPE.itemsize == RECORD.size
+
+# Side of a cell for top_cells, in degrees: about 550 m
+CELL_DEG = 0.005
+# Records read at a time by queries
+CHUNK_RECORDS = 1 << 16
+
+
+def cell_centre(cell, cell_deg=CELL_DEG):
+    return round((cell[0] + 0.5) * cell_deg, 6), round((cell[1] + 0.5) * cell_deg, 6)
+
+
+class HistoryRecorder(object):
+    """
+    Appends batches of spawns. The data is written before its index entry,
+    so a crash leaves at most records no batch points at; a torn record or
+    entry at the end is cut off on the next open.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = open(path, 'a+b')
+        self.index = open(path + '.idx', 'a+b')
+        size = self.data.seek(0, os.SEEK_END)
+        if size == 0:
+            self.data.write(HEADER.pack(MAGIC, RECORD.size))
+            self.data.flush()
+            size = HEADER.size
+        else:
+            self.data.seek(0)
+            magic, record_size = HEADER.unpack(self.data.read(HEADER.size))
+            if magic != MAGIC or record_size != RECORD.size:
+                raise ValueError("{} is not a spawn history file".format(path))
+        self.count = (size - HEADER.size) // RECORD.size
+        self.data.truncate(HEADER.size + self.count * RECORD.size)
+        entries = self.index.seek(0, os.SEEK_END) // INDEX.size
+        self.index.truncate(entries * INDEX.size)
+
+    def append(self, spawns, inserted, seen=None):
+        if not spawns:
+            return
+        seen = time.time() if seen is None else seen
+        records = b''.join(RECORD.pack(
+            int(seen), int(spawn['despawn']),
+            int(round(float(spawn['lat']) * 1e6)), int(round(float(spawn['lng']) * 1e6)),
+            int(spawn['pokemon_id']),
+            int(spawn['attack']), int(spawn['defence']), int(spawn['stamina'])) for spawn in spawns)
+        with self.lock:
+            self.data.seek(0, os.SEEK_END)
+            self.data.write(records)
+            self.data.flush()
+            self.index.seek(0, os.SEEK_END)
+            self.index.write(INDEX.pack(seen, self.count, len(spawns), int(inserted or 0)))
+            self.index.flush()
+            self.count += len(spawns)
+
+    def close(self):
+        with self.lock:
+            self.data.close()
+            self.index.close()
+
+
+class History(object):
+    """
+    Read-only view of a history file as it was when opened. Only the index
+    is held in memory; records are paged in from the memory map as read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.idx', 'rb') as f:
+            self.entries = [entry for entry in INDEX.iter_unpack(
+                f.read(os.fstat(f.fileno()).st_size // INDEX.size * INDEX.size))]
+        self.seen = [entry[0] for entry in self.entries]
+        self.file = open(path, 'rb')
+        magic, record_size = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC or record_size != RECORD.size:
+            raise ValueError("{} is not a spawn history file".format(path))
+        self.count = 0
+        if self.entries:
+            self.count = self.entries[-1][1] + self.entries[-1][2]
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else None
+        self.array = None
+        if np is not None and self.count:
+            self.array = np.frombuffer(self.map, DTYPE, self.count, HEADER.size)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        # Views of the map must be gone before it can close
+        self.array = None
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def batches(self, start=None, end=None):
+        # Index entries of batches seen in [start, end)
+        lo = 0 if start is None else bisect_left(self.seen, start)
+        hi = len(self.entries) if end is None else bisect_left(self.seen, end)
+        return self.entries[lo:hi]
+
+    def span(self, start=None, end=None):
+        # (first, last) records of batches seen in [start, end)
+        batches = self.batches(start, end)
+        if not batches:
+            return 0, 0
+        return batches[0][1], batches[-1][1] + batches[-1][2]
+
+    def records(self, first, last):
+        # Records first to last: a structured array with NumPy, else tuples
+        if self.array is not None:
+            return self.array[first:last]
+        if first >= last:
+            return []
+        offset = HEADER.size + first * RECORD.size
+        return list(RECORD.iter_unpack(self.map[offset:offset + (last - first) * RECORD.size]))
+
+    def spawns(self, first, last):
+        records = self.records(first, last)
+        if self.array is not None:
+            records = records.tolist()
+        return [Spawn(pokemon_id, lat / 1e6, lng / 1e6, despawn, attack, defence, stamina)
+                for seen, despawn, lat, lng, pokemon_id, attack, defence, stamina
+                in (record[:8] for record in records)]
+
+    def replay(self, start=None, end=None, speed=None):
+        # Yields (seen, spawns, inserted) per batch. Given the speed the replay
+        # runs at, spawns get as long to live as when recorded, in replay time.
+        for seen, first, count, inserted in self.batches(start, end):
+            spawns = self.spawns(first, first + count)
+            if speed:
+                now = time.time()
+                for spawn in spawns:
+                    spawn.despawn = int(now + max(1, (spawn.despawn - seen) / speed))
+            yield seen, spawns, inserted
+
+    def top_cells(self, pokemon_id, start=None, end=None, top=10, cell_deg=CELL_DEG, chunk=CHUNK_RECORDS):
+        # [((lat, lng) of a cell's centre, spawns)] of the cells where pokemon_id
+        # was seen most in [start, end), reading chunk records at a time
+        first, last = self.span(start, end)
+        counts = Counter()
+        scale = 1e6 * cell_deg
+        for lo in range(first, last, chunk):
+            records = self.records(lo, min(last, lo + chunk))
+            if self.array is not None:
+                records = records[records['pokemon_id'] == pokemon_id]
+                if not len(records):
+                    continue
+                rows = np.floor(records['lat'] / scale).astype(np.int64)
+                cols = np.floor(records['lng'] / scale).astype(np.int64)
+                cells, n = np.unique(np.stack([rows, cols], axis=1), axis=0, return_counts=True)
+                counts.update(dict(zip(map(tuple, cells.tolist()), n.tolist())))
+            else:
+                counts.update((int(lat // scale), int(lng // scale))
+                              for _, _, lat, lng, species, _, _, _ in records if species == pokemon_id)
+        return [(cell_centre(cell, cell_deg), n) for cell, n in counts.most_common(top)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['stats', 'top'])
+    parser.add_argument('pokemon', nargs='?')
+    parser.add_argument('--path', default=os.environ.get("TELE_POKEBACON_HISTORY", "history.bin"))
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    history = History(args.path)
+    if args.command == 'stats':
+        batches = history.batches()
+        print("{} spawns in {} batches, {:.1f} MB".format(
+            len(history), len(batches), os.path.getsize(args.path) / 1e6))
+        if batches:
+            print("from {} to {}".format(time.ctime(batches[0][0]), time.ctime(batches[-1][0])))
+    else:
+        pokemon_id = pokedex.lookup(args.pokemon or '')
+        if pokemon_id is None:
+            parser.error("unknown pokemon {!r}".format(args.pokemon))
+        start = time.time() - args.days * 86400
+        for (lat, lng), n in history.top_cells(pokemon_id, start, top=args.top):
+            print("{:>6}  {:.6f},{:.6f}".format(n, lat, lng))
+    history.close()
+
+
+if __name__ == "__main__":
+    main()
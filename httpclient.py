@@ -0,0 +1,97 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeout in seconds
+TIMEOUT = (5, 30)
+RETRIES = 3
+BACKOFF = 0.5
+# Keep-alive connections kept per host
+POOL_SIZE = 16
+
+
+class HttpClient(object):
+    """
+    Shared requests sessions with per-host keep-alive pools, gzip, timeouts
+    and retries with backoff. Used for Telegram, sgpokemap and geocoding.
+    Calls that are not idempotent, eg. sendMessage, go through a session
+    that only retries failed connects, as a timed out or failed send may
+    still have been delivered.
+    """
+
+    def __init__(self, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF, pool_size=POOL_SIZE):
+        self.timeout = timeout
+        self.session = self.make_session(pool_size, Retry(
+            total=retries, backoff_factor=backoff,
+            status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(['GET'])))
+        self.send_session = self.make_session(pool_size, Retry(
+            total=retries, read=0, other=0, status=0, backoff_factor=backoff,
+            allowed_methods=frozenset(['GET'])))
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    @staticmethod
+    def make_session(pool_size, retry):
+        session = requests.Session()
+        session.headers['accept-encoding'] = 'gzip, deflate'
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, max_retries=retry)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, url, idempotent=True, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session if idempotent else self.send_session
+        with self.lock:
+            self.in_flight += 1
+        start = time.time()
+        try:
+            return session.get(url, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            latency = time.time() - start
+            with self.lock:
+                self.in_flight -= 1
+                self.requests += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def pools(self):
+        pools = []
+        adapters = set(self.session.adapters.values()) | set(self.send_session.adapters.values())
+        for adapter in adapters:
+            manager = adapter.poolmanager
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is not None:
+                    pools.append(pool)
+        return pools
+
+    def stats(self):
+        pools = self.pools()
+        connections = sum(pool.num_connections for pool in pools)
+        pool_requests = sum(pool.num_requests for pool in pools)
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'connections': connections,
+                'reuse_rate': 1 - connections / float(pool_requests) if pool_requests else 0.0,
+                'latency_avg': self.latency_total / self.requests if self.requests else 0.0,
+                'latency_max': self.latency_max,
+            }
+
+
+client = HttpClient()
@@ -0,0 +1,81 @@
+"""
+Minimal HTTP/1.1 server on asyncio streams, with keep-alive, for the
+webhook and metrics endpoints. Subclasses answer each request in process.
+"""
+import asyncio
+
+MAX_BODY = 1 << 20
+
+STATUS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    413: "Payload Too Large",
+}
+
+
+class HttpServer(object):
+    """
+    Reads requests off each connection and writes back what process returns.
+    Bodies over max_body are refused and the connection closed.
+    """
+
+    def __init__(self, host, port, max_body=MAX_BODY):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve_client, self.host, self.port)
+        # Port 0 binds any free port
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    def close(self):
+        self.server.close()
+
+    async def process(self, method, target, headers, body):
+        # Returns (status, content type, body)
+        raise NotImplementedError
+
+    async def serve_client(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                too_large = length > self.max_body
+                if too_large:
+                    status, content_type, body = 413, 'text/plain', ''
+                else:
+                    body = await reader.readexactly(length)
+                    try:
+                        status, content_type, body = await self.process(method, target, headers, body)
+                    except ValueError:
+                        status, content_type, body = 400, 'text/plain', 'bad request\n'
+                body = body.encode()
+                close = too_large or headers.get("connection", "").lower() == "close" \
+                    or version.strip() == "HTTP/1.0"
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n{}\r\n".format(
+                    status, STATUS[status], content_type, len(body), "Connection: close\r\n" if close else "").encode() + body)
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
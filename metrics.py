@@ -0,0 +1,322 @@
+"""
+Instrumentation. Counters, gauges and latency histograms for the hot
+paths, eg. Telegram calls, upstream fetches, geocoding and the monitor
+pass, kept in a registry that renders them as Prometheus text or JSON. A
+small local HTTP endpoint serves them, and runs a sampling profiler on
+request that dumps collapsed stacks for flamegraphs.
+"""
+from collections import Counter as Tally
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import parse_qsl
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+from httpserver import HttpServer
+
+# Upper bounds of the latency buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 150.0)
+# Stack samples per second while profiling, and the longest /profile run
+PROFILE_HZ = 100
+MAX_PROFILE_SECS = 300
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in zip(names, values)) + '}'
+
+
+class Metric(object):
+    """
+    Values per tuple of label values; a metric without labels has one, under
+    (). Given fn, values are read from it when rendered instead: a number,
+    or a dict of label values to numbers.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.fn = fn
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def collect(self):
+        if self.fn is None:
+            with self.lock:
+                return dict(self.values)
+        values = self.fn()
+        if isinstance(values, dict):
+            return dict((k if isinstance(k, tuple) else (k,), v) for k, v in values.items())
+        return {(): values}
+
+    def samples(self):
+        # (suffix, label names, label values, value) lines for the exposition
+        for labels, value in sorted(self.collect().items()):
+            yield '', self.labels, labels, value
+
+    def summary(self, value):
+        return value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    Values are [count per bucket, sum, count]; the last bucket is +Inf.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            stats = self.values.get(labels)
+            if stats is None:
+                stats = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            n = 0
+            while n < len(self.buckets) and value > self.buckets[n]:
+                n += 1
+            stats[0][n] += 1
+            stats[1] += value
+            stats[2] += 1
+
+    @contextmanager
+    def time(self, labels=()):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, labels)
+
+    def collect(self):
+        with self.lock:
+            return dict((labels, [list(counts), total, count])
+                        for labels, (counts, total, count) in self.values.items())
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for labels, (counts, total, count) in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                yield '_bucket', names, labels + (bound,), cumulative
+            yield '_sum', self.labels, labels, total
+            yield '_count', self.labels, labels, count
+
+    def quantile(self, counts, count, q):
+        # Upper bound of the bucket holding the q-th observation; None past the last
+        rank = q * count
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return None
+
+    def summary(self, value):
+        counts, total, count = value
+        if not count:
+            return {'count': 0}
+        return {
+            'count': count,
+            'avg': round(total / count, 6),
+            'p50': self.quantile(counts, count, 0.5),
+            'p90': self.quantile(counts, count, 0.9),
+            'p99': self.quantile(counts, count, 0.99),
+        }
+
+
+class Registry(object):
+    """
+    Metrics by name. Asking for a name again returns the metric already
+    registered, with fn replaced if one is given, so modules and bots can
+    declare what they use without coordinating.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def add(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif kwargs.get('fn') is not None:
+                metric.fn = kwargs['fn']
+            return metric
+
+    def counter(self, name, help, labels=(), fn=None):
+        return self.add(Counter, name, help, labels, fn=fn)
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self.add(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.add(Histogram, name, help, labels, buckets=buckets)
+
+    def sorted(self):
+        with self.lock:
+            return [self.metrics[name] for name in sorted(self.metrics)]
+
+    def prometheus(self):
+        lines = []
+        for metric in self.sorted():
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for suffix, names, values, value in metric.samples():
+                lines.append('{}{}{} {}'.format(metric.name, suffix, format_labels(names, values), value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        # {name: value}, or {name: {"label=value,...": value}} for labelled metrics
+        snapshot = {}
+        for metric in self.sorted():
+            values = metric.collect()
+            if not metric.labels:
+                if () in values:
+                    snapshot[metric.name] = metric.summary(values[()])
+                continue
+            snapshot[metric.name] = dict(
+                (','.join('{}={}'.format(n, v) for n, v in zip(metric.labels, labels)), metric.summary(value))
+                for labels, value in sorted(values.items()))
+        return snapshot
+
+
+# Shared by every module
+REGISTRY = Registry()
+
+
+def timed(histogram, labels=()):
+    # Decorator observing how long each call takes
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.time() - started, labels)
+        return wrapper
+    return decorate
+
+
+class Sampler(object):
+    """
+    Wall-clock sampling profiler: every thread's stack, hz times a second,
+    counted in the collapsed format flamegraph.pl and speedscope read.
+    Threads blocked on I/O or locks show where they wait.
+    """
+
+    def __init__(self, hz=PROFILE_HZ):
+        self.hz = hz
+        self.stacks = Tally()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='sampler')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopping.wait(1.0 / self.hz):
+            self.sample()
+
+    def sample(self):
+        me = threading.get_ident()
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread'))
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def stop(self):
+        # Returns the collapsed stacks, one "frame;frame;... count" per line
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in self.stacks.most_common())
+
+
+class MetricsServer(HttpServer):
+    """
+    Local HTTP endpoint on asyncio streams:
+
+        GET /metrics           Prometheus text
+        GET /metrics.json      the same as JSON, histograms as quantiles
+        GET /profile?seconds=N profiles for N seconds, returns collapsed stacks
+        GET /profile/start     starts profiling
+        GET /profile/stop      stops it, returns collapsed stacks
+    """
+
+    def __init__(self, registry=REGISTRY, host="127.0.0.1", port=9464):
+        super(MetricsServer, self).__init__(host, port)
+        self.registry = registry
+        self.sampler = None
+
+    def close(self):
+        super(MetricsServer, self).close()
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+
+    async def process(self, method, target, headers, body):
+        path, _, query = target.partition("?")
+        params = dict(parse_qsl(query))
+        if path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', self.registry.prometheus()
+        if path == '/metrics.json':
+            return 200, 'application/json', json.dumps(self.registry.snapshot())
+        if path == '/profile/start':
+            if self.sampler is None:
+                self.sampler = Sampler(int(params.get('hz', PROFILE_HZ))).start()
+            return 200, 'text/plain', 'profiling\n'
+        if path == '/profile/stop':
+            if self.sampler is None:
+                return 409, 'text/plain', 'not profiling\n'
+            sampler, self.sampler = self.sampler, None
+            return 200, 'text/plain', sampler.stop()
+        if path == '/profile':
+            seconds = min(float(params.get('seconds', 10)), MAX_PROFILE_SECS)
+            sampler = Sampler(int(params.get('hz', PROFILE_HZ))).start()
+            await asyncio.sleep(seconds)
+            return 200, 'text/plain', sampler.stop()
+        return 404, 'text/plain', 'not found\n'
@@ -0,0 +1,209 @@
+"""
+Open Location Code (plus code) encoding and decoding, following the
+reference implementation at https://github.com/google/open-location-code.
+Lets full and short plus codes be resolved without a network call.
+"""
+from collections import namedtuple
+
+SEPARATOR = '+'
+SEPARATOR_POSITION = 8
+PADDING = '0'
+ALPHABET = '23456789CFGHJMPQRVWX'
+ENCODING_BASE = len(ALPHABET)
+LATITUDE_MAX = 90
+LONGITUDE_MAX = 180
+MAX_DIGIT_COUNT = 15
+PAIR_CODE_LENGTH = 10
+PAIR_FIRST_PLACE_VALUE = ENCODING_BASE ** (PAIR_CODE_LENGTH // 2 - 1)
+PAIR_PRECISION = ENCODING_BASE ** 3
+GRID_CODE_LENGTH = MAX_DIGIT_COUNT - PAIR_CODE_LENGTH
+GRID_COLUMNS = 4
+GRID_ROWS = 5
+GRID_LAT_FIRST_PLACE_VALUE = GRID_ROWS ** (GRID_CODE_LENGTH - 1)
+GRID_LNG_FIRST_PLACE_VALUE = GRID_COLUMNS ** (GRID_CODE_LENGTH - 1)
+FINAL_LAT_PRECISION = PAIR_PRECISION * GRID_ROWS ** GRID_CODE_LENGTH
+FINAL_LNG_PRECISION = PAIR_PRECISION * GRID_COLUMNS ** GRID_CODE_LENGTH
+
+
+class CodeArea(namedtuple('CodeArea', [
+        'latitude_lo', 'longitude_lo', 'latitude_hi', 'longitude_hi', 'code_length'])):
+
+    @property
+    def latitude_center(self):
+        return min(self.latitude_lo + (self.latitude_hi - self.latitude_lo) / 2, LATITUDE_MAX)
+
+    @property
+    def longitude_center(self):
+        return min(self.longitude_lo + (self.longitude_hi - self.longitude_lo) / 2, LONGITUDE_MAX)
+
+    @property
+    def latlon(self):
+        return self.latitude_center, self.longitude_center
+
+
+def is_valid(code):
+    if not code or len(code) == 1 or code.count(SEPARATOR) != 1:
+        return False
+    separator = code.find(SEPARATOR)
+    if separator > SEPARATOR_POSITION or separator % 2 == 1:
+        return False
+    # A single character after the separator is not allowed
+    if len(code) - separator - 1 == 1:
+        return False
+
+    padding = code.find(PADDING)
+    if padding != -1:
+        # Padding is only allowed in full codes, not at the start, and must be
+        # one even-length run right before the separator
+        if separator < SEPARATOR_POSITION or padding == 0:
+            return False
+        run = code[padding:separator]
+        if len(run) % 2 == 1 or run != PADDING * len(run):
+            return False
+        if not code.endswith(SEPARATOR):
+            return False
+
+    for ch in code.upper():
+        if ch not in ALPHABET and ch not in (SEPARATOR, PADDING):
+            return False
+    return True
+
+
+def is_short(code):
+    if not is_valid(code):
+        return False
+    return 0 <= code.find(SEPARATOR) < SEPARATOR_POSITION
+
+
+def is_full(code):
+    if not is_valid(code) or is_short(code):
+        return False
+    code = code.upper()
+    if ALPHABET.find(code[0]) * ENCODING_BASE >= LATITUDE_MAX * 2:
+        return False
+    if len(code) > 1 and ALPHABET.find(code[1]) * ENCODING_BASE >= LONGITUDE_MAX * 2:
+        return False
+    return True
+
+
+def clip_latitude(latitude):
+    return min(LATITUDE_MAX, max(-LATITUDE_MAX, latitude))
+
+
+def normalize_longitude(longitude):
+    while longitude < -LONGITUDE_MAX:
+        longitude += LONGITUDE_MAX * 2
+    while longitude >= LONGITUDE_MAX:
+        longitude -= LONGITUDE_MAX * 2
+    return longitude
+
+
+def latitude_precision(code_length):
+    if code_length <= PAIR_CODE_LENGTH:
+        return ENCODING_BASE ** (code_length // -2 + 2)
+    return ENCODING_BASE ** -3 / GRID_ROWS ** (code_length - PAIR_CODE_LENGTH)
+
+
+def encode(latitude, longitude, code_length=PAIR_CODE_LENGTH):
+    if code_length < 2 or (code_length < PAIR_CODE_LENGTH and code_length % 2 == 1):
+        raise ValueError('Invalid Open Location Code length: {}'.format(code_length))
+    code_length = min(code_length, MAX_DIGIT_COUNT)
+    latitude = clip_latitude(latitude)
+    longitude = normalize_longitude(longitude)
+    if latitude == LATITUDE_MAX:
+        latitude -= latitude_precision(code_length)
+
+    # Work in integers to avoid floating point drift
+    lat_val = int(round((latitude + LATITUDE_MAX) * FINAL_LAT_PRECISION, 6))
+    lng_val = int(round((longitude + LONGITUDE_MAX) * FINAL_LNG_PRECISION, 6))
+
+    code = ''
+    if code_length > PAIR_CODE_LENGTH:
+        for _ in range(GRID_CODE_LENGTH):
+            lat_digit = lat_val % GRID_ROWS
+            lng_digit = lng_val % GRID_COLUMNS
+            code = ALPHABET[lat_digit * GRID_COLUMNS + lng_digit] + code
+            lat_val //= GRID_ROWS
+            lng_val //= GRID_COLUMNS
+    else:
+        lat_val //= GRID_ROWS ** GRID_CODE_LENGTH
+        lng_val //= GRID_COLUMNS ** GRID_CODE_LENGTH
+    for _ in range(PAIR_CODE_LENGTH // 2):
+        code = ALPHABET[lng_val % ENCODING_BASE] + code
+        code = ALPHABET[lat_val % ENCODING_BASE] + code
+        lat_val //= ENCODING_BASE
+        lng_val //= ENCODING_BASE
+
+    code = code[:SEPARATOR_POSITION] + SEPARATOR + code[SEPARATOR_POSITION:]
+    if code_length >= SEPARATOR_POSITION:
+        return code[:code_length + 1]
+    return code[:code_length] + PADDING * (SEPARATOR_POSITION - code_length) + SEPARATOR
+
+
+def decode(code):
+    if not is_full(code):
+        raise ValueError('Passed Open Location Code is not a valid full code: {}'.format(code))
+    code = code.replace(SEPARATOR, '').replace(PADDING, '').upper()[:MAX_DIGIT_COUNT]
+
+    normal_lat = -LATITUDE_MAX * PAIR_PRECISION
+    normal_lng = -LONGITUDE_MAX * PAIR_PRECISION
+    grid_lat = 0
+    grid_lng = 0
+
+    digits = min(len(code), PAIR_CODE_LENGTH)
+    place_value = PAIR_FIRST_PLACE_VALUE
+    for i in range(0, digits, 2):
+        normal_lat += ALPHABET.find(code[i]) * place_value
+        normal_lng += ALPHABET.find(code[i + 1]) * place_value
+        if i < digits - 2:
+            place_value //= ENCODING_BASE
+    lat_precision = float(place_value) / PAIR_PRECISION
+    lng_precision = float(place_value) / PAIR_PRECISION
+
+    if len(code) > PAIR_CODE_LENGTH:
+        row_place_value = GRID_LAT_FIRST_PLACE_VALUE
+        col_place_value = GRID_LNG_FIRST_PLACE_VALUE
+        digits = min(len(code), MAX_DIGIT_COUNT)
+        for i in range(PAIR_CODE_LENGTH, digits):
+            value = ALPHABET.find(code[i])
+            grid_lat += value // GRID_COLUMNS * row_place_value
+            grid_lng += value % GRID_COLUMNS * col_place_value
+            if i < digits - 1:
+                row_place_value //= GRID_ROWS
+                col_place_value //= GRID_COLUMNS
+        lat_precision = float(row_place_value) / FINAL_LAT_PRECISION
+        lng_precision = float(col_place_value) / FINAL_LNG_PRECISION
+
+    latitude = float(normal_lat) / PAIR_PRECISION + float(grid_lat) / FINAL_LAT_PRECISION
+    longitude = float(normal_lng) / PAIR_PRECISION + float(grid_lng) / FINAL_LNG_PRECISION
+    return CodeArea(
+        latitude, longitude, latitude + lat_precision, longitude + lng_precision,
+        min(len(code), MAX_DIGIT_COUNT))
+
+
+def recover_nearest(code, reference_latitude, reference_longitude):
+    # Full code of the area nearest the reference that matches a short code
+    if not is_short(code):
+        if is_full(code):
+            return code.upper()
+        raise ValueError('Passed short code is not valid: {}'.format(code))
+
+    reference_latitude = clip_latitude(reference_latitude)
+    reference_longitude = normalize_longitude(reference_longitude)
+    code = code.upper()
+    padding_length = SEPARATOR_POSITION - code.find(SEPARATOR)
+    resolution = ENCODING_BASE ** (2 - padding_length / 2.0)
+    half_resolution = resolution / 2.0
+
+    area = decode(encode(reference_latitude, reference_longitude)[:padding_length] + code)
+    latitude, longitude = area.latlon
+    # Move by one resolution step if the reference is nearer a neighbouring area
+    if reference_latitude + half_resolution < latitude and latitude - resolution >= -LATITUDE_MAX:
+        latitude -= resolution
+    elif reference_latitude - half_resolution > latitude and latitude + resolution <= LATITUDE_MAX:
+        latitude += resolution
+    if reference_longitude + half_resolution < longitude:
+        longitude -= resolution
+    elif reference_longitude - half_resolution > longitude:
+        longitude += resolution
+    return encode(latitude, longitude, area.code_length)
@@ -0,0 +1,190 @@
+from collections import deque
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+# Lower goes first
+PRIORITY_REPLY = 0
+PRIORITY_ALERT = 1
+
+# Telegram flood limits: about 30 msg/s overall and 1 msg/s per chat
+GLOBAL_RATE = 30.0
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+WORKERS = 4
+# Per-chat buckets kept before idle ones are pruned
+MAX_BUCKETS = 10000
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+
+    def level(self, now):
+        # Tokens there would be now, without taking one
+        return min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+
+    def take(self, now):
+        # Takes a token and returns 0, or returns seconds until one is available
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+def prune_buckets(buckets, now, busy=(), max_buckets=MAX_BUCKETS):
+    # Once there are over max_buckets, forgets the chats not in busy whose
+    # bucket has refilled, and returns them
+    if len(buckets) <= max_buckets:
+        return []
+    idle = [chat_id for chat_id, bucket in buckets.items()
+            if chat_id not in busy and bucket.level(now) >= bucket.capacity]
+    for chat_id in idle:
+        del buckets[chat_id]
+    return idle
+
+
+class Outbox(object):
+    """
+    Outbound message dispatcher. Messages for a chat are sent in order,
+    chats are served by priority, and sends are held back by per-chat and
+    global token buckets and by any retry_after Telegram asks for.
+    """
+
+    def __init__(self, send, workers=WORKERS, global_rate=GLOBAL_RATE,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.send = send
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        # chat_id -> deque of (priority, method, params)
+        self.pending = {}
+        # (priority, seq, chat_id) of chats that may send now
+        self.ready = []
+        # (not_before, seq, chat_id) of throttled chats
+        self.waiting = []
+        self.paused_until = 0
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.running = False
+        self.sent = 0
+        self.throttled = 0
+
+    def start(self):
+        self.running = True
+        for _ in range(self.workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def set_global_rate(self, rate):
+        # For a process sending a share of the bot's traffic
+        with self.cond:
+            self.global_bucket = TokenBucket(rate, max(rate, 1))
+
+    def set_chat_rate(self, rate, burst):
+        # Per-chat limit for sends from now on, eg. lifted against a fake Telegram
+        with self.cond:
+            self.chat_rate = rate
+            self.chat_burst = burst
+            self.chat_buckets = {}
+
+    def put(self, chat_id, method, params, priority=PRIORITY_REPLY):
+        with self.cond:
+            queue = self.pending.get(chat_id)
+            if queue is None:
+                queue = self.pending[chat_id] = deque()
+                heapq.heappush(self.ready, (priority, next(self.seq), chat_id))
+            queue.append((priority, method, params))
+            self.cond.notify()
+
+    def size(self):
+        with self.cond:
+            return sum(len(queue) for queue in self.pending.values())
+
+    def schedule(self, chat_id, now, retry_after=0):
+        # Called with the lock held, once a chat's send has finished
+        queue = self.pending.get(chat_id)
+        if not queue:
+            self.pending.pop(chat_id, None)
+            prune_buckets(self.chat_buckets, now, self.pending)
+            return
+        wait = retry_after
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is not None:
+            wait = max(wait, (1 - bucket.level(now)) / bucket.rate)
+        if wait > 0:
+            heapq.heappush(self.waiting, (now + wait, next(self.seq), chat_id))
+        else:
+            heapq.heappush(self.ready, (queue[0][0], next(self.seq), chat_id))
+        self.cond.notify()
+
+    def next_message(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                while self.waiting and self.waiting[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self.waiting)
+                    heapq.heappush(self.ready, (self.pending[chat_id][0][0], next(self.seq), chat_id))
+
+                timeout = None
+                if self.waiting:
+                    timeout = self.waiting[0][0] - now
+                if self.paused_until > now:
+                    timeout = self.paused_until - now
+                elif self.ready:
+                    _, _, chat_id = self.ready[0]
+                    bucket = self.chat_buckets.get(chat_id)
+                    if bucket is None:
+                        bucket = self.chat_buckets[chat_id] = TokenBucket(
+                            self.chat_rate, self.chat_burst)
+                    wait = bucket.take(now)
+                    if wait:
+                        heapq.heappop(self.ready)
+                        heapq.heappush(self.waiting, (now + wait, next(self.seq), chat_id))
+                        continue
+                    wait = self.global_bucket.take(now)
+                    if not wait:
+                        heapq.heappop(self.ready)
+                        return chat_id, self.pending[chat_id].popleft()
+                    # Give back the chat token, the global limit is what holds us
+                    bucket.tokens += 1
+                    timeout = wait if timeout is None else min(timeout, wait)
+                self.cond.wait(timeout)
+
+    def work(self):
+        while True:
+            chat_id, message = self.next_message()
+            priority, method, params = message
+            retry_after = 0
+            try:
+                result = self.send(method, list(params), chat_id)
+                if result and result.get('error_code') == 429:
+                    retry_after = result.get('parameters', {}).get('retry_after', 1)
+            except Exception:
+                traceback.print_exc()
+
+            with self.cond:
+                now = time.time()
+                if retry_after:
+                    # Flood limit hit: put the message back and hold the chat. Telegram
+                    # doesn't say which limit it was, so hold every chat only when
+                    # sends were going out at the global rate
+                    self.throttled += 1
+                    self.pending.setdefault(chat_id, deque()).appendleft(message)
+                    if self.global_bucket.level(now) < 1:
+                        self.paused_until = max(self.paused_until, now + retry_after)
+                else:
+                    self.sent += 1
+                self.schedule(chat_id, now, retry_after)
+                self.cond.notify_all()
@@ -0,0 +1,82 @@
+"""
+Pokedex name and id lookups. pokemon.json and want.txt are only read on
+first use, and each derived map is built once.
+"""
+from difflib import get_close_matches
+from functools import lru_cache
+import os
+import re
+
+here = os.path.dirname(os.path.abspath(__file__))
+POKEDEX_PATH = os.path.join(here, 'pokemon.json')
+WANT_PATH = os.path.join(here, 'want.txt')
+
+# Names users type that don't normalize to the pokedex name
+ALIASES = {
+    'nidoranf': 'Nidoran♀',
+    'nidoranfemale': 'Nidoran♀',
+    'nidoranm': 'Nidoran♂',
+    'nidoranmale': 'Nidoran♂',
+    'mime': 'Mr. Mime',
+    'mrmine': 'Mr. Mime',
+    'farfetch': 'Farfetch’d',
+    'typenull': 'Type: Null',
+    'porygon3': 'Porygon-Z',
+}
+
+
+def normalize(name):
+    # Lowercase letters and digits only, eg. "Mr. Mime" -> "mrmime"
+    return re.sub(r'[^a-z0-9♀♂]', '', name.lower())
+
+
+def read_lines(path):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f.read().split('\n')]
+
+
+@lru_cache(maxsize=None)
+def names():
+    # Pokemon names in pokedex order; id 1 is names()[0]
+    return tuple(read_lines(POKEDEX_PATH))
+
+
+@lru_cache(maxsize=None)
+def ids():
+    lookup = dict((normalize(name), i + 1) for i, name in enumerate(names()) if name)
+    for alias, name in ALIASES.items():
+        lookup.setdefault(alias, lookup[normalize(name)])
+    return lookup
+
+
+def size():
+    return len(names())
+
+
+def name(pokemon_id):
+    return names()[int(pokemon_id) - 1]
+
+
+def lookup(text, cutoff=0.8):
+    # Pokedex id for a user-typed name, allowing small typos; None if unknown
+    key = normalize(text)
+    if not key:
+        return None
+    pokemon_id = ids().get(key)
+    if pokemon_id is None:
+        matches = get_close_matches(key, ids().keys(), n=1, cutoff=cutoff)
+        if matches:
+            pokemon_id = ids()[matches[0]]
+    return pokemon_id
+
+
+@lru_cache(maxsize=None)
+def want_ids():
+    # Pokedex ids in want.txt, skipping blank lines
+    return tuple(ids()[normalize(line)] for line in read_lines(WANT_PATH) if line)
+
+
+@lru_cache(maxsize=None)
+def want_mons():
+    # want.txt as the upstream mons parameter
+    return ",".join(str(i) for i in want_ids())
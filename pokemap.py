@@ -1,21 +1,52 @@
-import requests
+from httpclient import client
+from geocache import GeocodeCache, LRUCache
+import olc
+import pokedex
+import feedstream
+from metrics import REGISTRY, timed
 from math import radians, cos, sin, asin, sqrt
-from datetime import datetime
+import time
 import os
+from operator import itemgetter
+from functools import lru_cache
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-geocode_api_key = os.environ["GOOGLE_GEOCODE_API"]
 
-# Pokemon index to lookup pokemon name
-with open('pokemon.json', 'r') as f:
-    pokedex = f.read().split('\n')
+def geocode_api_key():
+    # Read on first use, so importing pokemap needs no secrets
+    return os.environ["GOOGLE_GEOCODE_API"]
 
-# Pokemons you want to look out for
-with open('want.txt', 'r') as f:
-    want_pk = f.read().split('\n')
 
-want_pk_ids = [pokedex.index(i) + 1 for i in want_pk]
-mons_list = str(want_pk_ids)[1:-1].replace(" ", "")
+@lru_cache(maxsize=None)
+def get_geocode_cache():
+    # Geocode results, with an on-disk tier if a path is given
+    return GeocodeCache(path=os.environ.get("GOOGLE_GEOCODE_CACHE"))
+
+
+# Upstream endpoints; override to point at local fakes, eg. for benchmarks
+QUERY_URL = os.environ.get("SGPOKEMAP_URL", "https://sgpokemap.com/query2.php")
+GEOCODE_URL = os.environ.get("GOOGLE_GEOCODE_URL", "https://maps.googleapis.com/maps/api/geocode/json")
+PLUS_CODES_URL = os.environ.get("PLUS_CODES_URL", "https://plus.codes/api")
+
+upstream_seconds = REGISTRY.histogram(
+    'pokebacon_upstream_fetch_seconds', 'Fetching and parsing a query2.php response')
+geocode_seconds = REGISTRY.histogram(
+    'pokebacon_get_location_seconds', 'Resolving an address, cached or not')
+get_pokemons_seconds = REGISTRY.histogram(
+    'pokebacon_get_pokemons_seconds', 'Fetching and filtering spawns around one location')
+
+# Reference location for short plus codes
+plus_code_reference = (1.3521, 103.8198)
+# plus.codes encryption key, refetched once it expires
+EKEY_TTL = 3600
+ekey_cache = LRUCache(maxsize=1, ttl=EKEY_TTL)
+
+# Feed fields loaded into arrays by spawn_columns
+column_fields = itemgetter('lat', 'lng', 'despawn', 'attack', 'defence', 'stamina', 'pokemon_id')
 
 headers = {
     'accept-encoding': 'gzip, deflate, sdch, br',
@@ -51,74 +82,167 @@ def get_latlong(pokemon):
     return lat, lon
 
 
-def get_location(address):
+def get_plus_codes_key():
+    ekey = ekey_cache.get('ekey')
+    if ekey is None:
+        ekey = client.get(PLUS_CODES_URL + "?encryptkey=" + geocode_api_key()).json()['key']
+        ekey_cache.put('ekey', ekey)
+    return ekey
+
+
+def find_plus_code(address):
+    for token in address.split():
+        if olc.is_valid(token):
+            return token.upper()
+
+
+@timed(geocode_seconds)
+def get_location(address, street_address=False):
+    # Plus codes are decoded locally
+    code = find_plus_code(address)
+    if code:
+        return get_plus_code_location(code, street_address)
+
+    # Repeated addresses, eg. MRT stations, are served from the cache
+    result = get_geocode_cache().get(address)
+    if result is None:
+        result = lookup_location(address)
+        get_geocode_cache().put(address, result)
+    return result
+
+
+def get_plus_code_location(code, street_address=False):
+    # Short codes are taken as nearest to Singapore
+    if olc.is_short(code):
+        code = olc.recover_nearest(code, *plus_code_reference)
+    geocode_latlon = olc.decode(code).latlon
+    formatted_address = code
+
+    # Only go to plus.codes when the street address is asked for
+    if street_address:
+        result = get_geocode_cache().get(code)
+        if result is None:
+            result = geocode_latlon, lookup_street_address(code)
+            get_geocode_cache().put(code, result)
+        formatted_address = result[1]
+    return geocode_latlon, formatted_address
+
+
+def lookup_street_address(code):
+    geocode = client.get(PLUS_CODES_URL + "?address=" + code.replace(
+        "+", "%2B") + "&ekey=" + get_plus_codes_key()).json()['plus_code']
+    return geocode["best_street_address"]
+
+
+def lookup_location(address):
     # Get lat long of current location
-    if len(address) == 11:
-        ekey = requests.get("https://plus.codes/api?encryptkey=" + geocode_api_key).json()['key']
-        geocode = requests.get("https://plus.codes/api?address=" + address.replace(
-            "+", "%2B") + "&ekey=" + ekey).json()['plus_code']
-        formatted_address = geocode["best_street_address"]
-        location = geocode["geometry"]["location"]
-        geocode_latlon = (location["lat"], location["lng"])
-        # print "Location set as: {}".format(formatted_address)
+    request_address = address.replace(" ", "+")
+    geocode_params = (
+        ('address', request_address),
+        ('key', geocode_api_key())
+    )
 
-    else:
-        request_address = address.replace(" ", "+")
-        geocode_params = (
-            ('address', request_address),
-            ('key', geocode_api_key)
-        )
-
-        geocode = requests.get(
-            'https://maps.googleapis.com/maps/api/geocode/json', params=geocode_params
-        ).json()["results"][0]
-        location = geocode["geometry"]["location"]
-        geocode_latlon = (location["lat"], location["lng"])
-        formatted_address = geocode["formatted_address"]
-        # print "Location set as: {}".format(formatted_address)
+    geocode = client.get(
+        GEOCODE_URL, params=geocode_params
+    ).json()["results"][0]
+    location = geocode["geometry"]["location"]
+    geocode_latlon = (location["lat"], location["lng"])
+    formatted_address = geocode["formatted_address"]
+    # print "Location set as: {}".format(formatted_address)
 
     return geocode_latlon, formatted_address
 
 
-def get_pokemons(geocode_latlon, radius_in_km, filter_iv=None, since=None):
-    if since:
-        params = (
-            ('since', since),
-            ('mons', mons_list),
-        )
-    else:
-        params = (
-            ('since', '0'),
-            ('mons', mons_list),
-        )
+def spawn_key(pokemon):
+    # Identity of a spawn across upstream responses
+    if pokemon.get('encounter_id'):
+        return pokemon['encounter_id']
+    return (pokemon['pokemon_id'], pokemon['lat'], pokemon['lng'], int(pokemon['despawn']))
+
+
+def mons_param(mons):
+    if mons is None:
+        return pokedex.want_mons()
+    elif not isinstance(mons, str):
+        return ",".join(str(i) for i in sorted(mons))
+    return mons
 
-    results = requests.get(
-        'https://sgpokemap.com/query2.php',
+
+@timed(upstream_seconds)
+def fetch_pokemons(since=None, mons=None):
+    params = (
+        ('since', since or '0'),
+        ('mons', mons_param(mons)),
+    )
+
+    results = client.get(
+        QUERY_URL,
         headers=headers, params=params).json()
 
-    pokemons = results['pokemons']
-    since = results['meta']
+    return results['pokemons'], results['meta']['inserted']
 
-    # Set radius in km
-    pokemon_within_radius = []
 
-    # Filter for pokemons within radius
-    for pokemon in pokemons:
-        poke_latlon = get_latlong(pokemon)
-        pokemon['km_from_location'] = haversine(geocode_latlon, poke_latlon)
-        if pokemon['km_from_location'] < radius_in_km:
-            # Get pokemon name
-            pokemon['name'] = pokedex[int(pokemon['pokemon_id']) - 1]
-            # Get time left before despawn
-            time_left = datetime.fromtimestamp(int(pokemon["despawn"])) - datetime.now()
-            minutes, seconds = divmod(time_left.seconds, 60)
-            pokemon['time_left_secs'] = "{:<2} mins {:<2} sec".format(minutes, seconds)
-            # Get pokemon IV percentage
-            stats = ["attack", "defence", "stamina"]
-            pokemon['iv'] = int(sum([int(pokemon[stat]) for stat in stats]) / 45.0 * 100)
-
-            pokemon_within_radius += [pokemon]
+@timed(upstream_seconds)
+def fetch_spawns(since=None, mons=None, bbox=None):
+    # Like fetch_pokemons, but parses the body as it streams in and keeps only
+    # wanted species within bbox, as Spawn records
+    mons = mons_param(mons)
+    params = (
+        ('since', since or '0'),
+        ('mons', mons),
+    )
+
+    response = client.get(
+        QUERY_URL,
+        headers=headers, params=params, stream=True)
+    try:
+        response.raise_for_status()
+        keep = feedstream.prefilter(set(int(i) for i in mons.split(",") if i), bbox)
+        spawns, fields, _ = feedstream.parse_feed(response.iter_content(feedstream.CHUNK_SIZE), keep)
+    finally:
+        response.close()
+
+    return spawns, fields['meta']['inserted']
+
+
+STATS = ("attack", "defence", "stamina")
+
+
+def iv_percent(stat_total):
+    # Attack, defence and stamina are out of 15 each; takes a column of totals too
+    return stat_total / 45.0 * 100
 
+
+def get_iv(pokemon):
+    return int(iv_percent(sum(int(pokemon[stat]) for stat in STATS)))
+
+
+def seconds_left(despawn, now=None):
+    # Seconds to despawn, wrapping around a day like timedelta.seconds;
+    # takes a column of despawn times too
+    now = time.time() if now is None else now
+    return (despawn - now) // 1 % 86400
+
+
+def format_time_left(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    return "{:<2} mins {:<2} sec".format(minutes, seconds)
+
+
+def describe_pokemon(pokemon, km_from_location):
+    # Copy, as the same spawn may be shared across users
+    pokemon = dict(pokemon)
+    pokemon['km_from_location'] = km_from_location
+    # Get pokemon name
+    pokemon['name'] = pokedex.name(pokemon['pokemon_id'])
+    # Get time left before despawn
+    pokemon['time_left_secs'] = format_time_left(int(seconds_left(int(pokemon["despawn"]))))
+    # Get pokemon IV percentage
+    pokemon['iv'] = get_iv(pokemon)
+    return pokemon
+
+
+def filter_iv_and_sort(pokemon_within_radius, filter_iv=None):
     # Filter for pokemons greater than filtered IV
     if filter_iv:
         pokemons_filtered = []
@@ -129,9 +253,105 @@ def get_pokemons(geocode_latlon, radius_in_km, filter_iv=None, since=None):
         pokemons_filtered = pokemon_within_radius
 
     # Sort by distance from location
-    sorted_pokemon_within_radius = sorted(pokemons_filtered, key=lambda k: k['km_from_location']) 
+    return sorted(pokemons_filtered, key=lambda k: k['km_from_location'])
 
-    return sorted_pokemon_within_radius, since["inserted"]
+
+def merge_nearest(matches):
+    # Several lists of matches, eg. one per circle, as one list sorted by
+    # distance, with a spawn in more than one at its nearest
+    nearest = {}
+    for pokemons in matches:
+        for pokemon in pokemons:
+            key = spawn_key(pokemon)
+            seen = nearest.get(key)
+            if seen is None or pokemon['km_from_location'] < seen['km_from_location']:
+                nearest[key] = pokemon
+    return filter_iv_and_sort(list(nearest.values()))
+
+
+def filter_pokemons_py(pokemons, geocode_latlon, radius_in_km, filter_iv=None, wanted=None):
+    # Set radius in km
+    pokemon_within_radius = []
+
+    # Filter for pokemons within radius
+    for pokemon in pokemons:
+        # Skip species the user doesn't want before any distance math
+        if wanted is not None and not wanted >> int(pokemon['pokemon_id']) & 1:
+            continue
+        poke_latlon = get_latlong(pokemon)
+        km_from_location = haversine(geocode_latlon, poke_latlon)
+        if km_from_location < radius_in_km:
+            pokemon_within_radius += [describe_pokemon(pokemon, km_from_location)]
+
+    return filter_iv_and_sort(pokemon_within_radius, filter_iv)
+
+
+def spawn_columns(pokemons):
+    # Load a feed batch into float columns once, for reuse across filters
+    table = np.array(list(map(column_fields, pokemons)), dtype=float).reshape(-1, 7)
+    return {
+        'lat': table[:, 0],
+        'lng': table[:, 1],
+        'despawn': table[:, 2],
+        'iv': iv_percent(table[:, 3:6].sum(axis=1)).astype(int),
+        'pokemon_id': np.minimum(table[:, 6].astype(int), pokedex.size() + 1),
+    }
+
+
+@lru_cache(maxsize=64)
+def species_lookup(wanted):
+    # Boolean array indexed by pokedex id, for a species mask
+    return np.array([bool(wanted >> i & 1) for i in range(pokedex.size() + 1)] + [False])
+
+
+def filter_pokemons_np(pokemons, geocode_latlon, radius_in_km, filter_iv=None,
+                       columns=None, mask=None, wanted=None):
+    if not pokemons:
+        return []
+    if columns is None:
+        columns = spawn_columns(pokemons)
+    lat, lng, iv = columns['lat'], columns['lng'], columns['iv']
+
+    # Haversine distance for the whole batch
+    lat1, lon1 = np.radians(geocode_latlon[0]), np.radians(geocode_latlon[1])
+    lat2, lon2 = np.radians(lat), np.radians(lng)
+    a = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    km = 6367 * 2 * np.arcsin(np.sqrt(a))
+
+    keep = km < radius_in_km
+    if mask is not None:
+        keep &= mask
+    if wanted is not None:
+        keep &= species_lookup(wanted)[columns['pokemon_id']]
+    if filter_iv:
+        keep &= iv >= int(filter_iv)
+    index = np.flatnonzero(keep)
+    index = index[np.argsort(km[index], kind='stable')]
+
+    time_left = seconds_left(columns['despawn'][index]).astype(int)
+
+    # Format only the survivors
+    pokemons_filtered = []
+    for n, i in enumerate(index):
+        pokemon = dict(pokemons[i])
+        pokemon['km_from_location'] = float(km[i])
+        pokemon['name'] = pokedex.name(pokemon['pokemon_id'])
+        pokemon['time_left_secs'] = format_time_left(int(time_left[n]))
+        pokemon['iv'] = int(iv[i])
+        pokemons_filtered.append(pokemon)
+    return pokemons_filtered
+
+
+def filter_pokemons(pokemons, geocode_latlon, radius_in_km, filter_iv=None, wanted=None):
+    if np is None:
+        return filter_pokemons_py(pokemons, geocode_latlon, radius_in_km, filter_iv, wanted)
+    return filter_pokemons_np(pokemons, geocode_latlon, radius_in_km, filter_iv, wanted=wanted)
+
+
+@timed(get_pokemons_seconds)
+def get_pokemons(geocode_latlon, radius_in_km, filter_iv=None, since=None):
+    pokemons, inserted = fetch_pokemons(since)
+    return filter_pokemons(pokemons, geocode_latlon, radius_in_km, filter_iv), inserted
 
 
 if __name__ == "__main__":
@@ -139,5 +359,5 @@ if __name__ == "__main__":
     radius_in_km = 2
     geocode_latlon, formatted_address = get_location(address)
     # address = "6PH58V74+G3"
-    sorted_pokemon_within_radius, since = get_pokemon_within_radius(
+    sorted_pokemon_within_radius, since = get_pokemons(
         geocode_latlon, radius_in_km, filter_iv=70)
@@ -0,0 +1,112 @@
+"""
+Alert rendering. What every user is shown of a spawn, its name, IV, time
+to despawn and map link, is formatted once per monitor pass into a Card;
+each user's Match only adds their distance, so a spawn matched by many
+users is formatted once rather than once per user.
+"""
+from html import escape
+import time
+
+import pokedex
+from pokemap import format_time_left, get_iv, seconds_left, spawn_key
+
+map_link = "https://maps.google.com/?q={},{}"
+
+
+class Card(object):
+    """
+    One spawn's shared fields and the message fragments around the
+    distance. Reads like the dicts describe_pokemon makes, less
+    km_from_location.
+    """
+    __slots__ = ('spawn', 'name', 'iv', 'time_left_secs', 'html_head', 'html_tail', 'text_head', 'text_tail')
+
+    def __init__(self, spawn, now=None):
+        now = time.time() if now is None else now
+        self.spawn = spawn
+        self.name = pokedex.name(spawn['pokemon_id'])
+        self.iv = get_iv(spawn)
+        self.time_left_secs = format_time_left(int(seconds_left(int(spawn['despawn']), now)))
+        name = self.name.upper()
+        self.html_head = '<b>{}</b> <a href="{}">'.format(
+            escape(name), map_link.format(spawn['lat'], spawn['lng']))
+        self.html_tail = '</a>\nIV {} %, despawn in {}'.format(self.iv, self.time_left_secs.strip())
+        self.text_head = "{}\n".format(name)
+        self.text_tail = "IV percent  : {0:<3} %\nDespawn in : {1}\n\n".format(self.iv, self.time_left_secs)
+
+    def __getitem__(self, key):
+        if key in ('name', 'iv', 'time_left_secs'):
+            return getattr(self, key)
+        return self.spawn[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class Match(object):
+    """
+    A card as one user sees it, with their distance to the spawn.
+    """
+    __slots__ = ('card', 'km_from_location')
+
+    def __init__(self, card, km_from_location):
+        self.card = card
+        self.km_from_location = km_from_location
+
+    def __getitem__(self, key):
+        if key == 'km_from_location':
+            return self.km_from_location
+        return self.card[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class Renderer(object):
+    """
+    Cards for one monitor pass, made the first time a spawn is matched and
+    shared by every user after that.
+    """
+
+    def __init__(self, now=None):
+        self.now = time.time() if now is None else now
+        self.cards = {}
+        self.reused = 0
+
+    def match(self, spawn, km_from_location):
+        key = spawn.get('seq') or spawn_key(spawn)
+        card = self.cards.get(key)
+        if card is None:
+            card = self.cards[key] = Card(spawn, self.now)
+        else:
+            self.reused += 1
+        return Match(card, km_from_location)
+
+
+def card_of(pokemon):
+    # Matches carry their pass's card; other results, eg. /list's, get one made
+    if isinstance(pokemon, Match):
+        return pokemon.card
+    return Card(pokemon)
+
+
+def alert_html(pokemons):
+    # All of a chat's pokemons as one HTML message with map links
+    lines = []
+    for counter, pk in enumerate(pokemons, 1):
+        card = card_of(pk)
+        lines.append("{}. {}{:.2f} km{}".format(counter, card.html_head, pk['km_from_location'], card.html_tail))
+    return "\n\n".join(lines)
+
+
+def alert_text(counter, pk):
+    # One pokemon's summary, sent ahead of its location
+    card = card_of(pk)
+    return "{0:<2} {1}Distance    : {2:<3.2f} km\n{3}".format(
+        counter, card.text_head, pk['km_from_location'], card.text_tail)
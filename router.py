@@ -0,0 +1,149 @@
+"""
+Command routing. The first token of a message picks its handler from a
+dict, its argument is parsed once before the handler runs, and every
+dispatch goes through a chain of middleware, eg. for metrics and rate
+limits.
+"""
+from collections import namedtuple
+from functools import partial
+import threading
+import time
+
+from outbox import TokenBucket, prune_buckets
+
+Command = namedtuple('Command', ['name', 'handler', 'parse', 'usage'])
+
+# Commands a chat may send per second, and in a burst
+COMMAND_RATE = 1.0
+COMMAND_BURST = 5
+
+
+def parse_command(text):
+    # "/SetLoc@mybot  city hall" -> ("/setloc", "city hall"); other text -> (None, text)
+    parts = text.strip().split(None, 1)
+    if not parts or not parts[0].startswith('/'):
+        return None, text
+    return parts[0].split('@', 1)[0].lower(), parts[1].strip() if len(parts) > 1 else ''
+
+
+class Router(object):
+    """
+    Handlers take (chat_id, user), or (argument, chat_id, user) when the
+    command has a parser. A parser raising ValueError gets the command's
+    usage sent back instead. Text that isn't a known command goes to
+    default(text, chat_id, user).
+    """
+
+    def __init__(self, reply, default=None):
+        self.reply = reply
+        self.default = default
+        self.commands = {}
+        self.middleware = []
+
+    def add(self, names, handler, parse=None, usage=None):
+        # names is space separated, eg. "/start /help"
+        for name in names.split():
+            self.commands[name] = Command(name, handler, parse, usage)
+
+    def use(self, middleware):
+        # middleware(name, chat_id, call) runs the rest of the chain with call()
+        self.middleware.append(middleware)
+
+    def run(self, command, argument, chat_id, user):
+        if command.parse is None:
+            return command.handler(chat_id, user)
+        try:
+            argument = command.parse(argument)
+        except ValueError:
+            self.reply(chat_id, command.usage)
+            return None
+        return command.handler(argument, chat_id, user)
+
+    def dispatch(self, text, chat_id, user):
+        name, argument = parse_command(text)
+        command = self.commands.get(name)
+        if command is None:
+            name = None
+            call = partial(self.default, text, chat_id, user)
+        else:
+            call = partial(self.run, command, argument, chat_id, user)
+        for middleware in reversed(self.middleware):
+            call = partial(middleware, name, chat_id, call)
+        return call()
+
+
+class Metrics(object):
+    """
+    Count, errors and latency per command; plain text is counted as "text".
+    """
+
+    def __init__(self):
+        # name -> [count, errors, total secs, max secs]
+        self.commands = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, name, chat_id, call):
+        started = time.time()
+        failed = True
+        try:
+            result = call()
+            failed = False
+            return result
+        finally:
+            self.record(name or 'text', time.time() - started, failed)
+
+    def record(self, name, secs, failed):
+        with self.lock:
+            stats = self.commands.get(name)
+            if stats is None:
+                stats = self.commands[name] = [0, 0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += failed
+            stats[2] += secs
+            stats[3] = max(stats[3], secs)
+
+    def summary(self):
+        with self.lock:
+            return dict((name, {
+                'count': count,
+                'errors': errors,
+                'avg_ms': round(total / count * 1000, 2),
+                'max_ms': round(longest * 1000, 2),
+            }) for name, (count, errors, total, longest) in self.commands.items())
+
+
+class RateLimit(object):
+    """
+    Drops commands from a chat beyond its token bucket, telling the chat
+    once until it slows down.
+    """
+
+    def __init__(self, reply, message, rate=COMMAND_RATE, burst=COMMAND_BURST):
+        self.reply = reply
+        self.message = message
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.limited = set()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, name, chat_id, call):
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.get(chat_id)
+            if bucket is None:
+                self.limited.difference_update(prune_buckets(self.buckets, now))
+                bucket = self.buckets[chat_id] = TokenBucket(self.rate, self.burst)
+            allowed = not bucket.take(now)
+            if allowed:
+                self.limited.discard(chat_id)
+            else:
+                self.dropped += 1
+                notify = chat_id not in self.limited
+                self.limited.add(chat_id)
+        if allowed:
+            return call()
+        if notify:
+            self.reply(chat_id, self.message)
+        return None
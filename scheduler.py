@@ -0,0 +1,144 @@
+"""
+Monitoring schedule. Monitor deadlines and each user's next alert time
+sit on heaps, so a pass only touches users that expire or are due, and
+the upstream fetch interval adapts to how fast new spawns arrive.
+"""
+import heapq
+import random
+import threading
+
+# Seconds between upstream fetches: where it starts and its bounds
+FETCH_INTERVAL = 100
+MIN_FETCH_INTERVAL = 20
+MAX_FETCH_INTERVAL = 300
+# New spawns per fetch at which fetches speed up; with none they slow down
+BUSY_SPAWNS = 20
+# Fraction of an interval that is randomised, to spread fetches and alerts out
+JITTER = 0.1
+# Shortest sleep between passes
+MIN_WAIT = 1.0
+
+
+def jittered(seconds, rng=random):
+    return seconds * rng.uniform(1 - JITTER, 1 + JITTER)
+
+
+def adapt(interval, new_spawns, min_interval=MIN_FETCH_INTERVAL, max_interval=MAX_FETCH_INTERVAL):
+    # Halve the interval while upstream is busy, back off by half again when quiet
+    if new_spawns >= BUSY_SPAWNS:
+        interval /= 2.0
+    elif not new_spawns:
+        interval *= 1.5
+    return min(max_interval, max(min_interval, interval))
+
+
+class MonitorSchedule(object):
+    """
+    Users with an active monitor. Users without an alert interval ("every")
+    are due on every pass; the rest on their own, jittered, cadence. Heap
+    entries are dropped lazily when a user's settings changed. Handlers and
+    the monitor pass call in from different threads.
+    """
+
+    def __init__(self, interval=FETCH_INTERVAL, min_interval=MIN_FETCH_INTERVAL,
+                 max_interval=MAX_FETCH_INTERVAL, rng=random):
+        self.interval = interval
+        self.min_interval = min(min_interval, interval)
+        self.max_interval = max(max_interval, interval)
+        self.rng = rng
+        self.next_fetch = 0
+        # chat_id -> monitor deadline
+        self.monitoring = {}
+        # chat_id -> seconds between alerts, for users who set one
+        self.every = {}
+        # chat_id -> when that user is next due
+        self.next_due = {}
+        # (deadline, chat_id)
+        self.expiry = []
+        # (due, chat_id)
+        self.due = []
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.monitoring)
+
+    def __contains__(self, chat_id):
+        return chat_id in self.monitoring
+
+    def watch(self, chat_id, user, now):
+        # Called whenever a user may have changed
+        with self.lock:
+            self.watch_locked(chat_id, user, now)
+
+    def watch_locked(self, chat_id, user, now):
+        deadline = user.get("monitor", None)
+        if not isinstance(deadline, (int, float)):
+            self.forget(chat_id)
+            return
+        if self.monitoring.get(chat_id) != deadline:
+            self.monitoring[chat_id] = deadline
+            heapq.heappush(self.expiry, (deadline, chat_id))
+        every = user.get("every", None)
+        if not every:
+            self.every.pop(chat_id, None)
+            self.next_due.pop(chat_id, None)
+        elif self.every.get(chat_id) != every:
+            self.every[chat_id] = every
+            self.push_due(chat_id, now + every)
+
+    def push_due(self, chat_id, due):
+        self.next_due[chat_id] = due
+        heapq.heappush(self.due, (due, chat_id))
+
+    def forget(self, chat_id):
+        with self.lock:
+            self.monitoring.pop(chat_id, None)
+            self.every.pop(chat_id, None)
+            self.next_due.pop(chat_id, None)
+
+    def monitored(self):
+        with self.lock:
+            return list(self.monitoring)
+
+    def expired(self, now):
+        # Pops users whose monitor ran out
+        expired = []
+        with self.lock:
+            while self.expiry and self.expiry[0][0] <= now:
+                deadline, chat_id = heapq.heappop(self.expiry)
+                if self.monitoring.get(chat_id) == deadline:
+                    self.forget(chat_id)
+                    expired.append(chat_id)
+        return expired
+
+    def due_now(self, now):
+        # Users to alert on this pass; those with a cadence are rescheduled
+        with self.lock:
+            due = set(chat_id for chat_id in self.monitoring if chat_id not in self.every)
+            while self.due and self.due[0][0] <= now:
+                when, chat_id = heapq.heappop(self.due)
+                if self.next_due.get(chat_id) == when:
+                    due.add(chat_id)
+                    self.push_due(chat_id, now + jittered(self.every[chat_id], self.rng))
+        return due
+
+    def fetch_due(self, now):
+        return now >= self.next_fetch
+
+    def fetched(self, new_spawns, now):
+        self.interval = adapt(self.interval, new_spawns, self.min_interval, self.max_interval)
+        self.next_fetch = now + jittered(self.interval, self.rng)
+
+    def skip(self, now):
+        # Nobody to fetch for; check again an interval later
+        self.next_fetch = now + jittered(self.interval, self.rng)
+
+    def wait(self, now):
+        # Seconds until the next fetch, expiry or user due
+        with self.lock:
+            wakeup = self.next_fetch
+            if self.expiry:
+                wakeup = min(wakeup, self.expiry[0][0])
+            if self.due:
+                wakeup = min(wakeup, self.due[0][0])
+        return max(min(MIN_WAIT, self.min_interval), wakeup - now)
@@ -0,0 +1,316 @@
+"""
+Sharded worker mode: one coordinator process long-polls Telegram and
+fetches upstream spawns, and N worker processes each own the chats whose
+chat_id hashes to their shard. Workers get their chats' updates and every
+spawn batch over multiprocessing queues, and run the usual handlers,
+matching and outbox for their own users.
+
+    TELE_POKEBACON_SHARDS=4 python sharding.py
+
+kill -USR1 adds a worker and kill -USR2 removes one; users move to their
+new owner through the shared store, so a SQLite store is needed. Dead
+workers are restarted on the next monitoring pass.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import traceback
+import zlib
+
+from history import HistoryRecorder
+from outbox import GLOBAL_RATE
+from pokemap import fetch_spawns
+from scheduler import adapt, jittered
+from userstore import open_store
+import telegram
+
+# Seconds a rebalance waits for workers to release their users, checking
+# every RELEASE_POLL seconds that the ones it waits on are still alive
+RELEASE_TIMEOUT = 60
+RELEASE_POLL = 1.0
+
+
+def shard_of(chat_id, shards):
+    # Jump consistent hash (Lamping and Veach) of a digest that is stable across
+    # processes, unlike hash(). Going from n to n + 1 shards moves only 1/(n + 1)
+    # of the chats, all of them to the new shard.
+    key = zlib.crc32(str(chat_id).encode())
+    shard, jump = -1, 0
+    while jump < shards:
+        shard = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((shard + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return shard
+
+
+def worker_main(shard, shards, inbox, results, store_url):
+    # Entry point of a worker process
+    store = open_store(store_url)
+    try:
+        asyncio.run(ShardWorker(shard, shards, inbox, results, store).run())
+    finally:
+        store.close()
+
+
+class ShardWorker(object):
+    """
+    Serves one shard's chats with a Bot that is fed from the coordinator
+    instead of polling Telegram and upstream itself.
+    """
+
+    def __init__(self, shard, shards, inbox, results, store):
+        self.shard = shard
+        self.shards = shards
+        self.inbox = inbox
+        self.results = results
+        self.bot = telegram.Bot(store, owns=self.owns)
+        # Every worker ingests the same batches; one of them keeps the history
+        if shard == 0 and os.environ.get("TELE_POKEBACON_HISTORY"):
+            telegram.feed.recorder = HistoryRecorder(os.environ["TELE_POKEBACON_HISTORY"])
+
+    def owns(self, chat_id):
+        return shard_of(chat_id, self.shards) == self.shard
+
+    async def drain(self):
+        # Wait for this shard's queued chat jobs
+        while self.bot.queues:
+            await asyncio.sleep(0.05)
+
+    async def run(self):
+        bot = self.bot
+        # Each worker sends its share of the bot's global flood limit
+        telegram.outbox.set_global_rate(GLOBAL_RATE / self.shards)
+        telegram.outbox.start()
+        bot.store.start()
+        while True:
+            kind, payload = await bot.call(self.inbox.get)
+            if kind == 'update':
+                bot.dispatch([payload])
+
+            elif kind == 'spawns':
+                if payload is not None:
+                    telegram.feed.ingest(*payload)
+                try:
+                    matches = await bot.call(bot.monitor_pass, False)
+                except Exception:
+                    traceback.print_exc()
+                    matches = {}
+                for chat_id in matches:
+                    bot.submit(chat_id, telegram.send_pokemons, chat_id, matches[chat_id], True)
+                self.results.put(('wants', self.shard, telegram.feed.species.union()))
+
+            elif kind == 'release':
+                await self.drain()
+                self.shards = payload
+                telegram.outbox.set_global_rate(GLOBAL_RATE / self.shards)
+                await bot.call(bot.release)
+                self.results.put(('released', self.shard, None))
+
+            elif kind == 'acquire':
+                await bot.call(bot.acquire)
+
+            elif kind == 'stop':
+                await self.drain()
+                while telegram.outbox.size():
+                    await asyncio.sleep(0.05)
+                return
+
+
+class Coordinator(object):
+    """
+    Polls Telegram and upstream once for the whole bot and routes work to
+    the shard workers, starting, stopping and restarting them as needed.
+    """
+
+    def __init__(self, shards, store_url, monitor_interval=telegram.MONITOR_INTERVAL):
+        # Workers are spawned, not forked, as this process runs threads
+        self.context = multiprocessing.get_context('spawn')
+        self.store_url = store_url
+        # Seconds between fetches, adapting to how busy upstream is
+        self.interval = monitor_interval
+        self.results = self.context.Queue()
+        self.inboxes = []
+        self.workers = []
+        self.shards = 0
+        # shard -> species its monitoring users want
+        self.wants = {}
+        self.inserted = None
+        self.stopped = False
+        # Held while routing, so a rebalance never sees a half-routed update
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.start_workers(shards)
+
+    def start_worker(self, shard):
+        inbox = self.context.Queue()
+        process = self.context.Process(
+            target=worker_main, args=(shard, self.shards, inbox, self.results, self.store_url))
+        process.daemon = True
+        process.start()
+        return inbox, process
+
+    def start_workers(self, shards):
+        self.shards = shards
+        for shard in range(len(self.workers), shards):
+            inbox, process = self.start_worker(shard)
+            self.inboxes.append(inbox)
+            self.workers.append(process)
+
+    def revive(self):
+        # Restart dead workers on their own shard
+        with self.lock:
+            for shard, process in enumerate(self.workers):
+                if not process.is_alive():
+                    print("{} -- Shard {} exited with {}, restarting".format(
+                        telegram.timestamp(), shard, process.exitcode))
+                    self.wants.pop(shard, None)
+                    self.inboxes[shard], self.workers[shard] = self.start_worker(shard)
+
+    def route(self, update):
+        message = update.get("message")
+        if message is None:
+            return
+        with self.lock:
+            self.inboxes[shard_of(message["chat"]["id"], self.shards)].put(('update', update))
+
+    def broadcast(self, message):
+        for inbox in self.inboxes:
+            inbox.put(message)
+
+    def handle_result(self, result):
+        kind, shard, payload = result
+        if kind == 'wants':
+            self.wants[shard] = payload
+        return kind
+
+    def drain_results(self):
+        while True:
+            try:
+                self.handle_result(self.results.get_nowait())
+            except queue.Empty:
+                return
+
+    def mons(self):
+        # Species wanted on any shard; want.txt until every shard has reported
+        if len(self.wants) < self.shards:
+            return None
+        return sorted(set().union(*self.wants.values()))
+
+    def tick(self):
+        # Returns how many spawns were fetched
+        self.drain_results()
+        mons = self.mons()
+        batch = None
+        if mons is None or mons:
+            pokemons, inserted = fetch_spawns(self.inserted, mons)
+            self.inserted = inserted
+            batch = (pokemons, inserted)
+        # Sent even without a batch, so workers still expire monitors
+        with self.lock:
+            self.broadcast(('spawns', batch))
+        return len(batch[0]) if batch else 0
+
+    def rebalance(self, shards):
+        with self.lock:
+            if shards == self.shards:
+                return
+            print("{} -- Rebalancing from {} to {} shards".format(
+                telegram.timestamp(), self.shards, shards))
+            # Every worker flushes the users it stops owning before anyone loads them
+            self.broadcast(('release', shards))
+            pending = set(range(len(self.workers)))
+            deadline = time.time() + RELEASE_TIMEOUT
+            while pending and time.time() < deadline:
+                try:
+                    result = self.results.get(timeout=RELEASE_POLL)
+                except queue.Empty:
+                    result = None
+                if result is not None and self.handle_result(result) == 'released':
+                    pending.discard(result[1])
+                # A dead worker's users are already in the store
+                pending = set(shard for shard in pending if self.workers[shard].is_alive())
+            for shard in pending:
+                print("{} -- Shard {} did not release its users, stopping it".format(
+                    telegram.timestamp(), shard))
+                self.workers[shard].kill()
+                self.workers[shard].join()
+
+            for inbox, process in zip(self.inboxes[shards:], self.workers[shards:]):
+                inbox.put(('stop', None))
+                process.join(RELEASE_TIMEOUT)
+                if process.is_alive():
+                    process.kill()
+            del self.inboxes[shards:]
+            del self.workers[shards:]
+            self.wants = {}
+
+            self.start_workers(shards)
+            self.broadcast(('acquire', None))
+
+    def stop(self):
+        self.stopped = True
+        with self.lock:
+            self.broadcast(('stop', None))
+            for process in self.workers:
+                process.join()
+
+    async def call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(fn, *args))
+
+    async def poll(self):
+        last_update_id = None
+        while not self.stopped:
+            try:
+                updates = await self.call(telegram.get_updates, last_update_id, telegram.POLL_TIMEOUT)
+            except Exception:
+                if not self.stopped:
+                    traceback.print_exc()
+                    await asyncio.sleep(5)
+                continue
+            if len(updates) == 0:
+                continue
+            last_update_id = telegram.get_last_update_id(updates) + 1
+            for update in updates:
+                await self.call(self.route, update)
+
+    async def monitor(self):
+        while True:
+            started = time.time()
+            print("{} -- Trigger monitor, {} shards, every {:.0f} s, http {}".format(
+                telegram.timestamp(), self.shards, self.interval, telegram.client.stats()))
+            try:
+                await self.call(self.revive)
+                self.interval = adapt(self.interval, await self.call(self.tick))
+            except Exception:
+                traceback.print_exc()
+            await asyncio.sleep(max(0, jittered(self.interval) - (time.time() - started)))
+
+    def resize(self, change):
+        asyncio.ensure_future(self.call(self.rebalance, max(1, self.shards + change)))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, self.resize, 1)
+        loop.add_signal_handler(signal.SIGUSR2, self.resize, -1)
+        await asyncio.gather(self.poll(), self.monitor())
+
+
+def main():
+    shards = int(os.environ.get("TELE_POKEBACON_SHARDS", os.cpu_count() or 1))
+    store_url = os.environ.get("TELE_POKEBACON_STORE", "sqlite:users.db")
+    coordinator = Coordinator(shards, store_url)
+    try:
+        asyncio.run(coordinator.run())
+    finally:
+        coordinator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Whole-feed snapshots for /list. Rather than each /list asking sgpokemap
+for everything near one user, the first /list in a while fetches the
+whole feed, and every /list for the next TTL seconds is answered from it
+through a grid over its spawns.
+"""
+import threading
+import time
+
+from pokemap import np, fetch_spawns, filter_pokemons_np, filter_pokemons_py, get_latlong, spawn_columns
+from filters import default_mask, mask_ids
+from spatial import CELL_DEG, cell_of, circle_bbox
+
+# Seconds a snapshot answers /list before the next /list fetches another
+TTL = 15
+# While upstream is failing, /list is answered from a snapshot up to this old
+MAX_STALE = 300
+
+
+class Snapshot(object):
+    """
+    One fetch of the whole feed, with its spawns bucketed by grid cell so a
+    radius query only looks at the cells its circle covers.
+    """
+
+    def __init__(self, pokemons, inserted, mask, fetched=None, cell_deg=CELL_DEG):
+        self.pokemons = pokemons
+        self.inserted = inserted
+        # Species the fetch asked for
+        self.mask = mask
+        self.fetched = time.time() if fetched is None else fetched
+        self.cell_deg = cell_deg
+        cells = {}
+        for i, pokemon in enumerate(pokemons):
+            cells.setdefault(cell_of(get_latlong(pokemon), cell_deg), []).append(i)
+        self.columns = None
+        if np is not None and pokemons:
+            self.columns = spawn_columns(pokemons)
+            cells = dict((cell, np.array(index)) for cell, index in cells.items())
+        self.cells = cells
+
+    def __len__(self):
+        return len(self.pokemons)
+
+    def age(self, now=None):
+        return (now or time.time()) - self.fetched
+
+    def covers(self, mask):
+        return not mask & ~self.mask
+
+    def near(self, latlon, radius_in_km):
+        # Index arrays of the spawns in each cell the circle overlaps
+        min_lat, min_lon, max_lat, max_lon = circle_bbox(latlon, radius_in_km)
+        min_row, min_col = cell_of((min_lat, min_lon), self.cell_deg)
+        max_row, max_col = cell_of((max_lat, max_lon), self.cell_deg)
+        found = []
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                index = self.cells.get((row, col))
+                if index is not None:
+                    found.append(index)
+        return found
+
+    def query(self, latlon, radius_in_km, filter_iv=None, wanted=None, now=None):
+        # Like filter_pokemons over the snapshot, leaving out spawns that have
+        # despawned since it was fetched
+        now = now or time.time()
+        found = self.near(latlon, radius_in_km)
+        if not found:
+            return []
+        if self.columns is None:
+            pokemons = [self.pokemons[i] for index in found for i in index
+                        if int(self.pokemons[i]['despawn']) > now]
+            return filter_pokemons_py(pokemons, latlon, radius_in_km, filter_iv, wanted)
+        index = np.concatenate(found)
+        index = index[self.columns['despawn'][index] > now]
+        columns = dict((key, column[index]) for key, column in self.columns.items())
+        return filter_pokemons_np(
+            [self.pokemons[i] for i in index.tolist()], latlon, radius_in_km, filter_iv,
+            columns=columns, wanted=wanted)
+
+
+class SnapshotCache(object):
+    """
+    The latest Snapshot, fetched again once it is ttl old. Callers who find
+    it expired while a fetch is in flight wait for that fetch instead of
+    starting their own. If the fetch fails they all get the old snapshot,
+    as long as it is under max_stale old.
+    """
+
+    def __init__(self, fetch=fetch_spawns, ttl=TTL, max_stale=MAX_STALE, ingest=None):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_stale = max_stale
+        # Called with each fetched batch before it is served, eg. SpawnFeed.ingest
+        self.ingest = ingest
+        self.snapshot = None
+        # Species mask of the fetch in flight, if any, and how many have finished
+        self.fetching = None
+        self.fetches = 0
+        self.error = None
+        self.cond = threading.Condition()
+        self.hits = 0
+        self.coalesced = 0
+        self.stale = 0
+
+    def get(self, wanted=None):
+        # A snapshot of at least the species in the wanted mask
+        wanted = default_mask() if wanted is None else wanted
+        with self.cond:
+            while True:
+                snapshot = self.snapshot
+                if snapshot is not None and snapshot.covers(wanted) and snapshot.age() < self.ttl:
+                    self.hits += 1
+                    return snapshot
+                if self.fetching is None:
+                    break
+                covered = not wanted & ~self.fetching
+                fetches = self.fetches
+                self.coalesced += covered
+                while self.fetches == fetches:
+                    self.cond.wait()
+                if covered and self.error is not None:
+                    return self.fallback(wanted, self.error)
+                if covered:
+                    return self.snapshot
+            # Keep species earlier callers wanted, so they don't each refetch
+            mask = wanted | (snapshot.mask if snapshot is not None else 0)
+            self.fetching = mask
+
+        fresh = error = None
+        try:
+            pokemons, inserted = self.fetch(None, mask_ids(mask))
+            if self.ingest is not None:
+                pokemons, inserted = self.ingest(pokemons, inserted)
+            fresh = Snapshot(pokemons, inserted, mask)
+        except Exception as e:
+            error = e
+        with self.cond:
+            self.fetching = None
+            self.fetches += 1
+            self.error = error
+            if fresh is not None:
+                self.snapshot = fresh
+            self.cond.notify_all()
+            if error is not None:
+                return self.fallback(wanted, error)
+        return fresh
+
+    def fallback(self, wanted, error):
+        # Called with the lock held, when the fetch for wanted failed
+        snapshot = self.snapshot
+        if snapshot is None or not snapshot.covers(wanted) or snapshot.age() >= self.max_stale:
+            raise error
+        self.stale += 1
+        return snapshot
+
+    def stats(self):
+        return {'hits': self.hits, 'coalesced': self.coalesced, 'fetches': self.fetches, 'stale': self.stale}
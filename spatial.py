@@ -0,0 +1,92 @@
+from math import cos, radians, floor
+
+from pokemap import haversine
+
+# Grid cell size in degrees (~2.2 km of latitude)
+CELL_DEG = 0.02
+KM_PER_DEG_LAT = 111.0
+
+
+def cell_of(latlon, cell_deg=CELL_DEG):
+    lat, lon = latlon
+    return int(floor(lat / cell_deg)), int(floor(lon / cell_deg))
+
+
+def circle_bbox(latlon, radius_in_km):
+    # (min_lat, min_lng, max_lat, max_lng) around a circle
+    lat, lon = latlon
+    dlat = radius_in_km / KM_PER_DEG_LAT
+    dlon = radius_in_km / (KM_PER_DEG_LAT * max(cos(radians(lat)), 0.01))
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+def user_circles(user):
+    # [(latlon, radius_in_km)] a user watches: each of their places, at its own
+    # radius or else theirs, or their one loc and radius
+    radius = user.get("radius")
+    places = user.get("places")
+    if places:
+        return [(latlon, place_radius or radius) for latlon, place_radius, _ in places
+                if place_radius or radius]
+    if user.get("loc") and radius:
+        return [(user["loc"], radius)]
+    return []
+
+
+def users_bbox(users):
+    # Box around every user's circles, or None if there are none
+    boxes = [circle_bbox(latlon, radius_in_km) for user in users.values()
+             for latlon, radius_in_km in user_circles(user)]
+    if not boxes:
+        return None
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+class UserGrid(object):
+    """
+    Buckets user circles (centre + radius) into a lat/lng grid. A spawn is
+    only checked against users whose circle overlaps the spawn's cell, with
+    exact haversine as the final step. A key may have several circles; it
+    matches once, at its nearest.
+    """
+
+    def __init__(self, cell_deg=CELL_DEG):
+        self.cell_deg = cell_deg
+        self.cells = {}
+        self.users = {}
+        # Whether any key has more than one circle
+        self.several = False
+
+    def __len__(self):
+        return len(self.users)
+
+    def add(self, key, latlon, radius_in_km):
+        min_lat, min_lon, max_lat, max_lon = circle_bbox(latlon, radius_in_km)
+        min_row, min_col = cell_of((min_lat, min_lon), self.cell_deg)
+        max_row, max_col = cell_of((max_lat, max_lon), self.cell_deg)
+
+        entry = (key, latlon, radius_in_km)
+        self.several = self.several or key in self.users
+        self.users[key] = entry
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                self.cells.setdefault((row, col), []).append(entry)
+
+    def match(self, latlon, keys=None):
+        # Returns [(key, km_from_location)] of users whose radius covers latlon,
+        # only considering the given keys if any
+        matched = []
+        for key, centre, radius_in_km in self.cells.get(cell_of(latlon, self.cell_deg), ()):
+            if keys is not None and key not in keys:
+                continue
+            km_from_location = haversine(centre, latlon)
+            if km_from_location < radius_in_km:
+                matched.append((key, km_from_location))
+        if self.several and len(matched) > 1:
+            nearest = {}
+            for key, km_from_location in matched:
+                if key not in nearest or km_from_location < nearest[key]:
+                    nearest[key] = km_from_location
+            matched = list(nearest.items())
+        return matched
@@ -0,0 +1,139 @@
+import threading
+
+from pokemap import fetch_spawns, get_latlong, filter_iv_and_sort
+from render import Renderer
+from spatial import UserGrid, users_bbox, user_circles
+from spawnstore import SpawnStore, Notified
+from filters import SpeciesIndex
+
+
+class SpawnFeed(object):
+    """
+    Shared view of the sgpokemap feed. One upstream fetch per tick
+    is fanned out to every monitoring user's own filters in memory, and
+    only spawns not seen by an earlier tick are matched.
+    """
+
+    def __init__(self, fetch=fetch_spawns):
+        self.fetch = fetch
+        self.store = SpawnStore()
+        self.notified = Notified()
+        # species -> monitoring users who want it
+        self.species = SpeciesIndex()
+        # seq of the last spawn handed to monitoring, and per monitoring user
+        self.processed = 0
+        self.watermarks = {}
+        # Spawns the last shared batch added, which paces monitoring fetches
+        self.added = 0
+        # HistoryRecorder appending every spawn seen for the first time, if any
+        self.recorder = None
+        self.inserted = None
+        # The bot fetches from several threads
+        self.lock = threading.Lock()
+
+    def update(self, since=None, mons=None, bbox=None, shared=True):
+        # A batch fetched for anything but monitoring, eg. a /list snapshot, is
+        # not shared: it moves neither the shared cursor nor the added count
+        if bbox is None:
+            pokemons, inserted = self.fetch(since, mons)
+        else:
+            pokemons, inserted = self.fetch(since, mons, bbox=bbox)
+        return self.ingest(pokemons, inserted, shared)
+
+    def ingest(self, pokemons, inserted, shared=True):
+        # Add a batch fetched here or handed over by another process
+        inserted = int(inserted)
+        with self.lock:
+            added = self.store.add(pokemons, inserted)
+            if self.recorder is not None:
+                self.recorder.append(added, inserted)
+            if shared:
+                self.inserted = inserted
+                self.added = len(added)
+        return pokemons, inserted
+
+    def tick(self, users, mons=None, fetch=True, due=None):
+        # Returns {chat_id: matched pokemons} for the due users (default all
+        # monitoring users), the new cursor, and how many new spawns this tick
+        # fetched, 0 if it didn't. With fetch=False, matches what was ingested
+        # since the last tick.
+        if not users:
+            with self.lock:
+                self.processed = self.store.seq
+                self.watermarks.clear()
+            return {}, self.inserted, 0
+
+        # Ask upstream only for species some monitoring user wants
+        self.species.sync(users)
+        if mons is None:
+            mons = self.species.union()
+        if due is None:
+            due = users
+        due = dict((chat_id, users[chat_id]) for chat_id in due if chat_id in users)
+        if not mons:
+            return dict((chat_id, []) for chat_id in due), self.inserted, 0
+
+        # Each due user gets the spawns first seen since they were last matched,
+        # including ones fetched by /list
+        added = 0
+        if fetch:
+            inserted = self.update(self.inserted, mons, users_bbox(users))[1]
+            added = self.added
+        else:
+            inserted = self.inserted
+        with self.lock:
+            watermarks = self.watermarks
+            for chat_id in list(watermarks):
+                if chat_id not in users:
+                    del watermarks[chat_id]
+            for chat_id in users:
+                watermarks.setdefault(chat_id, self.processed)
+            after = dict((chat_id, watermarks[chat_id]) for chat_id in due)
+            new = self.store.added_after(min(after.values()) if after else self.store.seq)
+            for chat_id in due:
+                watermarks[chat_id] = self.store.seq
+            self.processed = self.store.seq
+            self.notified.rebase(self.store.oldest_seq())
+        return self.match(due, new, after), inserted, added
+
+    def match(self, users, pokemons, after=None):
+        # Match each spawn only against users who want its species, in nearby grid
+        # cells, and, given after, only spawns with a higher seq than the user's.
+        # Each spawn is rendered once, however many users it matches.
+        if after is None:
+            self.species.sync(users)
+        grid = UserGrid()
+        cursors = {}
+        for chat_id, user in users.items():
+            for latlon, radius_in_km in user_circles(user):
+                grid.add(chat_id, latlon, radius_in_km)
+            since = user.get("since", None)
+            cursors[chat_id] = int(since) if since else None
+
+        renderer = Renderer()
+        within_radius = dict((chat_id, []) for chat_id in users)
+        for pokemon in pokemons:
+            wanted_by = self.species.users_for(pokemon['pokemon_id'])
+            if not wanted_by:
+                continue
+            for chat_id, km_from_location in grid.match(get_latlong(pokemon), wanted_by):
+                since = cursors[chat_id]
+                if since is not None and pokemon['inserted'] <= since:
+                    continue
+                if after is not None and pokemon['seq'] <= after[chat_id]:
+                    continue
+                if self.notified.seen(chat_id, pokemon['seq']):
+                    continue
+                within_radius[chat_id].append(renderer.match(pokemon, km_from_location))
+
+        matches = {}
+        for chat_id, user in users.items():
+            matches[chat_id] = filter_iv_and_sort(within_radius[chat_id], user.get("iv", None))
+            self.mark_notified(chat_id, matches[chat_id])
+        return matches
+
+    def mark_notified(self, chat_id, pokemons):
+        seqs = [pokemon['seq'] for pokemon in pokemons if pokemon.get('seq')]
+        if seqs:
+            with self.lock:
+                self.notified.add(chat_id, seqs)
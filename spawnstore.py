@@ -0,0 +1,103 @@
+from collections import OrderedDict
+import heapq
+import time
+
+from pokemap import spawn_key
+
+
+class SpawnStore(object):
+    """
+    Live spawns keyed by identity, in the order they were first seen. Each
+    new spawn gets the next sequence number; a despawn-time min-heap evicts
+    expired spawns in O(log n).
+    """
+
+    def __init__(self):
+        self.spawns = OrderedDict()
+        # (despawn, seq, key)
+        self.expiry = []
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.spawns)
+
+    def evict(self, now=None):
+        now = now or time.time()
+        while self.expiry and self.expiry[0][0] <= now:
+            _, _, key = heapq.heappop(self.expiry)
+            del self.spawns[key]
+
+    def add(self, pokemons, inserted, now=None):
+        # Tags each pokemon with the cursor and seq it was first seen with,
+        # and returns only the ones not seen before
+        now = now or time.time()
+        self.evict(now)
+        new = []
+        for pokemon in pokemons:
+            key = spawn_key(pokemon)
+            seen = self.spawns.get(key)
+            if seen is not None:
+                pokemon['inserted'], pokemon['seq'] = seen['inserted'], seen['seq']
+                continue
+            despawn = int(pokemon['despawn'])
+            if despawn <= now:
+                pokemon['inserted'], pokemon['seq'] = inserted, 0
+                continue
+            self.seq += 1
+            pokemon['inserted'], pokemon['seq'] = inserted, self.seq
+            self.spawns[key] = pokemon
+            heapq.heappush(self.expiry, (despawn, self.seq, key))
+            new.append(pokemon)
+        return new
+
+    def oldest_seq(self):
+        for pokemon in self.spawns.values():
+            return pokemon['seq']
+        return self.seq + 1
+
+    def added_after(self, seq):
+        # Spawns first seen after seq, oldest first
+        new = []
+        for pokemon in reversed(self.spawns.values()):
+            if pokemon['seq'] <= seq:
+                break
+            new.append(pokemon)
+        new.reverse()
+        return new
+
+
+class Notified(object):
+    """
+    Per-user bitsets over spawn seq numbers, marking spawns a user was
+    already alerted about. Bits are relative to a base seq and are shifted
+    out as old spawns expire.
+    """
+
+    def __init__(self):
+        # chat_id -> (base, bits)
+        self.bits = {}
+        self.base = 1
+
+    def rebase(self, base):
+        # Forget bits for spawns older than base
+        self.base = base
+        for chat_id, (user_base, bits) in list(self.bits.items()):
+            bits >>= base - user_base
+            if bits:
+                self.bits[chat_id] = (base, bits)
+            else:
+                del self.bits[chat_id]
+
+    def get(self, chat_id):
+        base, bits = self.bits.get(chat_id, (self.base, 0))
+        return bits >> (self.base - base)
+
+    def seen(self, chat_id, seq):
+        return seq >= self.base and bool(self.get(chat_id) >> (seq - self.base) & 1)
+
+    def add(self, chat_id, seqs):
+        bits = self.get(chat_id)
+        for seq in seqs:
+            if seq >= self.base:
+                bits |= 1 << (seq - self.base)
+        self.bits[chat_id] = (self.base, bits)
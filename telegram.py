@@ -1,17 +1,50 @@
-from pokemap import get_location, get_pokemons
+from pokemap import get_location, get_geocode_cache, merge_nearest
+import pokedex
+from filters import user_mask, mask_ids
+from spawnfeed import SpawnFeed
+from snapshot import SnapshotCache
+from spatial import user_circles
+from httpclient import client
+from userstore import open_store, ResidentUsers, User
+from outbox import Outbox, PRIORITY_REPLY, PRIORITY_ALERT
+from webhook import WebhookServer
+from router import Router, Metrics, RateLimit
+from scheduler import MonitorSchedule
+from metrics import REGISTRY, MetricsServer, timed
+from render import alert_html, alert_text
+from history import HistoryRecorder
 from datetime import datetime, timedelta
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
+import math
+import re
+import secrets
+import traceback
 import time
 import os
 
 # Set up Telegram bot
 pokesg_username = os.environ["TELE_POKEBACON_USER"]
 pokesg_api = os.environ["TELE_POKEBACON_API"]
-endpoint = "https://api.telegram.org/bot{}/".format(pokesg_api)
+# Point at a local fake server for testing, eg. http://127.0.0.1:8081/bot{}/
+endpoint = os.environ.get("TELE_POKEBACON_ENDPOINT", "https://api.telegram.org/bot{}/").format(pokesg_api)
 
 send_msg = endpoint + "sendMessage"
 send_loc = endpoint + "sendLocation"
 ep_get_updates = endpoint + "getUpdates"
+ep_set_webhook = endpoint + "setWebhook"
+
+# Send each chat's monitoring alerts from a pass, or its /list, as one message
+# with map links instead of a message and location per pokemon
+MERGE_ALERTS = True
+MERGE_LIST = False
+
+# Shared upstream spawn feed for all users
+feed = SpawnFeed()
+# Whole-feed snapshot /list is answered from; its spawns go into the feed too,
+# so monitoring doesn't alert on ones a /list already showed
+snapshots = SnapshotCache(feed.fetch, ingest=partial(feed.ingest, shared=False))
 
 greetings = '''
 Hi, you must be new! I'll need 2 things for you to get started.
@@ -36,6 +69,7 @@ Once you have set up these 2, you may use this bot to:
 
 /monitor
     - Monitor your location and radius and notify you of new spawns for the next 1 hour
+    - Eg. /monitor 3 to monitor for the next 3 hours instead
 
 /stop
     - Stop the monitoring
@@ -74,12 +108,57 @@ You may set other filters too, such as:
 /include <pokemon>
     - Includes a particular pokemon for tracking
     - Eg. /include dratini
+
+/every <minutes>
+    - While monitoring, send new spawns at most every few minutes
+    - Eg. /every 10
+    - /every alone sends them as soon as they are found
+
+/setloc <address>; <address> ...
+    - Watch up to 5 places at once, eg. home, work and your commute
+    - Each may end with its own radius, else /setradius is used
+    - Eg. /setloc bishan mrt 2km; raffles place mrt
 '''
 
-def telegram_do(method, params=None, chat_id=None):
+def telegram_do(method, params=None, chat_id=None, timeout=None, priority=PRIORITY_REPLY):
+    if chat_id and outbox.running:
+        # Sends to a chat are queued behind the flood limits
+        return outbox.put(chat_id, method, params or [], priority)
+    return telegram_request(method, params, chat_id, timeout)
+
+
+telegram_seconds = REGISTRY.histogram(
+    'pokebacon_telegram_request_seconds', 'Telegram Bot API calls, getUpdates including its long-poll',
+    labels=('method',))
+messages_sent = REGISTRY.counter('pokebacon_messages_sent_total', 'Messages and locations delivered to chats')
+flood_limited = REGISTRY.counter('pokebacon_telegram_429_total', 'Telegram calls refused with 429 Too Many Requests')
+
+
+def telegram_request(method, params=None, chat_id=None, timeout=None):
     if chat_id:
         params += [('chat_id', chat_id)]
-    return requests.get(method, params=params).json()
+    # Sends to a chat are not retried once they may have reached Telegram
+    with telegram_seconds.time((method.rsplit("/", 1)[-1],)):
+        if timeout:
+            result = client.get(method, params=params, timeout=timeout, idempotent=not chat_id).json()
+        else:
+            result = client.get(method, params=params, idempotent=not chat_id).json()
+    if result.get('error_code') == 429:
+        flood_limited.inc()
+    elif chat_id and result.get('ok'):
+        messages_sent.inc()
+    return result
+
+
+# Rate-limited sender for everything the bot posts to chats
+outbox = Outbox(telegram_request)
+REGISTRY.gauge('pokebacon_outbox_queued', 'Messages waiting on the flood limits', fn=outbox.size)
+REGISTRY.gauge('pokebacon_http_in_flight', 'Outbound HTTP requests in flight',
+               fn=lambda: client.stats()['in_flight'])
+REGISTRY.counter('pokebacon_geocode_cache_total', 'Geocode cache lookups by result', labels=('result',),
+                 fn=lambda: get_geocode_cache().stats())
+REGISTRY.counter('pokebacon_list_snapshot_total', '/list snapshot lookups by result', labels=('result',),
+                 fn=snapshots.stats)
 
 
 def get_last_update_id(updates):
@@ -89,31 +168,23 @@ def get_last_update_id(updates):
     return max(update_ids)
 
 
-def get_all_chats(updates):
-    chats = {}
-    for update in updates:
-        chat_id = update["message"]["chat"]["id"]
-        update["message"]["chat"].pop('id')
-        from_user = update["message"]["chat"]
-        chats[chat_id] = chats.get(chat_id, {"chats": []})
-        chats[chat_id]["from"] = from_user
-        text = update["message"].get("text", None)
-        if text:
-            chats[chat_id]["chats"] += [text]
-        else:
-            other_msg_types = set(["location", "contact", "photo"])
-            list_message_type = list(other_msg_types.intersection(set(update["message"])))
-            if len(list_message_type) > 0:
-                message_type = list_message_type[0]
-                chats[chat_id]["chats"] += ["Sent {}".format(message_type)]
-                msg = "Sorry, I cannot accept your {} :(".format(message_type)
-                telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
-            else:
-                chats[chat_id]["chats"] += ["Unrecognized message type"]
-                msg = "Sorry, I don't get it :("
-                telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
-    return chats
-    # telegram_do(send_msg, params=[('text', text)], chat_id=chat)
+# Message types answered with an apology; the bot only reads text
+OTHER_MESSAGE_TYPES = ("location", "contact", "photo")
+
+
+def read_message(update):
+    # (chat_id, chat, text, reply) of a message update: its text, or a stand-in
+    # for other types with the reply to send first
+    message = update["message"]
+    chat = message["chat"]
+    text = message.get("text", None)
+    if text:
+        return chat["id"], chat, text, None
+    for message_type in OTHER_MESSAGE_TYPES:
+        if message_type in message:
+            return (chat["id"], chat, "Sent {}".format(message_type),
+                    "Sorry, I cannot accept your {} :(".format(message_type))
+    return chat["id"], chat, "Unrecognized message type", "Sorry, I don't get it :("
 
 
 def get_updates(offset=None, timeout=None):
@@ -124,10 +195,19 @@ def get_updates(offset=None, timeout=None):
         params += [('timeout', str(timeout))]
     if params == []:
         params = None
-    return telegram_do(ep_get_updates, params=params)['result']
+    # Read timeout must outlast the long-poll, if any
+    connect_timeout, read_timeout = client.timeout
+    if timeout:
+        read_timeout = int(timeout) + 10
+    return telegram_do(ep_get_updates, params=params, timeout=(connect_timeout, read_timeout))['result']
 
 
-def chat_action_list(chat_id, user, since=None, monitor=False, nearest=10):
+def set_webhook(url, secret):
+    params = [('url', url), ('secret_token', secret), ('allowed_updates', '["message"]')]
+    return telegram_do(ep_set_webhook, params=params)
+
+
+def chat_action_list(chat_id, user, nearest=10):
     geocode_latlon = user.get("loc", "")
     radius = user.get("radius", "")
     filter_iv = user.get("iv", None)
@@ -159,7 +239,7 @@ Eg. /setloc city hall mrt
         '''
         telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
 
-    elif radius == "":
+    elif not user_circles(user):
         msg = '''
 Unable to list nearby pokemons. You have not set your radius.
 
@@ -171,31 +251,56 @@ Eg. /setradius 1
         telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
 
     else:
+        wanted = user_mask(user)
+        snapshot = snapshots.get(wanted)
+        # Each of the user's places, with a spawn near several listed once
+        sorted_pokemon_within_radius = merge_nearest(
+            snapshot.query(latlon, radius_in_km, filter_iv, wanted)
+            for latlon, radius_in_km in user_circles(user))
+        age = snapshot.age()
+        if age >= snapshots.ttl:
+            # Only when sgpokemap is failing and an older snapshot is all there is
+            ago = "{} sec".format(int(age)) if age < 60 else "{} min".format(int(age // 60))
+            msg = "The map isn't responding, so these are the spawns from {} ago.".format(ago)
+            telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+        send_pokemons(chat_id, sorted_pokemon_within_radius, nearest=nearest)
+        feed.mark_notified(chat_id, sorted_pokemon_within_radius[:nearest])
+        return snapshot.inserted
+
+
+def send_pokemons(chat_id, sorted_pokemon_within_radius, monitor=False, nearest=10, merge=None):
+    priority = PRIORITY_ALERT if monitor else PRIORITY_REPLY
+    if merge is None:
+        merge = MERGE_ALERTS if monitor else MERGE_LIST
+    if sorted_pokemon_within_radius and merge:
+        send_pokemons_merged(chat_id, sorted_pokemon_within_radius[:nearest], priority)
+    elif sorted_pokemon_within_radius:
         counter = 0
-        sorted_pokemon_within_radius, since = get_pokemons(
-            geocode_latlon, radius, filter_iv=filter_iv, since=since)
-        if sorted_pokemon_within_radius:
-            for pk in sorted_pokemon_within_radius[:nearest]:
-                counter += 1
-                # print counter, pk["name"].upper()
-                message = "{0:<2} {1}\n".format(counter, pk["name"].upper())
-                message += "Distance    : {0:<3.2f} km\n".format(pk["km_from_location"])
-                message += "IV percent  : {0:<3} %\n".format(pk["iv"])
-                message += "Despawn in : {}\n\n".format(pk["time_left_secs"])
-                # Send pokemon summary
-                msg_params = [('text', message)]
-                summary_msg = telegram_do(send_msg, params=msg_params, chat_id=chat_id)
-                # Send location of selected pokemon
-                latitude = pk['lat']
-                longitude = pk['lng']
-                loc_params = [('latitude', latitude), ('longitude', longitude)]
-                loc = telegram_do(send_loc, params=loc_params, chat_id=chat_id)
-        else:
-            if not monitor:
-                message = "Sorry, no pokemons found nearby :/"
-                msg_params = [('text', message)]
-                summary_msg = telegram_do(send_msg, params=msg_params, chat_id=chat_id)
-        return since
+        for pk in sorted_pokemon_within_radius[:nearest]:
+            counter += 1
+            # Send pokemon summary
+            msg_params = [('text', alert_text(counter, pk))]
+            summary_msg = telegram_do(send_msg, params=msg_params, chat_id=chat_id, priority=priority)
+            # Send location of selected pokemon
+            latitude = pk['lat']
+            longitude = pk['lng']
+            loc_params = [('latitude', latitude), ('longitude', longitude)]
+            loc = telegram_do(send_loc, params=loc_params, chat_id=chat_id, priority=priority)
+    else:
+        if not monitor:
+            message = "Sorry, no pokemons found nearby :/"
+            msg_params = [('text', message)]
+            summary_msg = telegram_do(send_msg, params=msg_params, chat_id=chat_id)
+
+
+def send_pokemons_merged(chat_id, pokemons, priority=PRIORITY_REPLY):
+    # One HTML message with map links instead of a message and location per pokemon
+    msg_params = [
+        ('text', alert_html(pokemons)),
+        ('parse_mode', 'HTML'),
+        ('disable_web_page_preview', 'true'),
+    ]
+    telegram_do(send_msg, params=msg_params, chat_id=chat_id, priority=priority)
 
 
 def chat_action_end_monitor(user):
@@ -205,24 +310,96 @@ def chat_action_end_monitor(user):
     return user
 
 
-def chat_action_set_loc(chat, chat_id, user):
-    if chat == "/setloc":
+# Most places a user can watch, and threads geocoding them, shared by all users
+MAX_PLACES = 5
+GEOCODE_WORKERS = 4
+# A radius ending a place in /setloc, eg. "bishan mrt 2km"
+PLACE_RADIUS = re.compile(r'\s+(\d+(?:\.\d+)?)\s*km$')
+
+geocoder = ThreadPoolExecutor(max_workers=GEOCODE_WORKERS)
+
+
+def parse_places(text):
+    # "bishan mrt 2km; raffles place" -> [("bishan mrt", 2.0), ("raffles place", None)];
+    # places are separated by ";" or new lines
+    places = []
+    for address in re.split(r'[;\n]', text.lower()):
+        address = address.strip()
+        if not address:
+            continue
+        radius = None
+        found = PLACE_RADIUS.search(address)
+        if found:
+            radius = float(found.group(1))
+            address = address[:found.start()].strip()
+        places.append((address, radius))
+    if len(places) > MAX_PLACES:
+        raise ValueError("more than {} places".format(MAX_PLACES))
+    return places
+
+
+def locate(address):
+    # (latlon, formatted_address), or None if the address isn't found
+    # Check if 'sg' or 'singapore' found within address
+    add_tokens = address.split(" ")
+    if "sg" not in add_tokens and "singapore" not in add_tokens:
+        add_tokens += ["Singapore"]
+        address = " ".join(add_tokens)
+    try:
+        return get_location(address)
+    except (IndexError, KeyError):
+        return None
+
+
+def chat_action_set_loc(places, chat_id, user):
+    if not places:
         msg = "Please type your address after the command. Example:\n/setloc city hall mrt, singapore"
         telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
-    else:
-        get_string = chat[chat.find("/setloc ")+8:].lower()
-        # Check if 'sg' or 'singapore' found within address
-        add_tokens = get_string.split(" ")
-        if "sg" not in add_tokens and "singapore" not in add_tokens:
-            add_tokens += ["Singapore"]
-            get_string = " ".join(add_tokens)
-
-        geocode_latlon, formatted_address = get_location(get_string)
-        user["loc"] = geocode_latlon
-        user["address"] = formatted_address
-        msg = "Location set to: {}\n\nTo check settings, tap /settings\nTo view pokemon around area, tap /list\nTo setup monitoring, tap /monitor".format(user["address"])
+        return
+    if any(radius and radius > 5.0 for _, radius in places):
+        msg = "Radius set is greater than 5 km. Please /setloc again."
         telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
-        return user
+        return
+    # A place without a radius of its own or a /setradius one would never be watched
+    if len(places) > 1 and not user.get("radius") and not all(radius for _, radius in places):
+        msg = "Please give each place its radius in km, or /setradius first. Example:\n/setloc bishan mrt 2km; raffles place mrt 1km"
+        telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+        return
+
+    # Several addresses are geocoded at once
+    located = list(geocoder.map(locate, [address for address, _ in places]))
+    missing = [address for (address, _), found in zip(places, located) if found is None]
+    if missing:
+        msg = "Sorry, I couldn't find: {}\n\nPlease check the address and /setloc again.".format(
+            "; ".join(missing))
+        telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+        return
+
+    user["loc"], user["address"] = located[0]
+    if len(places) == 1:
+        if "places" in user:
+            del user["places"]
+        if places[0][1]:
+            user["radius"] = places[0][1]
+        msg = "Location set to: {}".format(user["address"])
+        if not user.get("radius"):
+            msg += "\n\nYou have not set your radius yet:\n/setradius <number or decimal>"
+    else:
+        user["places"] = [(latlon, radius, formatted_address)
+                          for (latlon, formatted_address), (_, radius) in zip(located, places)]
+        msg = "Locations set to:\n{}".format(format_places(user))
+    msg += "\n\nTo check settings, tap /settings\nTo view pokemon around area, tap /list\nTo setup monitoring, tap /monitor"
+    telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+    return user
+
+
+def format_places(user):
+    # Each place with the radius it is watched at, its own or else the user's
+    lines = []
+    for n, (_, radius, address) in enumerate(user["places"], 1):
+        radius = radius or user.get("radius")
+        lines.append("  {}. {} ({})".format(n, address, "{:g} km".format(radius) if radius else "radius not set"))
+    return "\n".join(lines)
 
 
 def set_radius(radius, chat_id, user):
@@ -236,22 +413,40 @@ def set_radius(radius, chat_id, user):
         return user
 
 
-def chat_action_set_radius(chat, chat_id, user):
-    if chat == "/setradius":
+def parse_radius(text):
+    # "2", "2km" or "2 km"; None when left out
+    text = text.lower().replace("km", "").strip()
+    return float(text) if text else None
+
+
+def chat_action_set_radius(radius, chat_id, user):
+    if radius is None:
         new_user = set_radius(1.0, chat_id, user)
         msg = "If that is not what you want, please enter your preferred radius after the command. Example:\n/setradius 2"
         telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
         return new_user
     else:
-        get_string = chat[chat.find("/setradius ") + 11:].lower().replace("km", "")
-        radius = float(get_string)
         return set_radius(radius, chat_id, user)
 
 
-def chat_action_monitor(chat_id, user):
+# Longest /monitor, in hours
+MAX_MONITOR_HOURS = 24
+
+
+def parse_hours(text):
+    # Hours to monitor for; None when left out
+    text = text.lower().replace("hours", "").replace("hour", "").replace("h", "").strip()
+    return float(text) if text else None
+
+
+def chat_action_monitor(hours, chat_id, user):
+    if hours is not None and not 0 < hours <= MAX_MONITOR_HOURS:
+        msg = "Monitoring can be set for up to {} hours. Example:\n/monitor 3".format(MAX_MONITOR_HOURS)
+        telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+        return
     since = chat_action_list(chat_id, user)
     if since:
-        monitor_till = datetime.now() + timedelta(hours=1)
+        monitor_till = datetime.now() + timedelta(hours=hours or 1)
         monitor_till_ts = int(time.mktime(monitor_till.timetuple()))
         monitor_pretty = monitor_till.strftime("%Y-%m-%d %-I:%M:%S %p")
         user["monitor"] = monitor_till_ts
@@ -280,25 +475,66 @@ def chat_action_stop_monitor(chat_id, user):
         telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
 
 
+def parse_minutes(text):
+    # Minutes between alerts; None when left out
+    text = text.lower().replace("mins", "").replace("min", "").strip()
+    if not text:
+        return None
+    minutes = float(text)
+    if not math.isfinite(minutes) or minutes <= 0:
+        raise ValueError("not a positive number of minutes: {}".format(text))
+    return minutes
+
+
+def chat_action_every(minutes, chat_id, user):
+    if minutes is None:
+        user["every"] = None
+        msg = "New spawns will be sent as soon as they are found."
+    elif minutes < 1:
+        msg = "Please enter at least 1 minute. Example:\n/every 10"
+        telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+        return
+    else:
+        user["every"] = int(minutes * 60)
+        msg = "New spawns will be sent at most every {:g} mins.\n\nTo undo, tap /every".format(minutes)
+    telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+    return user
+
+
 def chat_action_settings(chat_id, user):
     address = user.get("address", None)
     radius = user.get("radius", None)
     filter_iv = user.get("iv", None)
     monitor_pretty = user.get("monitor_pretty", None)
 
-    if address:
-        msg = "Location : {}\n".format(address)
+    if user.get("places"):
+        # Each place with the radius it is watched at
+        msg = "Locations :\n{}\n".format(format_places(user))
     else:
-        msg = "Location : {}\n".format("Not set")
+        if address:
+            msg = "Location : {}\n".format(address)
+        else:
+            msg = "Location : {}\n".format("Not set")
 
-    if radius:
-        msg += "Radius    : {} km\n".format(radius)
-    else:
-        msg += "Radius    : {}\n".format("Not set")
+        if radius:
+            msg += "Radius    : {} km\n".format(radius)
+        else:
+            msg += "Radius    : {}\n".format("Not set")
 
     if filter_iv:
         msg += "IV filtered > {} %\n".format(filter_iv)
 
+    if user.get("exclude", 0):
+        msg += "Excluded  : {}\n".format(", ".join(
+            pokedex.name(i) for i in mask_ids(user["exclude"])))
+
+    if user.get("include", 0):
+        msg += "Included  : {}\n".format(", ".join(
+            pokedex.name(i) for i in mask_ids(user["include"])))
+
+    if user.get("every", None):
+        msg += "Alerts every : {:g} mins\n".format(user["every"] / 60.0)
+
     if monitor_pretty:
         msg += "Monitoring : {}\n".format(monitor_pretty)
     else:
@@ -315,24 +551,23 @@ def set_filter_iv(iv, chat_id, user):
     return user
 
 
-def chat_action_filter_iv(chat, chat_id, user):
-    if chat == "/filteriv":
+def parse_iv(text):
+    # "80" or "80%"; None when left out
+    text = text.replace("%", "").strip()
+    return int(text) if text else None
+
+
+def chat_action_filter_iv(iv, chat_id, user):
+    if iv is None:
         new_user = set_filter_iv(80, chat_id, user)
         msg = "If that is not what you want, please enter your preferred IV filter after the command. Example:\n/filteriv 90"
         telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
         return new_user
+    elif iv < 0 or iv > 100:
+        msg = "IV filter must be between 0 - 100. Example:\n/filteriv 80"
+        telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
     else:
-        get_string = chat[chat.find("/filteriv ") + 10:].lower().replace("%", "")
-        try:
-            iv = int(get_string)
-            if iv < 0 or iv > 100:
-                msg = "IV filter must be between 0 - 100. Example:\n/filteriv 80"
-                telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
-            else:
-                return set_filter_iv(iv, chat_id, user)
-        except ValueError:
-            msg = "Please enter IV filter between 0 - 100. Example:\n/filteriv 80"
-            telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+        return set_filter_iv(iv, chat_id, user)
 
 
 def chat_action_clear_filter_iv(chat_id, user):
@@ -347,7 +582,51 @@ def chat_action_clear_filter_iv(chat_id, user):
         telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
 
 
-def chat_action_repeat(chat, chat_id):
+def get_pokemon_id(name, chat_id):
+    pokemon_id = pokedex.lookup(name)
+    if pokemon_id is None:
+        msg = "Sorry, I don't know a pokemon called {} :(".format(name)
+        telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+    return pokemon_id
+
+
+def chat_action_exclude(name, chat_id, user):
+    if not name:
+        msg = "Please type the pokemon after the command. Example:\n/exclude dratini"
+        telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+    else:
+        pokemon_id = get_pokemon_id(name, chat_id)
+        if pokemon_id:
+            user["exclude"] = user.get("exclude", 0) | 1 << pokemon_id
+            user["include"] = user.get("include", 0) & ~(1 << pokemon_id)
+            msg = "Excluded {}.\n\nTo undo, tap /include\nTo check your settings here: /settings".format(
+                pokedex.name(pokemon_id))
+            telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+            return user
+
+
+def chat_action_include(name, chat_id, user):
+    if not name:
+        if user.get("exclude", 0):
+            user["exclude"] = 0
+            msg = "Cleared your exclusion list.\nCheck your settings here: /settings\n"
+            telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+            return user
+        else:
+            msg = "No pokemon was excluded."
+            telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+    else:
+        pokemon_id = get_pokemon_id(name, chat_id)
+        if pokemon_id:
+            user["exclude"] = user.get("exclude", 0) & ~(1 << pokemon_id)
+            user["include"] = user.get("include", 0) | 1 << pokemon_id
+            msg = "Included {} for tracking.\nTo check your settings here: /settings".format(
+                pokedex.name(pokemon_id))
+            telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
+            return user
+
+
+def chat_action_repeat(chat, chat_id, user=None):
     if ("copy" in chat.lower() or "stop" in chat.lower()) and "/" not in chat:
         msg = "Hahaha 8-) I'll stop if you give me a command! Like: /list"
         telegram_do(send_msg, params=[('text', msg)], chat_id=chat_id)
@@ -355,108 +634,277 @@ def chat_action_repeat(chat, chat_id):
         telegram_do(send_msg, params=[('text', chat)], chat_id=chat_id)
 
 
-def chat_action(chat, chat_id, user):
-    if "/start" in chat or "/help" in chat:
-        telegram_do(send_msg, params=[('text', greetings)], chat_id=chat_id)
+def chat_action_help(chat_id, user):
+    telegram_do(send_msg, params=[('text', greetings)], chat_id=chat_id)
 
-    elif "/more" in chat:
-        telegram_do(send_msg, params=[('text', more_filters)], chat_id=chat_id)
 
-    elif "/setloc" in chat:
-        return chat_action_set_loc(chat, chat_id, user)
+def chat_action_more(chat_id, user):
+    telegram_do(send_msg, params=[('text', more_filters)], chat_id=chat_id)
 
-    elif "/setradius" in chat:
-        return chat_action_set_radius(chat, chat_id, user)
 
-    elif "/monitor" in chat:
-        return chat_action_monitor(chat_id, user)
+def chat_action_list_nearby(chat_id, user):
+    chat_action_list(chat_id, user)
 
-    elif "/filteriv" in chat:
-        return chat_action_filter_iv(chat, chat_id, user)
 
-    elif "/clearfilter" in chat:
-        return chat_action_clear_filter_iv(chat_id, user)
+def send_text(chat_id, text):
+    return telegram_do(send_msg, params=[('text', text)], chat_id=chat_id)
 
-    elif "/stop" in chat:
-        return chat_action_stop_monitor(chat_id, user)
 
-    elif "/settings" in chat:
-        chat_action_settings(chat_id, user)
+# Commands are matched on the first token of a message; anything else is echoed
+router = Router(send_text, default=chat_action_repeat)
+router.add("/start /help", chat_action_help)
+router.add("/more", chat_action_more)
+router.add("/setloc", chat_action_set_loc, parse=parse_places,
+           usage="You can set up to {} places, separated by ; or new lines. Example:\n/setloc bishan mrt 2km; raffles place mrt".format(MAX_PLACES))
+router.add("/setradius", chat_action_set_radius, parse=parse_radius,
+           usage="Please enter your radius in km after the command. Example:\n/setradius 2")
+router.add("/monitor", chat_action_monitor, parse=parse_hours,
+           usage="Please enter the hours to monitor for. Example:\n/monitor 3")
+router.add("/every", chat_action_every, parse=parse_minutes,
+           usage="Please enter the minutes between alerts. Example:\n/every 10")
+router.add("/filteriv", chat_action_filter_iv, parse=parse_iv,
+           usage="Please enter IV filter between 0 - 100. Example:\n/filteriv 80")
+router.add("/clearfilter", chat_action_clear_filter_iv)
+router.add("/exclude", chat_action_exclude, parse=str.lower)
+router.add("/include", chat_action_include, parse=str.lower)
+router.add("/stop", chat_action_stop_monitor)
+router.add("/settings", chat_action_settings)
+router.add("/list", chat_action_list_nearby)
 
-    elif "/list" in chat:
-        chat_action_list(chat_id, user)
-    else:
-        chat_action_repeat(chat, chat_id)
+command_metrics = Metrics()
+command_limit = RateLimit(send_text, "You're sending commands too fast, please wait a moment.")
+REGISTRY.counter('pokebacon_commands_total', 'Commands handled', labels=('command',),
+                 fn=lambda: dict((name, stats['count']) for name, stats in command_metrics.summary().items()))
+REGISTRY.counter('pokebacon_command_errors_total', 'Commands whose handler raised', labels=('command',),
+                 fn=lambda: dict((name, stats['errors']) for name, stats in command_metrics.summary().items()))
+REGISTRY.counter('pokebacon_commands_dropped_total', 'Commands dropped by the rate limit',
+                 fn=lambda: command_limit.dropped)
+router.use(command_metrics)
+router.use(command_limit)
+
+
+def chat_action(chat, chat_id, user):
+    # Returns the updated user, if the command changed it
+    return router.dispatch(chat, chat_id, user)
+
+
+# Seconds Telegram holds a getUpdates long-poll open
+POLL_TIMEOUT = 120
+# Seconds between upstream fetches to start with; adapts to how busy upstream is
+MONITOR_INTERVAL = 100
+# Threads running blocking handlers and HTTP calls
+WORKERS = 16
+
+monitor_seconds = REGISTRY.histogram('pokebacon_monitor_pass_seconds', 'One pass of the monitoring scheduler')
+spawns_matched = REGISTRY.counter('pokebacon_spawns_matched_total', 'New spawns matched to monitoring users, per user')
+
+
+def timestamp():
+    return datetime.now().strftime("%Y-%m-%d  %I:%M:%S %p")
+
+
+class Bot(object):
+    """
+    Runs the getUpdates long-poll, the command handlers and the monitoring
+    scheduler as independent asyncio tasks. Blocking handlers run in a thread
+    pool; each chat's jobs run in order, and chats don't wait on each other.
+    """
+
+    def __init__(self, store, workers=WORKERS, monitor_interval=MONITOR_INTERVAL, owns=None):
+        self.store = store
+        # Predicate on chat_id for the users this process serves, when sharded
+        self.owns = owns
+        self.schedule = MonitorSchedule(monitor_interval)
+        # Only active monitors are loaded at startup, and kept while monitoring;
+        # anyone else is read from the store on their next message and dropped
+        # from memory again once idle
+        self.users = ResidentUsers(store, pinned=self.schedule.__contains__)
+        REGISTRY.gauge('pokebacon_active_monitors', 'Users with a monitor running', fn=self.schedule.__len__)
+        REGISTRY.gauge('pokebacon_users_loaded', 'Users held in memory', fn=self.users.__len__)
+        REGISTRY.counter('pokebacon_users_evicted_total', 'Users dropped from memory while idle',
+                         fn=lambda: self.users.evicted)
+        REGISTRY.gauge('pokebacon_fetch_interval_seconds', 'Current seconds between upstream fetches',
+                       fn=lambda: self.schedule.interval)
+        self.acquire()
+        # users = {
+        #     323679630: {
+        #         'loc': (1.305192, 103.7909068),
+        #         'radius': 2.0,
+        #         'address': u'1 North Buona Vista Drive, Singapore 138675'
+        #     },
+        # }
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # chat_id -> queue of pending jobs for that chat
+        self.queues = {}
+
+    async def call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(fn, *args))
+
+    def submit(self, chat_id, fn, *args):
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = asyncio.Queue()
+            asyncio.ensure_future(self.chat_worker(chat_id, queue))
+        queue.put_nowait((fn, args))
+
+    async def chat_worker(self, chat_id, queue):
+        while not queue.empty():
+            fn, args = queue.get_nowait()
+            try:
+                await self.call(fn, *args)
+            except Exception:
+                traceback.print_exc()
+        del self.queues[chat_id]
+
+    def handle_chat(self, chat_id, chat):
+        # The user may be dropped from memory meanwhile, so is only looked up once
+        user = self.users.load(chat_id)
+
+        # Send welcome message if user is not previously seen
+        if user is None:
+            telegram_do(send_msg, params=[('text', greetings)], chat_id=chat_id)
+            user = User()
+        # Determine chat action
+        else:
+            user = chat_action(chat, chat_id, user) or user
+        # Watched first, so a user who just started monitoring is pinned in memory
+        self.schedule.watch(chat_id, user, time.time())
+        self.users[chat_id] = user
+        self.store.put(chat_id, user)
+
+    def acquire(self):
+        # Load active monitors this process owns and doesn't have yet
+        for chat_id, user in self.store.load_active(time.time()).items():
+            if chat_id not in self.users and (self.owns is None or self.owns(chat_id)):
+                self.schedule.watch(chat_id, user, time.time())
+                self.users[chat_id] = user
+
+    def release(self):
+        # Hand users this process no longer owns back to the store
+        for chat_id in list(self.users):
+            if not self.owns(chat_id):
+                self.schedule.forget(chat_id)
+                self.store.put(chat_id, self.users.pop(chat_id))
+        self.store.flush()
+
+    @timed(monitor_seconds)
+    def monitor_pass(self, fetch=True):
+        now = time.time()
+        self.users.evict(now)
+        for chat_id in self.schedule.expired(now):
+            user = self.users.get(chat_id)
+            if user is not None:
+                self.users[chat_id] = chat_action_end_monitor(user)
+                self.store.put(chat_id, user)
+
+        monitoring = {}
+        for chat_id in self.schedule.monitored():
+            if chat_id in self.users:
+                monitoring[chat_id] = self.users[chat_id]
+        fetch = fetch and self.schedule.fetch_due(now)
+        if not monitoring:
+            self.schedule.skip(now)
+
+        # Single upstream fetch shared by all monitoring users, or the batch
+        # the sharding coordinator handed over; only due users are alerted
+        matches, since, added = feed.tick(monitoring, fetch=fetch, due=self.schedule.due_now(now))
+        if fetch and monitoring:
+            self.schedule.fetched(added, now)
+        for chat_id in matches:
+            monitoring[chat_id]["since"] = since
+            self.store.put(chat_id, monitoring[chat_id])
+        spawns_matched.inc(sum(len(pokemons) for pokemons in matches.values()))
+        return matches
+
+    async def poll(self):
+        last_update_id = None
+        while True:
+            print("{} -- Polling...".format(timestamp()))
+
+            # Receiving telegram commands
+            try:
+                updates = await self.call(get_updates, last_update_id, POLL_TIMEOUT)
+            except Exception:
+                traceback.print_exc()
+                await asyncio.sleep(5)
+                continue
+            if len(updates) == 0:
+                continue
+            last_update_id = get_last_update_id(updates) + 1
 
+            self.dispatch(updates)
+
+    def dispatch(self, updates):
+        # Each message goes straight onto its chat's queue, in order
+        for update in updates:
+            if "message" not in update:
+                continue
+            chat_id, chat, text, reply = read_message(update)
+            print("{:>10} {}: {}".format(chat.get("first_name", ""), chat.get("last_name", ""), text))
+            if reply:
+                self.submit(chat_id, send_text, chat_id, reply)
+            self.submit(chat_id, self.handle_chat, chat_id, text)
+
+    def handle_update(self, update):
+        # A single pushed update; replies to it only queue on the outbox
+        self.dispatch([update])
+
+    async def monitor(self):
+        while True:
+            if self.schedule.fetch_due(time.time()):
+                print("{} -- Trigger monitor, {} monitoring, every {:.0f} s, http {}, geocode cache {}, outbox {} queued {} sent {} throttled, commands {}".format(
+                    timestamp(), len(self.schedule), self.schedule.interval, client.stats(),
+                    get_geocode_cache().stats(), outbox.size(), outbox.sent, outbox.throttled,
+                    command_metrics.summary()))
+            try:
+                matches = await self.call(self.monitor_pass)
+            except Exception:
+                traceback.print_exc()
+                matches = {}
+            for chat_id in matches:
+                self.submit(chat_id, send_pokemons, chat_id, matches[chat_id], True)
+            await asyncio.sleep(self.schedule.wait(time.time()))
+
+    async def run(self, webhook=None, metrics=None):
+        # Updates come from the getUpdates long-poll, or are pushed to a WebhookServer;
+        # metrics, a MetricsServer, serves the instrumentation if given
+        outbox.start()
+        self.store.start()
+        if metrics is not None:
+            await metrics.start()
+            print("{} -- Metrics on http://{}:{}/metrics".format(timestamp(), metrics.host, metrics.port))
+        if webhook is None:
+            await asyncio.gather(self.poll(), self.monitor())
+        else:
+            await webhook.start(self.handle_update)
+            if webhook.url:
+                print("{} -- Webhook {}".format(
+                    timestamp(), await self.call(set_webhook, webhook.url, webhook.secret.decode())))
+            await self.monitor()
 
 
 def main():
-    last_update_id = None
-    # users keep prior chats in memory
-    users = {}
-    # users = {
-    #     323679630: {
-    #         'loc': (1.305192, 103.7909068),
-    #         'radius': 2.0,
-    #         'address': u'1 North Buona Vista Drive, Singapore 138675'
-    #     },
-    # }
-    # Main code
-    last_monitored = datetime.now() - timedelta(hours=1)
-    while True:
-        now = datetime.now()
-        print("{} -- Polling...".format(now.strftime("%Y-%m-%d  %I:%M:%S %p")))
-
-        # Receiving telegram commands
-        updates = get_updates(offset=last_update_id, timeout='120')
-        if len(updates) > 0:
-            last_update_id = get_last_update_id(updates) + 1
+    store = open_store(os.environ.get("TELE_POKEBACON_STORE", "sqlite:users.db"))
+    webhook = None
+    if os.environ.get("TELE_POKEBACON_WEBHOOK_URL"):
+        webhook = WebhookServer(
+            os.environ.get("TELE_POKEBACON_WEBHOOK_SECRET") or secrets.token_urlsafe(32),
+            url=os.environ["TELE_POKEBACON_WEBHOOK_URL"],
+            port=int(os.environ.get("TELE_POKEBACON_WEBHOOK_PORT", 8443)))
+    metrics = None
+    if os.environ.get("TELE_POKEBACON_METRICS_PORT"):
+        metrics = MetricsServer(port=int(os.environ["TELE_POKEBACON_METRICS_PORT"]))
+    # Keep every spawn seen, for replays and spawn pattern queries
+    if os.environ.get("TELE_POKEBACON_HISTORY"):
+        feed.recorder = HistoryRecorder(os.environ["TELE_POKEBACON_HISTORY"])
+    try:
+        asyncio.run(Bot(store).run(webhook, metrics))
+    finally:
+        store.close()
+        if feed.recorder is not None:
+            feed.recorder.close()
 
-            # Gets only the last updated
-            chats = get_all_chats(updates)
-            for chat in chats:
-                conv = chats[chat]
-                name = "{:>10} {}: ".format(
-                    conv["from"]["first_name"],
-                    conv["from"]["last_name"])
-                print name,
-                for message in conv["chats"]:
-                    print message
-
-            for chat_id in chats:
-                # Send welcome message if user is not previously seen
-                if chat_id not in users.keys():
-                    telegram_do(send_msg, params=[('text', greetings)], chat_id=chat_id)
-                    users[chat_id] = {}
-                # Loop through new chats, and determine chat action
-                else:
-                    user = users[chat_id]
-                    for chat in chats[chat_id]["chats"]:
-                        new_user = chat_action(chat, chat_id, user)
-                        if new_user:
-                            users[chat_id] = new_user
-            # print users
-            time.sleep(0.5)
-
-        # Monitoring mechanism
-        # -- Runs only if time last monitored is more than 100s ago
-        check_now = datetime.now()
-        time_since_last_monitored = check_now - last_monitored
-        if time_since_last_monitored.total_seconds() > 100:
-            print("{} -- Trigger monitor".format(
-                check_now.strftime("%Y-%m-%d  %I:%M:%S %p")))
-            # Execute monitoring
-            for chat_id in users:
-                user = users[chat_id]
-                monitor = user.get("monitor", None)
-                if monitor:
-                    if datetime.fromtimestamp(monitor) < datetime.now():
-                        users[chat_id] = chat_action_end_monitor(user)
-                    else:
-                        users[chat_id]["since"] = chat_action_list(
-                            chat_id, user, since=user["since"], monitor=True)
-
-            last_monitored = check_now
 
 if __name__ == '__main__':
     main()
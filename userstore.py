@@ -0,0 +1,375 @@
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Seconds between write-behind flushes
+FLUSH_INTERVAL = 1.0
+# Flush early once this many users are dirty
+BATCH_SIZE = 500
+# Users kept in memory besides those monitoring, and seconds a user is kept
+# after their last message
+MAX_RESIDENT = 10000
+IDLE_SECONDS = 3600
+# Least seconds between evictions triggered by a new user
+EVICT_INTERVAL = 1.0
+
+
+class User(object):
+    """
+    One user's settings. Reads and writes like the dict it replaced
+    (user["loc"], user.get("iv"), dict(user)) in a fraction of the memory;
+    settings never set are absent, as they were from the dict.
+    """
+    __slots__ = ('loc', 'radius', 'address', 'places', 'iv', 'exclude', 'include', 'every',
+                 'monitor', 'monitor_pretty', 'since')
+    FIELDS = frozenset(__slots__)
+
+    def __init__(self, fields=()):
+        for key, value in dict(fields).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        try:
+            delattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.FIELDS and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return dict(self) == dict(other)
+
+    def __repr__(self):
+        return "User({!r})".format(dict(self))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+
+def dump_user(user):
+    return json.dumps(dict(user), sort_keys=True)
+
+
+def load_user(data):
+    user = User(json.loads(data))
+    if user.get("loc"):
+        user["loc"] = tuple(user["loc"])
+    if user.get("places"):
+        # [(latlon, radius or None, address)]
+        user["places"] = [(tuple(latlon), radius, address) for latlon, radius, address in user["places"]]
+    return user
+
+
+class ResidentUsers(object):
+    """
+    The users a bot holds in memory, least recently used first, in front of
+    its store. Users idle for idle seconds, and the least recently used
+    beyond maxsize, are dropped and read back from the store on their next
+    message; users pinned, eg. while monitoring, stay. Every change is
+    put() to the store as it is made, so dropping a user loses nothing.
+    """
+
+    def __init__(self, store, maxsize=MAX_RESIDENT, idle=IDLE_SECONDS, pinned=None):
+        self.store = store
+        self.maxsize = maxsize
+        self.idle = idle
+        self.pinned = pinned
+        self.users = OrderedDict()
+        # chat_id -> when last used, in the same order
+        self.used = {}
+        self.evicted = 0
+        self.checked = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, chat_id):
+        return chat_id in self.users
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.users))
+
+    def __getitem__(self, chat_id):
+        return self.users[chat_id]
+
+    def get(self, chat_id, default=None):
+        return self.users.get(chat_id, default)
+
+    def items(self):
+        with self.lock:
+            return list(self.users.items())
+
+    def __setitem__(self, chat_id, user):
+        self.put(chat_id, user)
+
+    def put(self, chat_id, user, now=None):
+        now = now or time.time()
+        with self.lock:
+            self.users[chat_id] = user
+            self.users.move_to_end(chat_id)
+            self.used[chat_id] = now
+            if len(self.users) > self.maxsize and now - self.checked >= EVICT_INTERVAL:
+                self.evict(now)
+
+    def pop(self, chat_id, *default):
+        with self.lock:
+            self.used.pop(chat_id, None)
+            return self.users.pop(chat_id, *default)
+
+    def load(self, chat_id, now=None):
+        # The user, from memory or else the store, marked as used; None if unknown
+        with self.lock:
+            user = self.users.get(chat_id)
+        if user is None:
+            user = self.store.get(chat_id)
+            if user is None:
+                return None
+        self.put(chat_id, user, now)
+        return user
+
+    def evict(self, now=None):
+        # Drops idle users and the least recently used beyond maxsize
+        now = now or time.time()
+        dropped = 0
+        with self.lock:
+            self.checked = now
+            # Pinned users go to the back, so each user is looked at once
+            for _ in range(len(self.users)):
+                chat_id = next(iter(self.users))
+                if len(self.users) <= self.maxsize and now - self.used[chat_id] < self.idle:
+                    break
+                if self.pinned is not None and self.pinned(chat_id):
+                    self.users.move_to_end(chat_id)
+                    self.used[chat_id] = now
+                    continue
+                del self.users[chat_id]
+                del self.used[chat_id]
+                dropped += 1
+            self.evicted += dropped
+        return dropped
+
+
+class UserStore(object):
+    """
+    Persistent user settings with write-behind batching: put() only marks a
+    user dirty, and a background thread writes all dirty users in one batch.
+    Backends implement read, write_batch and load_active.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.dirty = {}
+        # Batch being written, still visible to get()
+        self.flushing = {}
+        self.flush_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.flusher = None
+
+    def start(self):
+        self.flusher = threading.Thread(target=self.flush_loop)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def put(self, chat_id, user):
+        with self.cond:
+            self.dirty[chat_id] = dump_user(user)
+            if len(self.dirty) >= self.batch_size:
+                self.cond.notify()
+
+    def get(self, chat_id):
+        with self.cond:
+            data = self.dirty.get(chat_id, self.flushing.get(chat_id))
+        if data is not None:
+            return load_user(data)
+        return self.read(chat_id)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.cond:
+                batch = self.flushing = self.dirty
+                self.dirty = {}
+            if batch:
+                self.write_batch(batch)
+            with self.cond:
+                self.flushing = {}
+
+    def flush_loop(self):
+        while True:
+            with self.cond:
+                if len(self.dirty) < self.batch_size:
+                    self.cond.wait(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        self.flush()
+
+
+class SqliteStore(UserStore):
+
+    def __init__(self, path, **kwargs):
+        UserStore.__init__(self, **kwargs)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            # WAL with synchronous=NORMAL survives a killed process
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS users ("
+                "chat_id INTEGER PRIMARY KEY, monitor INTEGER, data TEXT NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS users_monitor ON users (monitor)")
+            self.db.commit()
+
+    def read(self, chat_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT data FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+        return load_user(row[0]) if row else None
+
+    def write_batch(self, batch):
+        rows = []
+        for chat_id, data in batch.items():
+            rows.append((chat_id, json.loads(data).get("monitor", None), data))
+        with self.lock:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO users (chat_id, monitor, data) VALUES (?, ?, ?)", rows)
+
+    def load_active(self, now):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT chat_id, data FROM users WHERE monitor > ?", (int(now),)).fetchall()
+        return dict((chat_id, load_user(data)) for chat_id, data in rows)
+
+    def close(self):
+        UserStore.close(self)
+        with self.lock:
+            self.db.close()
+
+
+class LogStore(UserStore):
+    """
+    Append-only log of JSON lines, replayed on open. A torn last line from a
+    crash is cut off. The log is compacted once most records are superseded.
+    """
+
+    def __init__(self, path, **kwargs):
+        UserStore.__init__(self, **kwargs)
+        self.path = path
+        self.lock = threading.Lock()
+        self.users = {}
+        # chat_id -> monitor deadline, for load_active
+        self.monitors = {}
+        self.records = 0
+        if os.path.exists(path):
+            self.replay()
+        self.log = open(path, "a")
+
+    def replay(self):
+        valid = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    break
+                chat_id = record["chat_id"]
+                self.users[chat_id] = line[line.index(b'"user": ') + 8:-2].decode("utf-8")
+                self.monitors[chat_id] = record["monitor"]
+                self.records += 1
+                valid += len(line)
+        # Drop a record torn by a crash, so new appends start on a clean line
+        with open(self.path, "r+b") as f:
+            f.truncate(valid)
+
+    def read(self, chat_id):
+        with self.lock:
+            data = self.users.get(chat_id)
+        return load_user(data) if data is not None else None
+
+    def record(self, chat_id, data, monitor):
+        return '{{"chat_id": {}, "monitor": {}, "user": {}}}\n'.format(
+            json.dumps(chat_id), json.dumps(monitor), data)
+
+    def write_batch(self, batch):
+        monitors = dict(
+            (chat_id, json.loads(data).get("monitor", None)) for chat_id, data in batch.items())
+        lines = "".join(
+            self.record(chat_id, data, monitors[chat_id]) for chat_id, data in batch.items())
+        with self.lock:
+            self.log.write(lines)
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.users.update(batch)
+            self.monitors.update(monitors)
+            self.records += len(batch)
+            if self.records > 2 * len(self.users) + 1000:
+                self.compact()
+
+    def compact(self):
+        # Called with the lock held
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for chat_id, data in self.users.items():
+                f.write(self.record(chat_id, data, self.monitors[chat_id]))
+            f.flush()
+            os.fsync(f.fileno())
+        self.log.close()
+        os.rename(tmp_path, self.path)
+        self.log = open(self.path, "a")
+        self.records = len(self.users)
+
+    def load_active(self, now):
+        with self.lock:
+            return dict(
+                (chat_id, load_user(self.users[chat_id]))
+                for chat_id, monitor in self.monitors.items() if monitor and monitor > now)
+
+    def close(self):
+        UserStore.close(self)
+        with self.lock:
+            self.log.close()
+
+
+def open_store(url, **kwargs):
+    # eg. sqlite:users.db or log:users.log
+    kind, _, path = url.partition(":")
+    if kind == "sqlite":
+        return SqliteStore(path, **kwargs)
+    if kind == "log":
+        return LogStore(path, **kwargs)
+    raise ValueError("Unknown user store: {}".format(url))
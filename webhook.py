@@ -0,0 +1,72 @@
+"""
+Webhook ingestion: Telegram POSTs each update as it happens instead of
+the bot long-polling getUpdates, and each update goes straight to the
+handlers. Plain HTTP on asyncio streams; run it behind a TLS-terminating
+proxy, as Telegram only delivers to https URLs.
+"""
+from collections import OrderedDict
+import hmac
+import json
+
+from httpserver import HttpServer
+
+# Recent update_ids remembered, to drop Telegram's redeliveries
+SEEN_UPDATES = 10000
+
+
+class WebhookServer(HttpServer):
+    """
+    Accepts Telegram updates on path, checking the secret token Telegram
+    sends with each request, and passes every update not seen before to the
+    handler. Connections are kept alive between updates.
+    """
+
+    def __init__(self, secret, url=None, path="/telegram", host="0.0.0.0", port=8443):
+        super(WebhookServer, self).__init__(host, port)
+        self.secret = secret.encode()
+        # Public URL to register with setWebhook, if any
+        self.url = url
+        self.path = path
+        self.handle = None
+        self.seen = OrderedDict()
+        # Highest update_id handled; older ones outside the window are redeliveries
+        self.last_update_id = 0
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    async def start(self, handle):
+        self.handle = handle
+        return await super(WebhookServer, self).start()
+
+    def accept(self, update):
+        # True the first time an update_id is seen
+        update_id = update.get("update_id")
+        if update_id is None:
+            return True
+        if update_id in self.seen or update_id <= self.last_update_id - SEEN_UPDATES:
+            self.duplicates += 1
+            return False
+        self.seen[update_id] = True
+        if len(self.seen) > SEEN_UPDATES:
+            self.seen.popitem(last=False)
+        self.last_update_id = max(self.last_update_id, update_id)
+        return True
+
+    async def process(self, method, target, headers, body):
+        if target.split("?", 1)[0] != self.path:
+            return 404, 'text/plain', ''
+        if method != "POST":
+            return 405, 'text/plain', ''
+        token = headers.get("x-telegram-bot-api-secret-token", "").encode()
+        if not hmac.compare_digest(token, self.secret):
+            self.rejected += 1
+            return 401, 'text/plain', ''
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400, 'text/plain', ''
+        self.received += 1
+        if self.accept(update):
+            self.handle(update)
+        return 200, 'text/plain', ''